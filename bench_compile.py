@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+# Times the compiler itself: importing the emitter, and compiling patches.
+#
+# Copyright (C) 2013 Jared Boone, ShareBrained Technology, Inc.
+#
+# This file is part of PD compiler.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# Each measurement runs in a fresh interpreter, as a user running
+# pd_compile.py would. With --baseline, the same measurements are made
+# against another checkout of the compiler (for example an older commit,
+# checked out with "git worktree add"), to show the difference.
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+def run_time(args, cwd, env=None):
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        subprocess.check_call(args, cwd=cwd, env=env, stdout=devnull)
+        return time.time() - start
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def measure(compiler_dir, patches, repeat):
+    """Median seconds to import emit_c, and to compile each patch."""
+    compiler_dir = os.path.abspath(compiler_dir)
+    import_args = [sys.executable, '-c', 'import emit_c']
+    import_time = median([run_time(import_args, compiler_dir) for k in range(repeat)])
+    compile_times = []
+    work_dir = tempfile.mkdtemp()
+    # Every run must compile, rather than find the last run's output in the
+    # compile cache. A checkout from before the cache has no --no-cache, so
+    # the cache is also pointed into work_dir, away from the user's.
+    env = dict(os.environ)
+    env['XDG_CACHE_HOME'] = work_dir
+    cache_options = []
+    if os.path.exists(os.path.join(compiler_dir, 'compile_cache.py')):
+        cache_options.append('--no-cache')
+    try:
+        for patch in patches:
+            patch_copy = os.path.join(work_dir, os.path.basename(patch))
+            shutil.copy(patch, patch_copy)
+            compile_args = [sys.executable, os.path.join(compiler_dir, 'pd_compile.py')] + cache_options + [patch_copy]
+            compile_times.append(median([run_time(compile_args, work_dir, env) for k in range(repeat)]))
+    finally:
+        shutil.rmtree(work_dir)
+    return import_time, compile_times
+
+arg_parser = argparse.ArgumentParser(description='Time importing the code emitter and compiling patches.')
+arg_parser.add_argument('patches', nargs='+', help='Pure Data patch files (.pd)')
+arg_parser.add_argument('--repeat', type=int, default=10,
+                        help='runs per measurement; the median is reported (default: 10)')
+arg_parser.add_argument('--baseline', metavar='DIR',
+                        help='another checkout of the compiler to compare against')
+
+def main():
+    args = arg_parser.parse_args()
+
+    if args.repeat < 1:
+        arg_parser.error('repeat must be at least 1')
+
+    compilers = [('current', os.path.dirname(os.path.abspath(__file__)))]
+    if args.baseline:
+        compilers.append(('baseline', args.baseline))
+
+    results = [(name, measure(compiler_dir, args.patches, args.repeat)) for name, compiler_dir in compilers]
+
+    print('%-30s %s' % ('', ' '.join(('%12s' % name for name, result in results))))
+    print('%-30s %s' % ('import emit_c', ' '.join(('%10.1fms' % (result[0] * 1000.0) for name, result in results))))
+    for k, patch in enumerate(args.patches):
+        print('%-30s %s' % (os.path.basename(patch), ' '.join(('%10.1fms' % (result[1][k] * 1000.0)
+                                                                for name, result in results))))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
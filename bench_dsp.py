@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+# Times the C code generated for patches, and compares with a baseline.
+#
+# Copyright (C) 2013 Jared Boone, ShareBrained Technology, Inc.
+#
+# This file is part of PD compiler.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# Each patch is compiled with the given pd_compile.py options, built with
+# bench_main.c and run --repeat times; the run with the median processing
+# time is kept. Results are saved as JSON with --output. With --baseline,
+# each patch is compared with the same patch in an earlier results file,
+# by cycles per sample when both have them and by time otherwise, and a
+# patch that got slower by more than --threshold is a regression.
+
+import argparse
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import pd_compile
+
+compiler_dir = os.path.dirname(os.path.abspath(__file__))
+
+def c_defines(compile_options):
+    """The bench_main.c defines that match the pd_compile.py options."""
+    options = pd_compile.arg_parser.parse_args(compile_options + ['patch.pd'])
+    defines = []
+    if options.numeric != 'float':
+        defines.append('-DPATCH_%s' % options.numeric.upper())
+    if options.state == 'struct':
+        defines.append('-DPATCH_STATE_STRUCT')
+    return defines
+
+def measure(patch, args, work_dir):
+    """Builds and times one patch, and returns its results."""
+    base = os.path.join(work_dir, os.path.splitext(os.path.basename(patch))[0])
+    shutil.copy(patch, base + '.pd')
+    compile_options = shlex.split(args.compile_options)
+    subprocess.check_output([sys.executable, os.path.join(compiler_dir, 'pd_compile.py'), '--no-cache',
+                             '--dac=interleaved', '--path=%s' % os.path.dirname(os.path.abspath(patch))] +
+                            compile_options + [base + '.pd'], stderr=subprocess.STDOUT)
+    executable = base + '.bench'
+    subprocess.check_output([args.cc] + shlex.split(args.cflags) + c_defines(compile_options) +
+                            ['-o', executable, base + '.c', os.path.join(compiler_dir, 'bench_main.c'), '-lm'],
+                            stderr=subprocess.STDOUT)
+    runs = []
+    for k in range(args.repeat):
+        output = subprocess.check_output([executable, '%g' % args.seconds], cwd=work_dir)
+        runs.append(json.loads(output.decode('utf-8')))
+    run = sorted(runs, key=lambda r: r['process_ns'])[len(runs) // 2]
+    result = {
+        'init_ns': run['init_ns'],
+        'ns_per_sample': float(run['process_ns']) / run['samples'],
+        'cycles_per_sample': None,
+    }
+    if run['cycles'] is not None:
+        result['cycles_per_sample'] = float(run['cycles']) / run['samples']
+    return result
+
+def compare(result, baseline):
+    """(metric name, ratio of result to baseline), preferring cycles."""
+    for metric in ('cycles_per_sample', 'ns_per_sample'):
+        if result.get(metric) and baseline.get(metric):
+            return metric, result[metric] / baseline[metric]
+    return None, None
+
+arg_parser = argparse.ArgumentParser(description='Time generated DSP code, and compare with a baseline.')
+arg_parser.add_argument('patches', nargs='+', metavar='patch',
+                        help='Pure Data patch file (.pd), or a directory of them')
+arg_parser.add_argument('--compile-options', default='',
+                        help='pd_compile.py options to benchmark, given with "=", for example '
+                             '--compile-options="--trig=table --numeric=q15"')
+arg_parser.add_argument('--seconds', type=float, default=10.0,
+                        help='seconds of audio timed per run (default: 10)')
+arg_parser.add_argument('--repeat', type=int, default=5,
+                        help='runs per patch; the median is kept (default: 5)')
+arg_parser.add_argument('--cc', default='gcc', help='C compiler (default: gcc)')
+arg_parser.add_argument('--cflags', default='-std=gnu99 -O2',
+                        help='C compiler options (default: %(default)s)')
+arg_parser.add_argument('-o', '--output', metavar='FILE', help='save the results as JSON')
+arg_parser.add_argument('--baseline', metavar='FILE', help='results to compare with')
+arg_parser.add_argument('--threshold', type=float, default=5.0,
+                        help='percentage slowdown that counts as a regression (default: 5)')
+
+def main():
+    args = arg_parser.parse_args()
+    if args.repeat < 1:
+        arg_parser.error('repeat must be at least 1')
+    if args.seconds <= 0.0:
+        arg_parser.error('seconds must be positive')
+    paths = pd_compile.patch_paths(args.patches)
+    if not paths:
+        arg_parser.error('no patches found')
+    baseline = {}
+    if args.baseline:
+        baseline = json.load(open(args.baseline, 'r'))['results']
+
+    results = {}
+    failures = []
+    regressions = []
+    print('%-32s %10s %10s %13s %s' % ('patch', 'init us', 'ns/sample', 'cycles/sample', 'baseline'))
+    work_dir = tempfile.mkdtemp()
+    try:
+        for patch in paths:
+            try:
+                result = measure(patch, args, work_dir)
+            except subprocess.CalledProcessError as e:
+                lines = (e.output or b'').decode('utf-8', 'replace').strip().splitlines() or [
+                         'exit status %d' % e.returncode]
+                print('%-32s failed: %s' % (patch, lines[-1]))
+                failures.append(patch)
+                continue
+            results[patch] = result
+            comparison = ''
+            if patch in baseline:
+                metric, ratio = compare(result, baseline[patch])
+                if metric is not None:
+                    change = (ratio - 1.0) * 100.0
+                    comparison = '%+.1f%% %s' % (change, metric)
+                    if change > args.threshold:
+                        regressions.append((patch, comparison))
+                        comparison += '  REGRESSION'
+            cycles = result['cycles_per_sample']
+            print('%-32s %10.1f %10.2f %13s %s' % (patch, result['init_ns'] / 1000.0, result['ns_per_sample'],
+                                                  '%.1f' % cycles if cycles is not None else '-', comparison))
+    finally:
+        shutil.rmtree(work_dir)
+
+    if args.output:
+        output_file = open(args.output, 'w')
+        json.dump({'compile_options': args.compile_options,
+                   'cc': args.cc,
+                   'cflags': args.cflags,
+                   'results': results}, output_file, indent=2, sort_keys=True)
+        output_file.write('\n')
+        output_file.close()
+
+    for patch in failures:
+        print('failed %s' % patch)
+    for patch, comparison in regressions:
+        print('regression %s: %s' % (patch, comparison))
+    return 1 if failures or regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
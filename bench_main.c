@@ -0,0 +1,194 @@
+/*
+ * Wrapper main() that times generated C code, for bench_dsp.py.
+ *
+ * Copyright (C) 2013 Jared Boone, ShareBrained Technology, Inc.
+ *
+ * This file is part of PD compiler.
+ *
+ * This program is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU General Public License
+ * as published by the Free Software Foundation; either version 2
+ * of the License, or (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+ * 02110-1301, USA.
+ */
+
+/* Usage: main [seconds]. Times init(), then runs dsptick() for a second
+ * of audio untimed so that caches and branch predictors settle, then
+ * times the given number of seconds of audio (10 by default). The results
+ * are printed as one JSON object. CPU cycles are counted with Linux perf
+ * events where they are available, and are null otherwise. The patch
+ * must be compiled with a buffer dac~ backend ("--dac=interleaved" or
+ * "--dac=planar"), so that no time goes to writing files. */
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <stdint.h>
+#include <time.h>
+
+#ifdef __linux__
+#include <string.h>
+#include <unistd.h>
+#include <sys/ioctl.h>
+#include <sys/syscall.h>
+#include <linux/perf_event.h>
+#endif
+
+#define SAMPLING_RATE 44100
+
+extern const int dsp_block_size;
+extern const int dsp_output_channels;
+
+/* As in main.c. */
+#if defined(PATCH_Q15)
+typedef int16_t sample_t;
+#elif defined(PATCH_Q31)
+typedef int32_t sample_t;
+#else
+typedef float sample_t;
+#endif
+
+#ifdef PATCH_STATE_STRUCT
+typedef struct patch_state patch_state_t;
+extern const size_t patch_state_size;
+
+extern void init(patch_state_t *state);
+extern void dsptick(patch_state_t *state, sample_t *out, int n);
+extern void deinit(patch_state_t *state);
+
+static patch_state_t *state = NULL;
+#define PATCH_INIT() init(state)
+#define PATCH_DSPTICK(out, n) dsptick(state, out, n)
+#define PATCH_DEINIT() deinit(state)
+#else
+extern void init();
+extern void dsptick(sample_t *out, int n);
+extern void deinit();
+
+#define PATCH_INIT() init()
+#define PATCH_DSPTICK(out, n) dsptick(out, n)
+#define PATCH_DEINIT() deinit()
+#endif
+
+/* Keeps the output live. */
+volatile sample_t sink;
+
+static long long now_ns(void) {
+    struct timespec t;
+    clock_gettime(CLOCK_MONOTONIC, &t);
+    return (long long)t.tv_sec * 1000000000LL + t.tv_nsec;
+}
+
+/* Returns a file descriptor counting user-space CPU cycles of this
+ * process, or -1. */
+static int cycle_counter_open(void) {
+#ifdef __linux__
+    struct perf_event_attr attr;
+    memset(&attr, 0, sizeof(attr));
+    attr.type = PERF_TYPE_HARDWARE;
+    attr.size = sizeof(attr);
+    attr.config = PERF_COUNT_HW_CPU_CYCLES;
+    attr.disabled = 1;
+    attr.exclude_kernel = 1;
+    attr.exclude_hv = 1;
+    return (int)syscall(__NR_perf_event_open, &attr, 0, -1, -1, 0);
+#else
+    return -1;
+#endif
+}
+
+static void cycle_counter_start(int fd) {
+#ifdef __linux__
+    if(fd >= 0) {
+        ioctl(fd, PERF_EVENT_IOC_RESET, 0);
+        ioctl(fd, PERF_EVENT_IOC_ENABLE, 0);
+    }
+#endif
+}
+
+static long long cycle_counter_stop(int fd) {
+#ifdef __linux__
+    long long count = 0;
+    if(fd >= 0) {
+        ioctl(fd, PERF_EVENT_IOC_DISABLE, 0);
+        if(read(fd, &count, sizeof(count)) == sizeof(count)) {
+            return count;
+        }
+    }
+#endif
+    return -1;
+}
+
+static void run(sample_t *block, int total) {
+    int i = 0;
+    int n = 0;
+    for(i=0; i<total; i+=n) {
+        n = (total - i < dsp_block_size) ? (total - i) : dsp_block_size;
+        PATCH_DSPTICK(block, n);
+        sink = block[0];
+    }
+}
+
+int main(int argc, char* argv[]) {
+    const double seconds = (argc > 1) ? atof(argv[1]) : 10.0;
+    const int total = (int)(seconds * SAMPLING_RATE);
+    const int channels = (dsp_output_channels > 0) ? dsp_output_channels : 1;
+    sample_t *block = NULL;
+    long long init_ns = 0;
+    long long process_ns = 0;
+    long long cycles = -1;
+    int counter = -1;
+
+    if(dsp_output_channels == 0) {
+        fprintf(stderr, "compile the patch with --dac=interleaved or --dac=planar\n");
+        return 1;
+    }
+    block = calloc((size_t)dsp_block_size * channels, sizeof(sample_t));
+    if(block == NULL) {
+        fprintf(stderr, "unable to allocate output buffer\n");
+        return 1;
+    }
+#ifdef PATCH_STATE_STRUCT
+    state = malloc(patch_state_size);
+    if(state == NULL) {
+        fprintf(stderr, "unable to allocate patch state\n");
+        return 1;
+    }
+#endif
+
+    init_ns = now_ns();
+    PATCH_INIT();
+    init_ns = now_ns() - init_ns;
+
+    run(block, SAMPLING_RATE);
+
+    counter = cycle_counter_open();
+    cycle_counter_start(counter);
+    process_ns = now_ns();
+    run(block, total);
+    process_ns = now_ns() - process_ns;
+    cycles = cycle_counter_stop(counter);
+
+    PATCH_DEINIT();
+
+    printf("{\"init_ns\": %lld, \"samples\": %d, \"process_ns\": %lld, \"cycles\": ", init_ns, total, process_ns);
+    if(cycles >= 0) {
+        printf("%lld}\n", cycles);
+    } else {
+        printf("null}\n");
+    }
+
+#ifdef PATCH_STATE_STRUCT
+    free(state);
+#endif
+    free(block);
+    return 0;
+}
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+# Compares the output of compiled patches against the NumPy interpreter.
+#
+# Copyright (C) 2013 Jared Boone, ShareBrained Technology, Inc.
+#
+# This file is part of PD compiler.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# Each patch is rendered by interpret.py as the reference, then compiled
+# with each backend's options, built with main.c and run. The three
+# seconds of output that main.c writes are compared with the reference.
+# A patch that a backend refuses to compile (for example log~ of an
+# unbounded signal in fixed point) is listed as unsupported; any other
+# compiler error, a generated file that doesn't build or run, or output
+# outside the thresholds, is a failure.
+#
+# Each backend has its own default thresholds. The float backends (float,
+# simd-gcc, no-optimize, threads) are compared with a reference whose
+# oscillator phases add up in float32 as theirs do, so they match it to
+# within rounding; their tight limits catch any change in what the float
+# code computes. --trig=table and poly follow the same phases, and their
+# SNR limit catches a cosine approximation that has got worse. Fixed-point
+# phases are near exact, like the default reference, but a phasor~ can
+# wrap a sample apart from it, so q15 and q31 only have an SNR limit, set
+# to catch mistakes in scaling or detuned oscillators rather than rounding.
+# --max-error and --min-snr replace the defaults for every backend.
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy
+
+import pdom
+import interpret
+from pd_compile import dsp_chain, patch_paths, UNSUPPORTED_STATUS
+
+# main.c renders this many frames.
+MAIN_FRAMES = 44100 * 3
+
+compiler_dir = os.path.dirname(os.path.abspath(__file__))
+
+# name: (pd_compile.py options, C compiler options, whether the output
+# saturates at full scale, the --trig whose float32 phases the reference
+# follows, or None for exact phases, default maximum error, default
+# minimum SNR in dB). The reference is clipped the same way for backends
+# that saturate. A limit of None isn't checked.
+backends = {
+    'float': ([], [], False, 'libm', 1e-4, 90.0),
+    'trig-table': (['--trig=table'], [], False, 'table', None, 40.0),
+    'trig-poly': (['--trig=poly'], [], False, 'poly', None, 40.0),
+    'q15': (['--numeric=q15'], ['-DPATCH_Q15'], True, None, None, 25.0),
+    'q31': (['--numeric=q31'], ['-DPATCH_Q31'], True, None, None, 25.0),
+    'simd-gcc': (['--simd=gcc'], [], False, 'libm', 1e-4, 90.0),
+    'no-optimize': (['--no-optimize'], [], False, 'libm', 1e-4, 90.0),
+    'threads': (['--partitions=4'], ['-pthread', '-DPATCH_THREADS', os.path.join(compiler_dir, 'dsp_threads.c')], False,
+                'libm', 1e-4, 90.0),
+}
+
+def compare(reference, output):
+    """(max error, RMS error, SNR in dB) of output against reference.
+    Samples that are NaN in both count as equal; NaN in one only is an
+    infinite error."""
+    reference = reference.astype(numpy.float64)
+    output = output.astype(numpy.float64)
+    both_nan = numpy.isnan(reference) & numpy.isnan(output)
+    error = numpy.where(both_nan, 0.0, numpy.abs(output - reference))
+    error[numpy.isnan(error)] = float('inf')
+    signal = numpy.where(numpy.isnan(reference), 0.0, reference)
+    if not error.size:
+        return 0.0, 0.0, float('inf')
+    max_error = error.max()
+    rms_error = numpy.sqrt(numpy.mean(error ** 2))
+    signal_power = numpy.sum(signal ** 2)
+    error_power = numpy.sum(error ** 2)
+    if error_power == 0.0:
+        snr = float('inf')
+    elif signal_power == 0.0 or not numpy.isfinite(error_power):
+        snr = float('-inf')
+    else:
+        snr = 10.0 * numpy.log10(signal_power / error_power)
+    return max_error, rms_error, snr
+
+def render_reference(patch, search_path, trig=None):
+    """The interpreter's output for the patch, and its samples/second."""
+    parse_context = pdom.parse_patch(open(patch, 'r'), search_path)
+    start = time.time()
+    frames = interpret.Interpreter(dsp_chain(parse_context.objects), parse_context.objects,
+                                   trig=trig).render(MAIN_FRAMES)
+    return frames, MAIN_FRAMES / max(time.time() - start, 1e-9)
+
+def run_backend(patch, backend, args, work_dir):
+    """Compiles, builds and runs the patch. Returns (frames, samples per
+    second), or raises CalledProcessError."""
+    compile_options, c_options = backends[backend][:2]
+    base = os.path.join(work_dir, backend)
+    shutil.copy(patch, base + '.pd')
+    path_options = ['--path=%s' % os.path.dirname(os.path.abspath(patch))]
+    path_options.extend(('--path=%s' % directory for directory in args.path))
+    subprocess.check_output([sys.executable, os.path.join(compiler_dir, 'pd_compile.py'), '--no-cache',
+                             '--dac=interleaved'] + path_options + compile_options + [base + '.pd'],
+                            stderr=subprocess.STDOUT)
+    executable = base + '.main'
+    subprocess.check_output([args.cc] + args.cflags.split() + c_options +
+                            ['-o', executable, base + '.c', os.path.join(compiler_dir, 'main.c'), '-lm'],
+                            stderr=subprocess.STDOUT)
+    times = []
+    for k in range(args.repeat):
+        start = time.time()
+        subprocess.check_output([executable], cwd=work_dir, stderr=subprocess.STDOUT)
+        times.append(time.time() - start)
+    frames = numpy.fromfile(os.path.join(work_dir, 'out.f32'), dtype='<f4')
+    return frames, MAIN_FRAMES / max(sorted(times)[len(times) // 2], 1e-9)
+
+def check(value, limit, exceeds):
+    return limit is not None and exceeds(value, limit)
+
+arg_parser = argparse.ArgumentParser(description='Compare compiled patches with the NumPy interpreter.')
+arg_parser.add_argument('patches', nargs='+', metavar='patch',
+                        help='Pure Data patch file (.pd), or a directory of them')
+arg_parser.add_argument('--backend', action='append', choices=sorted(backends.keys()),
+                        help='backend to check; may be given more than once (default: all)')
+arg_parser.add_argument('--max-error', type=float,
+                        help='fail when a sample differs from the reference by more than this '
+                             '(default: set for each backend)')
+arg_parser.add_argument('--max-rms', type=float,
+                        help='fail when the RMS error is more than this')
+arg_parser.add_argument('--min-snr', type=float,
+                        help='fail when the signal to error ratio is below this many dB '
+                             '(default: set for each backend)')
+arg_parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of each executable; the median time is reported (default: 3)')
+arg_parser.add_argument('--cc', default='gcc', help='C compiler (default: gcc)')
+arg_parser.add_argument('--cflags', default='-std=gnu99 -O2',
+                        help='C compiler options (default: %(default)s)')
+arg_parser.add_argument('--path', action='append', default=[], metavar='DIR',
+                        help='directory to search for abstractions')
+
+def main():
+    args = arg_parser.parse_args()
+    if args.repeat < 1:
+        arg_parser.error('repeat must be at least 1')
+    selected = args.backend or sorted(backends.keys())
+    paths = patch_paths(args.patches)
+    if not paths:
+        arg_parser.error('no patches found')
+
+    print('%-24s %-12s %10s %10s %9s %12s' % ('patch', 'backend', 'max error', 'rms error', 'snr dB', 'samples/s'))
+    failures = []
+    for patch in paths:
+        name = os.path.basename(patch)
+        try:
+            reference, speed = render_reference(patch, args.path)
+        except Exception as e:
+            print('%-24s %-12s failed: %s' % (name, 'reference', e))
+            failures.append((patch, 'reference'))
+            continue
+        print('%-24s %-12s %10s %10s %9s %12.0f' % (name, 'reference', '', '', '', speed))
+        references = {None: reference.reshape(-1)}
+        work_dir = tempfile.mkdtemp()
+        try:
+            for backend in selected:
+                saturates, trig, max_error_limit, min_snr_limit = backends[backend][2:]
+                if trig not in references:
+                    try:
+                        references[trig] = render_reference(patch, args.path, trig)[0].reshape(-1)
+                    except Exception as e:
+                        print('%-24s %-12s failed: reference: %s' % (name, backend, e))
+                        failures.append((patch, backend))
+                        continue
+                reference = references[trig]
+                try:
+                    output, speed = run_backend(patch, backend, args, work_dir)
+                except subprocess.CalledProcessError as e:
+                    lines = e.output.decode('utf-8', 'replace').strip().splitlines() or ['exit status %d' % e.returncode]
+                    # pd_compile.py exits with 2 for options it refuses.
+                    if 'pd_compile.py' in ' '.join(e.cmd) and e.returncode in (2, UNSUPPORTED_STATUS):
+                        print('%-24s %-12s unsupported: %s' % (name, backend, lines[-1]))
+                    else:
+                        print('%-24s %-12s failed: %s' % (name, backend, lines[-1]))
+                        failures.append((patch, backend))
+                    continue
+                if output.shape != reference.shape:
+                    print('%-24s %-12s failed: %d samples, expected %d' % (name, backend, output.size, reference.size))
+                    failures.append((patch, backend))
+                    continue
+                expected = numpy.clip(reference, -1.0, 1.0) if saturates else reference
+                max_error, rms_error, snr = compare(expected, output)
+                if args.max_error is not None:
+                    max_error_limit = args.max_error
+                if args.min_snr is not None:
+                    min_snr_limit = args.min_snr
+                exceeded = (check(max_error, max_error_limit, lambda value, limit: value > limit) or
+                            check(rms_error, args.max_rms, lambda value, limit: value > limit) or
+                            check(snr, min_snr_limit, lambda value, limit: value < limit))
+                print('%-24s %-12s %10.3g %10.3g %9.1f %12.0f%s' % (name, backend, max_error, rms_error, snr, speed,
+                                                                   '  FAIL' if exceeded else ''))
+                if exceeded:
+                    failures.append((patch, backend))
+        finally:
+            shutil.rmtree(work_dir)
+
+    for patch, backend in failures:
+        print('failed %s (%s)' % (patch, backend))
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+# On-disk cache of compiled patches.
+#
+# Copyright (C) 2013 Jared Boone, ShareBrained Technology, Inc.
+#
+# This file is part of PD compiler.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# An entry holds the files generated for a patch and the messages printed
+# while compiling it. Entries are named by a hash of everything that the
+# output depends on: the bytes of the patch and of the abstractions it
+# uses, the compiler's own source, and the code generation options. An
+# entry's modification time is its last use; when the cache grows past
+# its size limit, the least recently used entries are deleted.
+
+import hashlib
+import json
+import os
+import sys
+import tempfile
+
+# The compiler's source files. Changing any of them changes every key.
+compiler_modules = ('pd_compile.py', 'pdom.py', 'optimize.py', 'emit_c.py', 'dispatch.py', 'compile_cache.py')
+
+def default_directory():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'pd_compile')
+
+_compiler_version = None
+
+def compiler_version():
+    """Hash of the compiler's source files and the Python version."""
+    global _compiler_version
+    if _compiler_version is None:
+        digest = hashlib.sha256()
+        digest.update(repr(sys.version_info[:2]).encode('utf-8'))
+        compiler_dir = os.path.dirname(os.path.abspath(__file__))
+        for name in compiler_modules:
+            digest.update(name.encode('utf-8'))
+            digest.update(open(os.path.join(compiler_dir, name), 'rb').read())
+        _compiler_version = digest.hexdigest()
+    return _compiler_version
+
+class CompileCache(object):
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def key(self, patch_bytes, dependency_bytes, options):
+        """options is a dict of the code generation options, and
+        dependency_bytes a list of the contents of the abstractions that
+        the patch uses."""
+        digest = hashlib.sha256()
+        digest.update(compiler_version().encode('utf-8'))
+        digest.update(json.dumps(sorted(options.items())).encode('utf-8'))
+        for data in [patch_bytes] + list(dependency_bytes):
+            # Length-prefixed, so that the boundaries between files count.
+            digest.update(('%d:' % len(data)).encode('utf-8'))
+            digest.update(data)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key):
+        """Returns (files, messages) for the key, or None. files maps an
+        output file suffix, such as '.c', to its contents."""
+        path = self._path(key)
+        try:
+            with open(path, 'r') as entry_file:
+                entry = json.load(entry_file)
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return entry['files'], entry['messages']
+
+    def put(self, key, files, messages):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # Write and rename, so that a parallel compile never reads half an
+        # entry.
+        handle, temporary_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        entry_file = os.fdopen(handle, 'w')
+        json.dump({'files': files, 'messages': messages}, entry_file)
+        entry_file.close()
+        os.rename(temporary_path, self._path(key))
+        self.evict()
+
+    def evict(self):
+        """Deletes the least recently used entries until the cache fits in
+        max_bytes."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                status = os.stat(path)
+            except OSError:
+                continue
+            entries.append((status.st_mtime, status.st_size, path))
+        total = sum((size for mtime, size, path in entries))
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # Another process got there first.
+                pass
+            total -= size
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+# Generic functions dispatched on the class of their first argument.
+#
+# Copyright (C) 2013 Jared Boone, ShareBrained Technology, Inc.
+#
+# This file is part of PD compiler.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# A generic function starts out as its default implementation. when()
+# registers the implementation for a class, which also covers subclasses
+# that don't have their own. The implementation for each class is looked
+# up along its MRO the first time an object of that class is seen, and
+# cached, so later calls cost a dictionary lookup.
+
+def generic(default):
+    registry = {}
+    resolved = {}
+
+    def dispatch(o, *args):
+        cls = type(o)
+        try:
+            implementation = resolved[cls]
+        except KeyError:
+            implementation = default
+            for base in cls.__mro__:
+                if base in registry:
+                    implementation = registry[base]
+                    break
+            resolved[cls] = implementation
+        return implementation(o, *args)
+
+    dispatch.__name__ = default.__name__
+    dispatch.__doc__ = default.__doc__
+    dispatch.registry = registry
+    dispatch.resolved = resolved
+    return dispatch
+
+def when(generic_function, cls):
+    def register(implementation):
+        if cls in generic_function.registry:
+            raise Exception('%s already has an implementation for %s' % (generic_function.__name__, cls.__name__))
+        generic_function.registry[cls] = implementation
+        generic_function.resolved.clear()
+        return implementation
+    return register
@@ -0,0 +1,153 @@
+/*
+ * Runs the partitions of code generated with --partitions on the two cores
+ * of a dual-core microcontroller.
+ *
+ * Copyright (C) 2013 Jared Boone, ShareBrained Technology, Inc.
+ *
+ * This file is part of PD compiler.
+ *
+ * This program is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU General Public License
+ * as published by the Free Software Foundation; either version 2
+ * of the License, or (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+ * 02110-1301, USA.
+ */
+
+/* For two cores sharing memory, without an operating system. Core 0 calls
+ * dsp_dualcore_init() once after init(), then dsp_dualcore_dsptick() in
+ * place of dsptick(), from its audio interrupt or main loop. Core 1 calls
+ * dsp_dualcore_core1(), which never returns. Partitions 0, 2, ... run on
+ * core 0 and partitions 1, 3, ... on core 1, so compile with
+ * "--partitions 2" to give each core one. The cores hand blocks over with
+ * two shared counters: core 0 releases a block, and waits for core 1 to
+ * finish it, once per block. The counters and core 1's output block must
+ * be in memory that both cores see, and not cached, or cleaned and
+ * invalidated around the hand-over.
+ *
+ * Waiting is a busy loop. Define DSP_DUALCORE_WAIT() and
+ * DSP_DUALCORE_SIGNAL() to sleep instead, for example as __WFE() and
+ * __SEV() on Cortex-M. Core 1's output goes to static blocks of
+ * DSP_DUALCORE_MAX_SAMPLES samples, which must hold BLOCK_SIZE frames of
+ * dsp_output_channels channels. Compile with the same PATCH_ defines as
+ * main.c. */
+
+#include <stdint.h>
+
+#ifndef DSP_DUALCORE_WAIT
+#define DSP_DUALCORE_WAIT()
+#endif
+#ifndef DSP_DUALCORE_SIGNAL
+#define DSP_DUALCORE_SIGNAL()
+#endif
+#ifndef DSP_DUALCORE_MAX_SAMPLES
+#define DSP_DUALCORE_MAX_SAMPLES (64 * 2)
+#endif
+
+/* Orders the memory accesses either side of it, for the other core. On ARM
+ * this is a DMB. */
+#define DSP_DUALCORE_BARRIER() __sync_synchronize()
+
+extern const int dsp_block_size;
+extern const int dsp_output_channels;
+extern const int dsp_partition_count;
+
+/* As in main.c. */
+#if defined(PATCH_Q15)
+typedef int16_t sample_t;
+#elif defined(PATCH_Q31)
+typedef int32_t sample_t;
+#else
+typedef float sample_t;
+#endif
+
+#ifdef PATCH_STATE_STRUCT
+typedef struct patch_state patch_state_t;
+extern void dsptick_partition(patch_state_t *state, int k, sample_t *out, int n);
+static patch_state_t * volatile dsp_dualcore_state = 0;
+#define PARTITION_DSPTICK(k, out, n) dsptick_partition(dsp_dualcore_state, k, out, n)
+#else
+extern void dsptick_partition(int k, sample_t *out, int n);
+#define PARTITION_DSPTICK(k, out, n) dsptick_partition(k, out, n)
+#endif
+extern void dsptick_mix(sample_t *out, const sample_t *partial, int n);
+
+static volatile uint32_t dsp_dualcore_released = 0;
+static volatile uint32_t dsp_dualcore_finished = 0;
+static volatile int dsp_dualcore_n = 0;
+
+static sample_t dsp_dualcore_core0_scratch[DSP_DUALCORE_MAX_SAMPLES];
+static sample_t dsp_dualcore_core1_out[DSP_DUALCORE_MAX_SAMPLES];
+static sample_t dsp_dualcore_core1_scratch[DSP_DUALCORE_MAX_SAMPLES];
+
+/* Runs partitions first, first + 2, ..., summing their output into out. */
+static void dsp_dualcore_run(int first, sample_t *out, sample_t *scratch, int n) {
+    int k = 0;
+    for(k=first; k<dsp_partition_count; k+=2) {
+        if(k == first) {
+            PARTITION_DSPTICK(k, out, n);
+        } else {
+            PARTITION_DSPTICK(k, scratch, n);
+            dsptick_mix(out, scratch, n);
+        }
+    }
+}
+
+/* Returns 0, or -1 if DSP_DUALCORE_MAX_SAMPLES is too small. */
+int dsp_dualcore_init(void) {
+    if(dsp_block_size * dsp_output_channels > DSP_DUALCORE_MAX_SAMPLES) {
+        return -1;
+    }
+    dsp_dualcore_released = 0;
+    dsp_dualcore_finished = 0;
+    return 0;
+}
+
+#ifdef PATCH_STATE_STRUCT
+void dsp_dualcore_dsptick(patch_state_t *state, sample_t *out, int n) {
+#else
+void dsp_dualcore_dsptick(sample_t *out, int n) {
+#endif
+    const uint32_t block = dsp_dualcore_released + 1;
+
+    dsp_dualcore_n = n;
+#ifdef PATCH_STATE_STRUCT
+    dsp_dualcore_state = state;
+#endif
+    DSP_DUALCORE_BARRIER();
+    dsp_dualcore_released = block;
+    DSP_DUALCORE_SIGNAL();
+
+    dsp_dualcore_run(0, out, dsp_dualcore_core0_scratch, n);
+
+    while(dsp_dualcore_finished != block) {
+        DSP_DUALCORE_WAIT();
+    }
+    DSP_DUALCORE_BARRIER();
+    if(dsp_partition_count > 1) {
+        dsptick_mix(out, dsp_dualcore_core1_out, n);
+    }
+}
+
+void dsp_dualcore_core1(void) {
+    uint32_t seen = dsp_dualcore_finished;
+    for(;;) {
+        while(dsp_dualcore_released == seen) {
+            DSP_DUALCORE_WAIT();
+        }
+        seen = dsp_dualcore_released;
+        DSP_DUALCORE_BARRIER();
+        dsp_dualcore_run(1, dsp_dualcore_core1_out, dsp_dualcore_core1_scratch, dsp_dualcore_n);
+        DSP_DUALCORE_BARRIER();
+        dsp_dualcore_finished = seen;
+        DSP_DUALCORE_SIGNAL();
+    }
+}
@@ -0,0 +1,191 @@
+/*
+ * Runs the partitions of code generated with --partitions on threads.
+ *
+ * Copyright (C) 2013 Jared Boone, ShareBrained Technology, Inc.
+ *
+ * This file is part of PD compiler.
+ *
+ * This program is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU General Public License
+ * as published by the Free Software Foundation; either version 2
+ * of the License, or (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+ * 02110-1301, USA.
+ */
+
+/* dsp_threads_start() starts a thread for each partition after the first.
+ * dsp_threads_dsptick() then does what dsptick() does: it releases the
+ * threads, runs partition 0 itself, waits at a barrier until the threads
+ * have run theirs, and adds their output blocks into out. The barrier is
+ * the only wait per block. Call dsp_threads_start() after init(), and
+ * dsp_threads_stop() before deinit(). Build with -pthread and the same
+ * PATCH_ defines as main.c. */
+
+#include <pthread.h>
+#include <stdlib.h>
+#include <stdint.h>
+
+extern const int dsp_block_size;
+extern const int dsp_output_channels;
+extern const int dsp_partition_count;
+
+/* As in main.c. */
+#if defined(PATCH_Q15)
+typedef int16_t sample_t;
+#elif defined(PATCH_Q31)
+typedef int32_t sample_t;
+#else
+typedef float sample_t;
+#endif
+
+#ifdef PATCH_STATE_STRUCT
+typedef struct patch_state patch_state_t;
+extern void dsptick_partition(patch_state_t *state, int k, sample_t *out, int n);
+#define PARTITION_DSPTICK(k, out, n) dsptick_partition(dsp_threads.state, k, out, n)
+#else
+extern void dsptick_partition(int k, sample_t *out, int n);
+#define PARTITION_DSPTICK(k, out, n) dsptick_partition(k, out, n)
+#endif
+extern void dsptick_mix(sample_t *out, const sample_t *partial, int n);
+
+struct dsp_worker {
+    pthread_t thread;
+    int k;
+    sample_t *out;
+};
+
+static struct {
+    pthread_mutex_t lock;
+    pthread_cond_t release;
+    pthread_barrier_t done;
+    /* Blocks released so far, and what the threads need for the block.
+     * All guarded by lock. */
+    unsigned long block;
+    int n;
+#ifdef PATCH_STATE_STRUCT
+    patch_state_t *state;
+#endif
+    int stopping;
+    struct dsp_worker *workers;
+    int worker_count;
+} dsp_threads;
+
+static void *dsp_worker_main(void *arg) {
+    struct dsp_worker *worker = arg;
+    unsigned long seen = 0;
+    int n = 0;
+    int stopping = 0;
+    for(;;) {
+        pthread_mutex_lock(&dsp_threads.lock);
+        while(dsp_threads.block == seen && !dsp_threads.stopping) {
+            pthread_cond_wait(&dsp_threads.release, &dsp_threads.lock);
+        }
+        seen = dsp_threads.block;
+        n = dsp_threads.n;
+        stopping = dsp_threads.stopping;
+        pthread_mutex_unlock(&dsp_threads.lock);
+        if(stopping) {
+            return NULL;
+        }
+        PARTITION_DSPTICK(worker->k, worker->out, n);
+        pthread_barrier_wait(&dsp_threads.done);
+    }
+}
+
+/* Returns 0, or -1 if the threads couldn't be started. */
+int dsp_threads_start(void) {
+    const size_t samples = (size_t)dsp_block_size * dsp_output_channels;
+    int k = 0;
+
+    dsp_threads.block = 0;
+    dsp_threads.stopping = 0;
+    dsp_threads.worker_count = 0;
+    dsp_threads.workers = calloc(dsp_partition_count, sizeof(struct dsp_worker));
+    if(dsp_threads.workers == NULL) {
+        return -1;
+    }
+    pthread_mutex_init(&dsp_threads.lock, NULL);
+    pthread_cond_init(&dsp_threads.release, NULL);
+    pthread_barrier_init(&dsp_threads.done, NULL, dsp_partition_count);
+
+    for(k=1; k<dsp_partition_count; k++) {
+        struct dsp_worker *worker = &dsp_threads.workers[k - 1];
+        worker->k = k;
+        worker->out = samples ? malloc(samples * sizeof(sample_t)) : NULL;
+        if((samples && worker->out == NULL) ||
+           pthread_create(&worker->thread, NULL, dsp_worker_main, worker) != 0) {
+            free(worker->out);
+            /* The barrier needs every thread; stop the ones started. */
+            pthread_mutex_lock(&dsp_threads.lock);
+            dsp_threads.stopping = 1;
+            pthread_cond_broadcast(&dsp_threads.release);
+            pthread_mutex_unlock(&dsp_threads.lock);
+            for(k=0; k<dsp_threads.worker_count; k++) {
+                pthread_join(dsp_threads.workers[k].thread, NULL);
+                free(dsp_threads.workers[k].out);
+            }
+            free(dsp_threads.workers);
+            dsp_threads.workers = NULL;
+            dsp_threads.worker_count = 0;
+            pthread_barrier_destroy(&dsp_threads.done);
+            pthread_cond_destroy(&dsp_threads.release);
+            pthread_mutex_destroy(&dsp_threads.lock);
+            return -1;
+        }
+        dsp_threads.worker_count++;
+    }
+    return 0;
+}
+
+#ifdef PATCH_STATE_STRUCT
+void dsp_threads_dsptick(patch_state_t *state, sample_t *out, int n) {
+#else
+void dsp_threads_dsptick(sample_t *out, int n) {
+#endif
+    int k = 0;
+
+    pthread_mutex_lock(&dsp_threads.lock);
+    dsp_threads.n = n;
+#ifdef PATCH_STATE_STRUCT
+    dsp_threads.state = state;
+#endif
+    dsp_threads.block++;
+    pthread_cond_broadcast(&dsp_threads.release);
+    pthread_mutex_unlock(&dsp_threads.lock);
+
+    PARTITION_DSPTICK(0, out, n);
+    pthread_barrier_wait(&dsp_threads.done);
+
+    if(dsp_output_channels > 0) {
+        for(k=0; k<dsp_threads.worker_count; k++) {
+            dsptick_mix(out, dsp_threads.workers[k].out, n);
+        }
+    }
+}
+
+void dsp_threads_stop(void) {
+    int k = 0;
+
+    pthread_mutex_lock(&dsp_threads.lock);
+    dsp_threads.stopping = 1;
+    pthread_cond_broadcast(&dsp_threads.release);
+    pthread_mutex_unlock(&dsp_threads.lock);
+    for(k=0; k<dsp_threads.worker_count; k++) {
+        pthread_join(dsp_threads.workers[k].thread, NULL);
+        free(dsp_threads.workers[k].out);
+    }
+    free(dsp_threads.workers);
+    dsp_threads.workers = NULL;
+    dsp_threads.worker_count = 0;
+    pthread_barrier_destroy(&dsp_threads.done);
+    pthread_cond_destroy(&dsp_threads.release);
+    pthread_mutex_destroy(&dsp_threads.lock);
+}
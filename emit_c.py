@@ -21,209 +21,2077 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
 # 02110-1301, USA.
 
+import math
+
 from pdom import *
-from peak.rules import when
+from dispatch import generic, when
+
+import optimize
+
+SAMPLING_RATE = 44100.0
+
+class Unsupported(Exception):
+    """The patch can't be compiled with the options given, though it may
+    compile with others."""
+    pass
+
+class Options(object):
+    """Code generation choices, set by the compiler front-end before any
+    code is emitted.
+
+    trig selects how osc~ and cos~ compute cosine: 'libm' calls cosf(),
+    'table' interpolates a table of cos_table_size points (a power of two)
+    and 'poly' evaluates a minimax polynomial of degree poly_degree.
+
+    dac selects the dac~ backend, one of dac_backends.
+
+    state selects where object state lives: 'static' file-level variables,
+    or 'struct', a patch_state_t passed to init(), dsptick() and deinit()
+    so that a patch can run as several independent instances.
+
+    dedup_tables makes arrays with the same contents share one table.
+
+    profile adds a cycle counter read after each group of objects in
+    dsptick(), with totals in a static table that profile_dump() prints.
+
+    numeric selects the sample format, one of numeric_formats. With the
+    fixed-point formats, osc~ always uses a cosine table and trig is
+    ignored.
+
+    simd selects how runs of elementwise objects (see fuse()) are emitted:
+    'none' as one scalar loop, 'gcc' as one loop over GCC vector extension
+    types, and 'cmsis' as CMSIS-DSP kernel calls for lone objects and one
+    scalar loop for longer runs.
+
+    event_queue_size is the number of pending events, from metro and vline~,
+    that the event queue holds. An event that doesn't fit is dropped.
+    """
+    def __init__(self, trig='libm', cos_table_size=2048, poly_degree=7, dac='file', state='static',
+                 numeric='float', simd='none', dedup_tables=False, profile=False, event_queue_size=64):
+        self.trig = trig
+        self.cos_table_size = cos_table_size
+        self.poly_degree = poly_degree
+        self.dac = dac
+        self.state = state
+        self.numeric = numeric
+        self.simd = simd
+        self.dedup_tables = dedup_tables
+        self.profile = profile
+        self.event_queue_size = event_queue_size
+
+options = Options()
 
 # TODO: Maybe instead of passing back language-specific strings, pass back statements...
 # initialize variable, assignments, ???
 
+# state returns (C type, name, initial value) for each variable that
+# persists from one dsptick() to the next. They are file-level statics, or
+# members of patch_state_t with options.state == 'struct'. declare is for
+# everything else at file level, such as constants.
+
+@generic
+def state(o):
+    return tuple()
+
+@generic
 def declare(o):
     return tuple()
 
+@generic
 def init(o):
     return tuple()
 
+# dsptick_start and dsptick_end run once per block, before and after the
+# object's sample loop. dsptick is the loop body, run once per sample with
+# the sample index in "i".
+
+@generic
 def dsptick_start(o):
     return tuple()
 
+@generic
 def dsptick(o):
     return tuple()
 
+@generic
 def dsptick_end(o):
     return tuple()
 
+@generic
 def deinit(o):
     return tuple()
 
+# support returns the names of shared helper code that the object's C code
+# uses. Each helper is emitted once, by support_declare().
+
+@generic
+def support(o):
+    return tuple()
+
+# receive is the body of the function that messages to one of the object's
+# inlets go to, with the message in "m". fire is the code run for one of
+# the object's events from the event queue, with the event in "e".
+# control_declare is for the helper functions that these call. See
+# control_define().
+
+@generic
+def receive(o, inlet):
+    return tuple()
+
+@generic
+def fire(o):
+    return tuple()
+
+@generic
+def control_declare(o):
+    return tuple()
+
 #######################################
 def obj_prop(obj, name):
     return 'object_%s_%s' % (obj.id, name)
 
-def outlet_str(outlet):
+def state_prop(obj, name):
+    if options.state == 'struct':
+        return 'state->%s' % obj_prop(obj, name)
+    return obj_prop(obj, name)
+
+def outlet_buffer_str(outlet):
+    if outlet in outlet_buffers:
+        return outlet_buffers[outlet]
     return obj_prop(outlet.parent, 'outlet_%d' % outlet.id)
-    
+
+def outlet_str(outlet):
+    if outlet in register_outlets or outlet in block_outlets:
+        return outlet_buffer_str(outlet)
+    return '%s[i]' % outlet_buffer_str(outlet)
+
+def buffer_declare(groups=None):
+    attribute = ' __attribute__((aligned(16)))' if options.simd == 'gcc' else ''
+    return tuple(('%s %s[BLOCK_SIZE]%s;' % (numeric_format().sample_type, name, attribute)
+                  for name in buffer_names(groups)))
+
+def float_str(value):
+    # Nine significant digits round-trip a C float exactly.
+    s = '%.9g' % value
+    if '.' not in s and 'e' not in s:
+        s += '.0'
+    return s + 'f'
+
 def source_str(inlet):
     source = inlet.source
     if isinstance(source, Outlet):
         return outlet_str(source)
     elif isinstance(source, ConstantOutlet):
-        return '%ff' % source.value
+        return float_str(source.value)
     else:
         raise Exception('Unknown source %s' % source)
 
 #######################################
+# Numeric formats. Signals are float, or fixed point with saturating
+# arithmetic: a sample x with f fraction bits stands for x / 2**f. Each
+# outlet gets as many fraction bits as the range of its values allows (see
+# optimize.signal_ranges()). Intermediate results are computed in a type
+# twice as wide as the sample, then saturated.
+
+class FloatFormat(object):
+    fixed = False
+    sample_type = 'float'
+
+class FixedFormat(object):
+    fixed = True
+
+    def __init__(self, bits):
+        self.bits = bits
+        self.sample_type = 'int%d_t' % bits
+        self.wide_type = 'int%d_t' % (bits * 2)
+        self.saturate = 'pd_sat_q%d' % (bits - 1)
+        self.from_float = 'pd_float_to_q%d' % (bits - 1)
+        self.cos = 'pd_cos_q%d' % (bits - 1)
+        self.literal_suffix = 'LL' if bits > 16 else ''
+
+    def fraction_bits(self, magnitude):
+        """Fraction bits for values of up to the given magnitude. Values of
+        magnitude 1 get all bits but the sign; 1.0 itself saturates."""
+        integer_bits = 0
+        if magnitude > 1.0:
+            integer_bits = int(math.ceil(math.log(magnitude, 2)))
+        return self.bits - 1 - integer_bits
+
+    def literal(self, value, fraction_bits):
+        return '%d%s' % (int(round(value * 2.0 ** fraction_bits)), self.literal_suffix)
+
+numeric_formats = {
+    'float': FloatFormat(),
+    'q15': FixedFormat(16),
+    'q31': FixedFormat(32),
+}
+
+def numeric_format():
+    return numeric_formats[options.numeric]
+
+outlet_fraction_bits = {}
+
+def prepare(chain):
+    """Work out the tables and the fixed-point scaling of every outlet in
+    the chain. Must be called before emitting code for the chain."""
+    prepare_tables(chain)
+    outlet_fraction_bits.clear()
+    fmt = numeric_format()
+    if not fmt.fixed:
+        return
+    for outlet, value_range in optimize.signal_ranges(chain).items():
+        o = outlet.parent
+        if value_range is None:
+            raise Unsupported('object %d (%s): range of output values is unbounded, '
+                            'clip~ its inputs for fixed-point code' % (o.id, object_name(o)))
+        fraction_bits = fmt.fraction_bits(max(abs(value_range[0]), abs(value_range[1])))
+        if fraction_bits < 0:
+            raise Unsupported('object %d (%s): range of output values %g to %g is too large for %s' % (
+                            o.id, object_name(o), value_range[0], value_range[1], options.numeric))
+        outlet_fraction_bits[outlet] = fraction_bits
+
+def fixed_operand(inlet):
+    """An inlet's value as (wide C expression, fraction bits), at the
+    inlet source's own scaling."""
+    fmt = numeric_format()
+    source = inlet.source
+    if isinstance(source, Outlet):
+        return '(%s)%s' % (fmt.wide_type, outlet_str(source)), outlet_fraction_bits[source]
+    elif isinstance(source, ConstantOutlet):
+        fraction_bits = fmt.fraction_bits(abs(source.value))
+        if source.value != 0.0 and abs(source.value) < 1.0:
+            # Small constants get extra precision, up to the sample width.
+            fraction_bits -= int(math.floor(math.log(abs(source.value), 2))) + 1
+        return fmt.literal(source.value, fraction_bits), fraction_bits
+    else:
+        return '0', fmt.bits - 1
+
+def fixed_rescale(operand, fraction_bits):
+    expr, operand_fraction_bits = operand
+    shift = fraction_bits - operand_fraction_bits
+    if expr == '0' or shift == 0:
+        return expr
+    elif shift > 0:
+        # Multiply rather than shift, as left-shifting a negative value is
+        # undefined in C.
+        return '(%s * %d%s)' % (expr, 1 << shift, numeric_format().literal_suffix)
+    else:
+        return '(%s >> %d)' % (expr, -shift)
+
+def fixed_value(inlet, fraction_bits):
+    """An inlet's value as a wide C expression with the given scaling."""
+    if isinstance(inlet.source, ConstantOutlet):
+        return numeric_format().literal(inlet.source.value, fraction_bits)
+    return fixed_rescale(fixed_operand(inlet), fraction_bits)
+
+def fixed_to_float(inlet):
+    source = inlet.source
+    if isinstance(source, ConstantOutlet):
+        return float_str(source.value)
+    elif source is None:
+        return '0.0f'
+    expr, fraction_bits = fixed_operand(inlet)
+    return '((float)%s * %s)' % (expr, float_str(2.0 ** -fraction_bits))
+
+def fixed_store(outlet, expr):
+    return '%s = %s(%s);' % (outlet_str(outlet), numeric_format().saturate, expr)
+
+def fixed_store_float(outlet, float_expr):
+    fraction_bits = outlet_fraction_bits[outlet]
+    return '%s = %s((%s) * %s);' % (outlet_str(outlet), numeric_format().from_float,
+                                    float_expr, float_str(2.0 ** fraction_bits))
+
+#######################################
+# dac~ output goes through a backend, selected by options.dac. The 'file'
+# backend writes each dac~ to its own dac_<id>.f32 file and ignores the
+# output buffer passed to dsptick(). The 'interleaved' and 'planar'
+# backends sum the dac~ objects into the caller's output buffer, like Pd
+# does. Channel c (counting from 0) of frame i goes to out[i * channels + c]
+# or out[c * stride + i], where stride is n unless dsptick() runs the
+# block in parts (see event_dsptick()).
+
+def dac_source_str(inlet):
+    if numeric_format().fixed:
+        return fixed_to_float(inlet)
+    return source_str(inlet) if inlet.source else '0.0f'
+
+def dac_output_str(inlets):
+    fmt = numeric_format()
+    if fmt.fixed:
+        terms = [fixed_value(inlet, fmt.bits - 1) for inlet in inlets]
+        return '%s(%s)' % (fmt.saturate, ' + '.join(terms)) if terms else '0'
+    return ' + '.join((source_str(inlet) for inlet in inlets)) or '0.0f'
+
+class FileDACBackend(object):
+    planar = False
+
+    def output_channels(self, dacs):
+        return 0
+
+    def state(self, o):
+        return (('FILE*', 'file', 'NULL'),
+                )
+
+    def declare(self, o):
+        return tuple()
+
+    def init(self, o):
+        return ('%s = fopen("dac_%d.f32", "wb");' % (state_prop(o, 'file'), o.id),
+                )
+
+    def dsptick_start(self, o):
+        return ('float %s[BLOCK_SIZE * %d];' % (obj_prop(o, 'buffer'), len(o.inlet)),
+                )
+
+    def dsptick(self, o):
+        return tuple(('%s[i * %d + %d] = %s;' % (obj_prop(o, 'buffer'), len(o.inlet), c, dac_source_str(inlet))
+                      for c, inlet in enumerate(o.inlet)))
+
+    def dsptick_end(self, o):
+        return ('fwrite(%s, sizeof(float) * %d, n, %s);' % (obj_prop(o, 'buffer'), len(o.inlet), state_prop(o, 'file')),
+                )
+
+    def deinit(self, o):
+        return ('fclose(%s);' % (state_prop(o, 'file'),),
+                '%s = NULL;' % (state_prop(o, 'file'),),
+                )
+
+    def output_dsptick(self, dacs, channels=None, stride='n'):
+        return tuple()
+
+class BufferDACBackend(object):
+    def __init__(self, planar):
+        self.planar = planar
+
+    def output_channels(self, dacs):
+        return max([max(o.channels) for o in dacs] or [2])
+
+    def state(self, o):
+        return tuple()
+
+    def declare(self, o):
+        return tuple()
+
+    def init(self, o):
+        return tuple()
+
+    def dsptick_start(self, o):
+        return tuple()
+
+    def dsptick(self, o):
+        return tuple()
+
+    def dsptick_end(self, o):
+        return tuple()
+
+    def deinit(self, o):
+        return tuple()
+
+    def output_dsptick(self, dacs, channels=None, stride='n'):
+        """Fills channels channels of out, by default as many as the dacs
+        use, from the dacs. Planar channels are stride samples apart."""
+        channels = channels or self.output_channels(dacs)
+        inlets = [[] for c in range(channels)]
+        for o in dacs:
+            for channel, inlet in zip(o.channels, o.inlet):
+                if inlet.source:
+                    inlets[channel - 1].append(inlet)
+        result = []
+        for c in range(channels):
+            if self.planar:
+                index = '%d * %s + i' % (c, stride)
+            else:
+                index = 'i * %d + %d' % (channels, c)
+            result.append('out[%s] = %s;' % (index, dac_output_str(inlets[c])))
+        return tuple(result)
+
+def mix_dsptick():
+    """Adds partial[i] to out[i], for summing the output blocks of
+    partitions that run separately."""
+    fmt = numeric_format()
+    if fmt.fixed:
+        return ('out[i] = %s((%s)out[i] + partial[i]);' % (fmt.saturate, fmt.wide_type),
+                )
+    return ('out[i] = out[i] + partial[i];',
+            )
+
+dac_backends = {
+    'file': FileDACBackend(),
+    'interleaved': BufferDACBackend(planar=False),
+    'planar': BufferDACBackend(planar=True),
+}
+
+def dac_backend():
+    return dac_backends[options.dac]
+
+@when(state, AudioDAC)
+def audio_dac_state(o):
+    return dac_backend().state(o)
+
 @when(declare, AudioDAC)
 def audio_dac_declare(o):
-    return ('static FILE* %s = NULL;' % (obj_prop(o, 'file'),),
-            )
-    
+    return dac_backend().declare(o)
+
 @when(init, AudioDAC)
 def audio_dac_init(o):
-    return ('%s = fopen("dac_%d.f32", "wb");' % (obj_prop(o, 'file'), o.id),
-            )
+    return dac_backend().init(o)
+
+@when(dsptick_start, AudioDAC)
+def audio_dac_dsptick_start(o):
+    return dac_backend().dsptick_start(o)
 
 @when(dsptick, AudioDAC)
 def audio_dac_dsptick(o):
-    left = source_str(o._left) if o._left.source else '0.0f'
-    right = source_str(o._right) if o._right.source else '0.0f'
-    return ('const float %s[2] = { %s, %s };' % (obj_prop(o, 'buffer'), left, right),
-            'fwrite(%s, sizeof(%s), 1, %s);' % (obj_prop(o, 'buffer'), obj_prop(o, 'buffer'), obj_prop(o, 'file')),
-            )
+    return dac_backend().dsptick(o)
+
+@when(dsptick_end, AudioDAC)
+def audio_dac_dsptick_end(o):
+    return dac_backend().dsptick_end(o)
 
 @when(deinit, AudioDAC)
 def audio_dac_deinit(o):
-    return ('fclose(%s);' % (obj_prop(o, 'file'),),
-            '%s = NULL;' % (obj_prop(o, 'file'),),
-            )
+    return dac_backend().deinit(o)
 
 #######################################
-@when(declare, 'isinstance(o, AudioOscillator)')
-def osc_declare(o):
-    return ('static float %s = 0.0f;' % (obj_prop(o, 'phase'),),
+# When the frequency is constant, the phase increment is computed by the
+# compiler instead of once per sample. With the 'table' and 'poly' cosine
+# modes, the phase is kept in cycles (0 to 1) instead of radians, and
+# wrapped without calling fmodf().
+
+# In fixed point, the phase is an unsigned 32-bit count of 1/2**32 cycles,
+# which wraps by itself.
+
+@when(support, AudioOscillator)
+def osc_support(o):
+    if numeric_format().fixed:
+        return ('cos_fixed',)
+    if options.trig == 'libm':
+        return tuple()
+    return ('wrap_phase', 'cos')
+
+@when(state, AudioOscillator)
+def osc_state(o):
+    if numeric_format().fixed:
+        return (('uint32_t', 'phase', '0u'),
+                )
+    return (('float', 'phase', '0.0f'),
             )
+
+@when(declare, AudioOscillator)
+def osc_declare(o):
+    if numeric_format().fixed:
+        return _fixed_phase_declare(o)
+    result = tuple()
+    if isinstance(o._in.source, ConstantOutlet):
+        if options.trig == 'libm':
+            increment = o._in.source.value * 2.0 * math.pi / SAMPLING_RATE
+        else:
+            increment = o._in.source.value / SAMPLING_RATE
+        result += ('static const float %s = %s;' % (obj_prop(o, 'phase_increment'), float_str(increment)),
+                   )
+    return result
     
-@when(init, 'isinstance(o, AudioOscillator)')
+@when(init, AudioOscillator)
 def osc_init(o):
-    return ('%s = 0.0f;' % (obj_prop(o, 'phase'),),
+    return ('%s = %s;' % (state_prop(o, 'phase'), state(o)[0][2]),
             )
 
-@when(dsptick, 'isinstance(o, AudioOscillator)')
+@when(dsptick, AudioOscillator)
 def osc_dsptick(o):
+    fmt = numeric_format()
+    if fmt.fixed:
+        return _fixed_phase_dsptick(o, ('(%s)%s(%s)' % (fmt.wide_type, fmt.cos, state_prop(o, 'phase')), fmt.bits - 1))
+    if options.trig != 'libm':
+        return _osc_cycles_dsptick(o, 'pd_cos(%s)' % state_prop(o, 'phase'))
     outlet = outlet_str(o._out)
-    result = ('const float %s = cosf(%s);' % (outlet, obj_prop(o, 'phase')),
-              'const float %s = %s * 2.0f * M_PI / SAMPLING_RATE;' % (obj_prop(o, 'phase_increment'), source_str(o._in)),
-              '%s = fmodf(%s + %s, 2.0f * M_PI);' % (obj_prop(o, 'phase'), obj_prop(o, 'phase'), obj_prop(o, 'phase_increment')),
+    result = ('%s = cosf(%s);' % (outlet, state_prop(o, 'phase')),
+              )
+    if not isinstance(o._in.source, ConstantOutlet):
+        result += ('const float %s = %s * 2.0f * M_PI / SAMPLING_RATE;' % (obj_prop(o, 'phase_increment'), source_str(o._in)),
+                   )
+    result += ('%s = fmodf(%s + %s, 2.0f * M_PI);' % (state_prop(o, 'phase'), state_prop(o, 'phase'), obj_prop(o, 'phase_increment')),
+               )
+    return result
+
+def _osc_cycles_dsptick(o, output_str):
+    outlet = outlet_str(o._out)
+    result = ('%s = %s;' % (outlet, output_str),
+              )
+    if not isinstance(o._in.source, ConstantOutlet):
+        result += ('const float %s = %s / SAMPLING_RATE;' % (obj_prop(o, 'phase_increment'), source_str(o._in)),
+                   )
+    result += ('%s = pd_wrap_phase(%s + %s);' % (state_prop(o, 'phase'), state_prop(o, 'phase'), obj_prop(o, 'phase_increment')),
+               )
+    return result
+
+def _fixed_phase_declare(o):
+    if isinstance(o._in.source, ConstantOutlet):
+        increment = int(round(o._in.source.value / SAMPLING_RATE * 2.0 ** 32)) % (1 << 32)
+        return ('static const uint32_t %s = %du;' % (obj_prop(o, 'phase_increment'), increment),
+                )
+    return tuple()
+
+def _fixed_phase_dsptick(o, output_operand):
+    result = (fixed_store(o._out, fixed_rescale(output_operand, outlet_fraction_bits[o._out])),
+              )
+    if not isinstance(o._in.source, ConstantOutlet):
+        # increment = frequency * 2**32 / SAMPLING_RATE, in 64 bits. The
+        # multiplier is 2**47 / SAMPLING_RATE whatever the frequency's
+        # scaling, so it keeps about 31 significant bits, and the product of
+        # it and a 32-bit sample fits in 63.
+        expr, fraction_bits = fixed_operand(o._in)
+        multiplier = int(round(2.0 ** 47 / SAMPLING_RATE))
+        result += ('const uint32_t %s = (uint32_t)(((int64_t)%s * %dLL) >> %d);' % (obj_prop(o, 'phase_increment'), expr, multiplier, fraction_bits + 15),
+                   )
+    result += ('%s += %s;' % (state_prop(o, 'phase'), obj_prop(o, 'phase_increment')),
                )
     return result
 
+# A float to the right inlet sets the phase, in cycles. Only its fraction
+# counts.
+
+def _phase_receive(o, scale_str=''):
+    cycles = 'm->argv[0] - floorf(m->argv[0])'
+    if numeric_format().fixed:
+        # Through 64 bits, so that a whole cycle wraps to 0.
+        value = '(uint32_t)(int64_t)((double)(%s) * 4294967296.0)' % cycles
+    else:
+        value = '(%s)%s' % (cycles, scale_str)
+    return ('if(m->argc > 0) {',
+            '\t%s = %s;' % (state_prop(o, 'phase'), value),
+            '}',
+            )
+
+@when(receive, AudioOscillator)
+def osc_receive(o, inlet):
+    if options.trig == 'libm' and not numeric_format().fixed:
+        return _phase_receive(o, ' * 2.0f * M_PI')
+    return _phase_receive(o)
+
 #######################################
-@when(declare, 'isinstance(o, AudioPhasor)')
-def phasor_declare(o):
-    return ('static float %s = 0.0f;' % (obj_prop(o, 'phase'),),
+@when(support, AudioPhasor)
+def phasor_support(o):
+    if numeric_format().fixed:
+        return tuple()
+    if options.trig == 'libm':
+        return tuple()
+    return ('wrap_phase',)
+
+@when(state, AudioPhasor)
+def phasor_state(o):
+    if numeric_format().fixed:
+        return (('uint32_t', 'phase', '0u'),
+                )
+    return (('float', 'phase', '0.0f'),
             )
 
-@when(init, 'isinstance(o, AudioPhasor)')
+@when(declare, AudioPhasor)
+def phasor_declare(o):
+    if numeric_format().fixed:
+        return _fixed_phase_declare(o)
+    result = tuple()
+    if isinstance(o._in.source, ConstantOutlet):
+        increment = o._in.source.value / SAMPLING_RATE
+        result += ('static const float %s = %s;' % (obj_prop(o, 'phase_increment'), float_str(increment)),
+                   )
+    return result
+
+@when(init, AudioPhasor)
 def phasor_init(o):
-    return ('%s = 0.0f;' % (obj_prop(o, 'phase'),),
+    return ('%s = %s;' % (state_prop(o, 'phase'), state(o)[0][2]),
             )
 
-@when(dsptick, 'isinstance(o, AudioPhasor)')
+@when(dsptick, AudioPhasor)
 def phasor_dsptick(o):
+    fmt = numeric_format()
+    if fmt.fixed:
+        # The top bits of the phase are the output, from 0 to 1.
+        return _fixed_phase_dsptick(o, ('(%s)(%s >> %d)' % (fmt.wide_type, state_prop(o, 'phase'), 33 - fmt.bits), fmt.bits - 1))
+    if options.trig != 'libm':
+        return _osc_cycles_dsptick(o, state_prop(o, 'phase'))
     outlet = outlet_str(o._out)
-    result = ('const float %s = %s;' % (outlet, obj_prop(o, 'phase')),
-              'const float %s = %s / SAMPLING_RATE;' % (obj_prop(o, 'phase_increment'), source_str(o._in)),
-              '%s = fmodf(%s + %s, 1.0f);' % (obj_prop(o, 'phase'), obj_prop(o, 'phase'), obj_prop(o, 'phase_increment')),
+    result = ('%s = %s;' % (outlet, state_prop(o, 'phase')),
+              )
+    if not isinstance(o._in.source, ConstantOutlet):
+        result += ('const float %s = %s / SAMPLING_RATE;' % (obj_prop(o, 'phase_increment'), source_str(o._in)),
+                   )
+    result += ('%s = fmodf(%s + %s, 1.0f);' % (state_prop(o, 'phase'), state_prop(o, 'phase'), obj_prop(o, 'phase_increment')),
                )
     return result
 
+@when(receive, AudioPhasor)
+def phasor_receive(o, inlet):
+    return _phase_receive(o)
+
 #######################################
+# Arrays read by tabread~ and tabosc4~ become static const tables, which
+# the linker can leave in flash. Tables stay float in fixed-point code.
+
+table_symbols = {}
+table_arrays = []
+
+def prepare_tables(chain):
+    """Give each array used in the chain a table, or with
+    options.dedup_tables, one table per distinct contents."""
+    table_symbols.clear()
+    del table_arrays[:]
+    symbol_by_contents = {}
+    for o in chain:
+        array = getattr(o, 'array', None)
+        if array is None or array in table_symbols:
+            continue
+        if isinstance(o, AudioTableOscillator):
+            points = len(array.values) - 3
+            if points < 1 or points & (points - 1):
+                raise Exception('object %d (%s): array %s has %d points, needs a power of two plus three' % (
+                                o.id, object_name(o), array.name, len(array.values)))
+        contents = array.values.tobytes()
+        if options.dedup_tables and contents in symbol_by_contents:
+            table_symbols[array] = symbol_by_contents[contents]
+            continue
+        symbol = 'pd_table_%d' % len(table_arrays)
+        table_symbols[array] = symbol
+        symbol_by_contents[contents] = symbol
+        table_arrays.append((symbol, array))
+
+def _table_declare():
+    lines = []
+    for symbol, array in table_arrays:
+        names = sorted((a.name for a, s in table_symbols.items() if s == symbol))
+        lines.append('/* %s, %d points */' % (', '.join(names), len(array.values)))
+        values = [float_str(value) for value in array.values] or ['0.0f']
+        lines.append('static const float %s[%d] = {' % (symbol, len(values)))
+        for k in range(0, len(values), 8):
+            lines.append('\t%s,' % ', '.join(values[k:k + 8]))
+        lines.append('};')
+        lines.append('')
+    return lines
+
+# tabread~ truncates its input to an index, and clips it to the table.
+
+@when(dsptick, AudioTableRead)
+def tabread_dsptick(o):
+    fmt = numeric_format()
+    size = len(o.array.values)
+    index = obj_prop(o, 'index')
+    if fmt.fixed:
+        index_str = fixed_rescale(fixed_operand(o._in), 0)
+    elif o._in.source is None:
+        index_str = '0'
+    else:
+        index_str = source_str(o._in)
+    value = '%s[(%s < 0) ? 0 : (%s > %d) ? %d : %s]' % (table_symbols[o.array], index, index, size - 1, size - 1, index)
+    if size == 0:
+        value = '0.0f'
+    result = ('const int %s = (int)%s;' % (index, index_str),
+              )
+    if fmt.fixed:
+        return result + (fixed_store_float(o._out, value),
+                         )
+    return result + ('%s = %s;' % (outlet_str(o._out), value),
+                     )
+
+# tabosc4~ reads a table of 2**k points plus three guard points, with the
+# same 4-point interpolation as Pd. Its phase is in cycles, or in 1/2**32
+# cycles in fixed point, like osc~.
+
+@when(support, AudioTableOscillator)
+def tabosc4_support(o):
+    if numeric_format().fixed:
+        return ('tabosc4',)
+    return ('wrap_phase', 'tabosc4')
+
+@when(state, AudioTableOscillator)
+def tabosc4_state(o):
+    if numeric_format().fixed:
+        return (('uint32_t', 'phase', '0u'),
+                )
+    return (('float', 'phase', '0.0f'),
+            )
+
+@when(declare, AudioTableOscillator)
+def tabosc4_declare(o):
+    if numeric_format().fixed:
+        return _fixed_phase_declare(o)
+    result = tuple()
+    if isinstance(o._in.source, ConstantOutlet):
+        increment = o._in.source.value / SAMPLING_RATE
+        result += ('static const float %s = %s;' % (obj_prop(o, 'phase_increment'), float_str(increment)),
+                   )
+    return result
+
+@when(init, AudioTableOscillator)
+def tabosc4_init(o):
+    return ('%s = %s;' % (state_prop(o, 'phase'), state(o)[0][2]),
+            )
+
+@when(dsptick, AudioTableOscillator)
+def tabosc4_dsptick(o):
+    fmt = numeric_format()
+    points = len(o.array.values) - 3
+    table = table_symbols[o.array]
+    phase = state_prop(o, 'phase')
+    if fmt.fixed:
+        fraction_bits = outlet_fraction_bits[o._out]
+        value = 'pd_tabosc4(%s, %d, (float)%s * %s)' % (table, points - 1, phase, float_str(points / 2.0 ** 32))
+        output_operand = ('(%s)%s(%s * %s)' % (fmt.wide_type, fmt.from_float, value, float_str(2.0 ** fraction_bits)),
+                          fraction_bits)
+        return _fixed_phase_dsptick(o, output_operand)
+    return _osc_cycles_dsptick(o, 'pd_tabosc4(%s, %d, %s * %s)' % (table, points - 1, phase, float_str(points)))
+
+@when(receive, AudioTableOscillator)
+def tabosc4_receive(o, inlet):
+    return _phase_receive(o)
+
+#######################################
+# line~ and vline~ ramp to a target in a whole number of samples, adding an
+# increment each sample and landing on the target exactly. object_N_ramp()
+# starts a ramp; vline~ calls it from an event when the ramp is delayed.
+
+def _ramp_state(o):
+    return (('float', 'value', '0.0f'),
+            ('float', 'increment', '0.0f'),
+            ('float', 'target', '0.0f'),
+            ('int', 'remaining', '0'),
+            ('float', 'time', '0.0f'),
+            )
+
+def _state_init(o):
+    return tuple(('%s = %s;' % (state_prop(o, name), initial) for c_type, name, initial in state(o)))
+
+def _store_float(o, name):
+    return ('if(m->argc > 0) {',
+            '\t%s = m->argv[0];' % state_prop(o, name),
+            '}',
+            )
+
+def _ramp_dsptick(o):
+    value = state_prop(o, 'value')
+    remaining = state_prop(o, 'remaining')
+    if numeric_format().fixed:
+        result = (fixed_store_float(o._out, value),
+                  )
+    else:
+        result = ('%s = %s;' % (outlet_str(o._out), value),
+                  )
+    return result + ('if(%s > 0) {' % remaining,
+                     '\t%s = (--%s == 0) ? %s : %s + %s;' % (value, remaining, state_prop(o, 'target'),
+                                                            value, state_prop(o, 'increment')),
+                     '}',
+                     )
+
+def _ramp_declare(o):
+    value = state_prop(o, 'value')
+    remaining = state_prop(o, 'remaining')
+    return ('static void %s(%sfloat target, float ms) {' % (obj_prop(o, 'ramp'), state_arg()),
+            '\tconst float samples = ms * (SAMPLING_RATE / 1000.0f);',
+            '\tif(!(samples >= 0.5f)) {',
+            '\t\t/* Under half a sample, or not a number: jump. */',
+            '\t\t%s = target;' % value,
+            '\t\t%s = 0;' % remaining,
+            '\t} else {',
+            '\t\tconst int count = (samples < 1.0e9f) ? (int)(samples + 0.5f) : 1000000000;',
+            '\t\t%s = target;' % state_prop(o, 'target'),
+            '\t\t%s = (target - %s) / count;' % (state_prop(o, 'increment'), value),
+            '\t\t%s = count;' % remaining,
+            '\t}',
+            '}',
+            )
+
+@when(state, AudioLine)
+def line_state(o):
+    return _ramp_state(o)
+
+@when(init, AudioLine)
+def line_init(o):
+    return _state_init(o)
+
+@when(dsptick, AudioLine)
+def line_dsptick(o):
+    return _ramp_dsptick(o)
+
+@when(control_declare, AudioLine)
+def line_control_declare(o):
+    return _ramp_declare(o)
+
+# A list "target time" sets both; a float to the right inlet is the time
+# of the next ramp alone.
+
+@when(receive, AudioLine)
+def line_receive(o, inlet):
+    if inlet == 1:
+        return _store_float(o, 'time')
+    time = state_prop(o, 'time')
+    return ('if(m->selector == PD_STOP) {',
+            '\t%s = 0;' % state_prop(o, 'remaining'),
+            '} else if(m->argc > 0) {',
+            '\tconst float ms = (m->argc > 1) ? m->argv[1] : %s;' % time,
+            '\t%s = 0.0f;' % time,
+            '\t%s(%sm->argv[0], ms);' % (obj_prop(o, 'ramp'), state_call()),
+            '}',
+            )
+
+@when(state, AudioVLine)
+def vline_state(o):
+    return _ramp_state(o) + (('float', 'delay', '0.0f'),
+                             )
+
+@when(init, AudioVLine)
+def vline_init(o):
+    return _state_init(o)
+
+@when(dsptick, AudioVLine)
+def vline_dsptick(o):
+    return _ramp_dsptick(o)
+
+@when(control_declare, AudioVLine)
+def vline_control_declare(o):
+    return _ramp_declare(o)
+
+# A delayed ramp is an event, due at the time of the message plus the delay.
+# Like Pd's vline~, a new ramp cancels those due at or after its start.
+
+@when(receive, AudioVLine)
+def vline_receive(o, inlet):
+    if inlet == 1:
+        return _store_float(o, 'time')
+    elif inlet == 2:
+        return _store_float(o, 'delay')
+    scheduler = scheduler_str()
+    time = state_prop(o, 'time')
+    delay = state_prop(o, 'delay')
+    return ('if(m->selector == PD_STOP) {',
+            '\tpd_event_cancel(&%s, %d, 0.0);' % (scheduler, o.id),
+            '\t%s = 0;' % state_prop(o, 'remaining'),
+            '} else if(m->argc > 0) {',
+            '\tconst float ms = (m->argc > 1) ? m->argv[1] : %s;' % time,
+            '\tconst float delay_ms = (m->argc > 2) ? m->argv[2] : %s;' % delay,
+            '\tconst double start = %s.time + delay_ms * (SAMPLING_RATE / 1000.0f);' % scheduler,
+            '\t%s = 0.0f;' % time,
+            '\t%s = 0.0f;' % delay,
+            '\tpd_event_cancel(&%s, %d, start);' % (scheduler, o.id),
+            '\tif(!(start > %s.elapsed)) {' % scheduler,
+            '\t\t%s(%sm->argv[0], ms);' % (obj_prop(o, 'ramp'), state_call()),
+            '\t} else {',
+            '\t\tpd_event_push(&%s, start, %d, m->argv[0], ms);' % (scheduler, o.id),
+            '\t}',
+            '}',
+            )
+
+@when(fire, AudioVLine)
+def vline_fire(o):
+    return ('%s(%se->a, e->b);' % (obj_prop(o, 'ramp'), state_call()),
+            )
+
+#######################################
+# A float inlet holds the last float sent to a signal inlet.
+
+@when(state, FloatInlet)
+def float_inlet_state(o):
+    return (('float', 'value', float_str(o.value)),
+            )
+
+@when(init, FloatInlet)
+def float_inlet_init(o):
+    return _state_init(o)
+
+@when(dsptick, FloatInlet)
+def float_inlet_dsptick(o):
+    if numeric_format().fixed:
+        return (fixed_store_float(o._out, state_prop(o, 'value')),
+                )
+    return ('%s = %s;' % (outlet_str(o._out), state_prop(o, 'value')),
+            )
+
+@when(receive, FloatInlet)
+def float_inlet_receive(o, inlet):
+    return _store_float(o, 'value')
+
+#######################################
+# Functions without a fixed-point implementation convert their inputs to
+# float and the result back, which is slow without an FPU.
+
 def _unfn(o, function_str, scale_str=''):
+    if numeric_format().fixed:
+        return (fixed_store_float(o._out, '%s(%s%s)' % (function_str, fixed_to_float(o._in), scale_str)),
+                )
     outlet = outlet_str(o._out)
     arg = source_str(o._in)
-    return ('const float %s = %s(%s%s);' % (outlet, function_str, arg, scale_str),
+    return ('%s = %s(%s%s);' % (outlet, function_str, arg, scale_str),
             )
     
 def _binop(o, operator_str):
+    if numeric_format().fixed:
+        return _fixed_binop(o, operator_str)
     outlet = outlet_str(o._out)
     left = source_str(o._in1)
     right = source_str(o._in2)
-    return ('const float %s = %s %s %s;' % (outlet, left, operator_str, right),
+    return ('%s = %s %s %s;' % (outlet, left, operator_str, right),
             )
 
 def _binfn(o, function_str):
+    if numeric_format().fixed:
+        return (fixed_store_float(o._out, '%s(%s, %s)' % (function_str, fixed_to_float(o._in1), fixed_to_float(o._in2))),
+                )
     outlet = outlet_str(o._out)
     left = source_str(o._in1)
     right = source_str(o._in2)
-    return ('const float %s = %s(%s, %s);' % (outlet, function_str, left, right),
+    return ('%s = %s(%s, %s);' % (outlet, function_str, left, right),
             )
-    
+
+def _fixed_binop(o, operator_str):
+    fraction_bits = outlet_fraction_bits[o._out]
+    if operator_str in ('+', '-'):
+        left = fixed_value(o._in1, fraction_bits)
+        right = fixed_value(o._in2, fraction_bits)
+        return (fixed_store(o._out, '%s %s %s' % (left, operator_str, right)),
+                )
+    if operator_str == '/':
+        if not isinstance(o._in2.source, ConstantOutlet):
+            return (fixed_store_float(o._out, '%s / %s' % (fixed_to_float(o._in1), fixed_to_float(o._in2))),
+                    )
+        # Divide by a constant as multiply by its reciprocal.
+        right = fixed_operand(_constant_inlet(o, 1.0 / o._in2.source.value))
+    else:
+        right = fixed_operand(o._in2)
+    left_expr, left_fraction_bits = fixed_operand(o._in1)
+    right_expr, right_fraction_bits = right
+    product = ('%s * %s' % (left_expr, right_expr), left_fraction_bits + right_fraction_bits)
+    return (fixed_store(o._out, fixed_rescale(product, fraction_bits)),
+            )
+
+def _constant_inlet(o, value):
+    inlet = Inlet(o, float)
+    inlet.source = ConstantOutlet(value)
+    return inlet
+
+def _fixed_temporaries(o, inlets, fraction_bits):
+    """Declares each inlet's value as a wide local, since the expression
+    uses it more than once."""
+    fmt = numeric_format()
+    return tuple(('const %s %s = %s;' % (fmt.wide_type, obj_prop(o, name), fixed_value(inlet, fraction_bits))
+                  for name, inlet in inlets))
+
 #######################################
-@when(dsptick, 'isinstance(o, AudioAdd)')
+@when(dsptick, AudioAdd)
 def add_dsptick(o):
     return _binop(o, '+')
 
-@when(dsptick, 'isinstance(o, AudioSubtract)')
+@when(dsptick, AudioSubtract)
 def subtract_dsptick(o):
     return _binop(o, '-')
 
-@when(dsptick, 'isinstance(o, AudioMultiply)')
+@when(dsptick, AudioMultiply)
 def multiply_dsptick(o):
     return _binop(o, '*')
 
-@when(dsptick, 'isinstance(o, AudioDivide)')
+@when(dsptick, AudioDivide)
 def divide_dsptick(o):
     return _binop(o, '/')
 
 #######################################
-@when(dsptick, 'isinstance(o, AudioCosine)')
+@when(support, AudioCosine)
+def cos_support(o):
+    if numeric_format().fixed:
+        return ('cos_fixed',)
+    if options.trig == 'libm':
+        return tuple()
+    return ('wrap_phase', 'cos')
+
+@when(dsptick, AudioCosine)
 def cos_dsptick(o):
+    fmt = numeric_format()
+    if fmt.fixed:
+        # The fraction bits of the input, moved to the top of 32 bits, are
+        # the phase.
+        expr, fraction_bits = fixed_operand(o._in)
+        phase = '((uint32_t)%s << %d)' % (expr, 32 - fraction_bits) if fraction_bits > 0 else '0u'
+        output = ('(%s)%s(%s)' % (fmt.wide_type, fmt.cos, phase), fmt.bits - 1)
+        return (fixed_store(o._out, fixed_rescale(output, outlet_fraction_bits[o._out])),
+                )
+    if options.trig != 'libm':
+        outlet = outlet_str(o._out)
+        return ('%s = pd_cos(pd_wrap_phase(%s));' % (outlet, source_str(o._in)),
+                )
     return _unfn(o, 'cosf', ' * 2.0f * M_PI')
 
-@when(dsptick, 'isinstance(o, AudioAbsolute)')
+@when(dsptick, AudioAbsolute)
 def abs_dsptick(o):
+    if numeric_format().fixed:
+        x = obj_prop(o, 'x')
+        return (_fixed_temporaries(o, (('x', o._in),), outlet_fraction_bits[o._out]) +
+                (fixed_store(o._out, '(%s < 0) ? -%s : %s' % (x, x, x)),
+                 ))
     return _unfn(o, 'fabsf')
 
-@when(dsptick, 'isinstance(o, AudioExponent)')
+@when(dsptick, AudioExponent)
 def exp_dsptick(o):
     return _unfn(o, 'expf')
 
-@when(dsptick, 'isinstance(o, AudioSignal)')
+@when(dsptick, AudioSignal)
 def sig_dsptick(o):
+    if numeric_format().fixed:
+        return (fixed_store(o._out, fixed_value(o._in, outlet_fraction_bits[o._out])),
+                )
     outlet = outlet_str(o._out)
     arg = source_str(o._in)
-    return ('const float %s = %s;' % (outlet, arg),
+    return ('%s = %s;' % (outlet, arg),
             )
 
-@when(dsptick, 'isinstance(o, AudioWrap)')
+@when(dsptick, AudioWrap)
 def wrap_dsptick(o):
+    fmt = numeric_format()
+    if fmt.fixed:
+        # In two's complement, the fraction bits alone are x - floor(x).
+        expr, fraction_bits = fixed_operand(o._in)
+        if fraction_bits <= 0:
+            return (fixed_store(o._out, '0'),
+                    )
+        fraction = ('(%s & %d%s)' % (expr, (1 << fraction_bits) - 1, fmt.literal_suffix), fraction_bits)
+        return (fixed_store(o._out, fixed_rescale(fraction, outlet_fraction_bits[o._out])),
+                )
     outlet = outlet_str(o._out)
     arg = source_str(o._in)
-    return ('const float %s = (%s > 0.0f) ? (%s - (int)%s) : (%s - ((int)%s - 1.0f));' % (outlet,
+    return ('%s = (%s > 0.0f) ? (%s - (int)%s) : (%s - ((int)%s - 1.0f));' % (outlet,
             arg, arg, arg, arg, arg),
             )
 
 #######################################
-@when(dsptick, 'isinstance(o, AudioMaximum)')
+def _fixed_select(o, operator_str):
+    a = obj_prop(o, 'a')
+    b = obj_prop(o, 'b')
+    return (_fixed_temporaries(o, (('a', o._in1), ('b', o._in2)), outlet_fraction_bits[o._out]) +
+            (fixed_store(o._out, '(%s %s %s) ? %s : %s' % (a, operator_str, b, a, b)),
+             ))
+
+@when(dsptick, AudioMaximum)
 def max_dsptick(o):
+    if numeric_format().fixed:
+        return _fixed_select(o, '>')
     return _binfn(o, 'fmaxf')
 
-@when(dsptick, 'isinstance(o, AudioMinimum)')
+@when(dsptick, AudioMinimum)
 def min_dsptick(o):
+    if numeric_format().fixed:
+        return _fixed_select(o, '<')
     return _binfn(o, 'fminf')
 
-@when(dsptick, 'isinstance(o, AudioPower)')
+@when(dsptick, AudioPower)
 def pow_dsptick(o):
     return _binfn(o, 'powf')
 
 #######################################
-@when(dsptick, 'isinstance(o, AudioClip)')
+@when(dsptick, AudioClip)
 def clip_dsptick(o):
+    if numeric_format().fixed:
+        inlets = (('x', o._in), ('lo', o._lo), ('hi', o._hi))
+        x, lo, hi = [obj_prop(o, name) for name, inlet in inlets]
+        return (_fixed_temporaries(o, inlets, outlet_fraction_bits[o._out]) +
+                (fixed_store(o._out, '(%s < %s) ? %s : (%s > %s) ? %s : %s' % (x, lo, lo, x, hi, hi, x)),
+                 ))
     outlet = outlet_str(o._out)
     i = source_str(o._in)
     lo = source_str(o._lo)
     hi = source_str(o._hi)
-    return ('const float %s = (%s < %s) ? %s : (%s > %s) ? %s : %s;' % (outlet,
+    return ('%s = (%s < %s) ? %s : (%s > %s) ? %s : %s;' % (outlet,
             i, lo, lo, i, hi, hi, i),
             )
 
-@when(dsptick, 'isinstance(o, AudioLogarithm)')
+@when(dsptick, AudioLogarithm)
 def log_dsptick(o):
+    if numeric_format().fixed:
+        in1 = fixed_to_float(o._in1)
+        if o._in2.source:
+            expr = 'logf(%s) / logf(%s)' % (in1, fixed_to_float(o._in2))
+        else:
+            expr = 'logf(%s)' % in1
+        return (fixed_store_float(o._out, expr),
+                )
     outlet = outlet_str(o._out)
     in1 = source_str(o._in1)
     if o._in2.source:
         in2 = source_str(o._in2)
-        return ('const float %s = logf(%s) / logf(%s);' % (outlet, in1, in2),
+        return ('%s = logf(%s) / logf(%s);' % (outlet, in1, in2),
+                )
+    else:
+        return ('%s = logf(%s);' % (outlet, in1),
+                )
+
+#######################################
+# Elementwise objects can share one loop over the block (see fuse()). An
+# outlet whose consumers are all in the same loop lives in a local variable
+# instead of a buffer.
+
+register_outlets = set()
+
+# Outlets whose value can't change within a block (see
+# optimize.signal_rates()) are computed once per block, into a local
+# variable, before the loops of the objects that run every sample.
+
+block_outlets = set()
+
+# vector_dsptick is the loop body for PD_VECTOR_SIZE samples at a time,
+# starting at sample "i". Objects without one aren't elementwise.
+
+@generic
+def vector_dsptick(o):
+    return tuple()
+
+def vector_outlet_str(outlet):
+    if outlet in register_outlets:
+        return '%s_v' % outlet_buffer_str(outlet)
+    return '*(pd_v4sf *)&%s[i]' % outlet_buffer_str(outlet)
+
+def vector_source_str(inlet):
+    source = inlet.source
+    if isinstance(source, Outlet) and source not in block_outlets:
+        return vector_outlet_str(source)
+    elif isinstance(source, (Outlet, ConstantOutlet)):
+        value = source_str(inlet)
+        return '(pd_v4sf){%s, %s, %s, %s}' % (value, value, value, value)
+    else:
+        raise Exception('Unknown source %s' % source)
+
+def _vector_binop(o, operator_str):
+    return ('%s = %s %s %s;' % (vector_outlet_str(o._out), vector_source_str(o._in1),
+                                operator_str, vector_source_str(o._in2)),
+            )
+
+@when(vector_dsptick, AudioAdd)
+def add_vector_dsptick(o):
+    return _vector_binop(o, '+')
+
+@when(vector_dsptick, AudioSubtract)
+def subtract_vector_dsptick(o):
+    return _vector_binop(o, '-')
+
+@when(vector_dsptick, AudioMultiply)
+def multiply_vector_dsptick(o):
+    return _vector_binop(o, '*')
+
+@when(vector_dsptick, AudioDivide)
+def divide_vector_dsptick(o):
+    return _vector_binop(o, '/')
+
+@when(vector_dsptick, AudioSignal)
+def sig_vector_dsptick(o):
+    return ('%s = %s;' % (vector_outlet_str(o._out), vector_source_str(o._in)),
+            )
+
+@when(vector_dsptick, AudioAbsolute)
+def abs_vector_dsptick(o):
+    return ('%s = pd_v4_abs(%s);' % (vector_outlet_str(o._out), vector_source_str(o._in)),
+            )
+
+@when(vector_dsptick, AudioMaximum)
+def max_vector_dsptick(o):
+    return ('%s = pd_v4_max(%s, %s);' % (vector_outlet_str(o._out), vector_source_str(o._in1),
+                                         vector_source_str(o._in2)),
+            )
+
+@when(vector_dsptick, AudioMinimum)
+def min_vector_dsptick(o):
+    return ('%s = pd_v4_min(%s, %s);' % (vector_outlet_str(o._out), vector_source_str(o._in1),
+                                         vector_source_str(o._in2)),
+            )
+
+@when(vector_dsptick, AudioClip)
+def clip_vector_dsptick(o):
+    return ('%s = pd_v4_clip(%s, %s, %s);' % (vector_outlet_str(o._out), vector_source_str(o._in),
+                                              vector_source_str(o._lo), vector_source_str(o._hi)),
+            )
+
+# cmsis_dsptick is a CMSIS-DSP call that processes the whole block, for
+# objects whose operation is one of its kernels.
+
+@generic
+def cmsis_dsptick(o):
+    return tuple()
+
+def _is_buffer(inlet):
+    return isinstance(inlet.source, Outlet) and inlet.source not in block_outlets
+
+def _is_constant(inlet):
+    return isinstance(inlet.source, ConstantOutlet) or inlet.source in block_outlets
+
+def _commutative_cmsis_dsptick(o, kernel, constant_kernel):
+    out = outlet_buffer_str(o._out)
+    if _is_buffer(o._in1) and _is_buffer(o._in2):
+        return ('%s(%s, %s, %s, n);' % (kernel, outlet_buffer_str(o._in1.source),
+                                        outlet_buffer_str(o._in2.source), out),
+                )
+    for buffer_inlet, constant_inlet in ((o._in1, o._in2), (o._in2, o._in1)):
+        if _is_buffer(buffer_inlet) and _is_constant(constant_inlet):
+            return ('%s(%s, %s, %s, n);' % (constant_kernel, outlet_buffer_str(buffer_inlet.source),
+                                            source_str(constant_inlet), out),
+                    )
+    return tuple()
+
+@when(cmsis_dsptick, AudioAdd)
+def add_cmsis_dsptick(o):
+    return _commutative_cmsis_dsptick(o, 'arm_add_f32', 'arm_offset_f32')
+
+@when(cmsis_dsptick, AudioMultiply)
+def multiply_cmsis_dsptick(o):
+    return _commutative_cmsis_dsptick(o, 'arm_mult_f32', 'arm_scale_f32')
+
+@when(cmsis_dsptick, AudioSubtract)
+def subtract_cmsis_dsptick(o):
+    out = outlet_buffer_str(o._out)
+    if not _is_buffer(o._in1):
+        return tuple()
+    if _is_buffer(o._in2):
+        return ('arm_sub_f32(%s, %s, %s, n);' % (outlet_buffer_str(o._in1.source),
+                                                  outlet_buffer_str(o._in2.source), out),
                 )
+    elif _is_constant(o._in2):
+        return ('arm_offset_f32(%s, -(%s), %s, n);' % (outlet_buffer_str(o._in1.source),
+                                                        source_str(o._in2), out),
+                )
+    return tuple()
+
+@when(cmsis_dsptick, AudioAbsolute)
+def abs_cmsis_dsptick(o):
+    if not _is_buffer(o._in):
+        return tuple()
+    return ('arm_abs_f32(%s, %s, n);' % (outlet_buffer_str(o._in.source), outlet_buffer_str(o._out)),
+            )
+
+@when(cmsis_dsptick, AudioSignal)
+def sig_cmsis_dsptick(o):
+    if not _is_buffer(o._in):
+        return tuple()
+    return ('arm_copy_f32(%s, %s, n);' % (outlet_buffer_str(o._in.source), outlet_buffer_str(o._out)),
+            )
+
+@when(cmsis_dsptick, AudioClip)
+def clip_cmsis_dsptick(o):
+    if not (_is_buffer(o._in) and _is_constant(o._lo) and _is_constant(o._hi)):
+        return tuple()
+    return ('arm_clip_f32(%s, %s, %s, %s, n);' % (outlet_buffer_str(o._in.source), outlet_buffer_str(o._out),
+                                                   source_str(o._lo), source_str(o._hi)),
+            )
+
+def fusable(o):
+    """Whether o can share a sample loop with its neighbours in the chain.
+    For scalar loops that is any object whose work is all in its loop body;
+    vector loops need a vector_dsptick as well."""
+    if options.simd == 'none':
+        return bool(dsptick(o)) and not dsptick_start(o) and not dsptick_end(o)
+    return bool(vector_dsptick(o))
+
+def fuse(chain, enabled=True):
+    """Splits the chain into the runs of objects that share a sample loop,
+    and picks the outlets that don't need a buffer. Objects whose output
+    only changes between blocks come first, in a group of their own that
+    runs once per block. Without fusion, every object gets its own loop."""
+    register_outlets.clear()
+    block_outlets.clear()
+    if not enabled:
+        return [[o] for o in chain]
+    block_outlets.update((outlet for outlet, rate in optimize.signal_rates(chain).items() if rate != 'sample'))
+    per_block = [o for o in chain if o.outlet and o.outlet[0] in block_outlets]
+    groups = []
+    for o in chain:
+        if o.outlet and o.outlet[0] in block_outlets:
+            continue
+        if groups and fusable(o) and fusable(groups[-1][-1]):
+            groups[-1].append(o)
+        else:
+            groups.append([o])
+    readers = optimize.consumers(chain)
+    for group in groups:
+        members = set(group)
+        for o in group:
+            for outlet in o.outlet:
+                inlets = readers.get(outlet, ())
+                if inlets and all((inlet.parent in members for inlet in inlets)):
+                    register_outlets.add(outlet)
+    if per_block:
+        groups.insert(0, per_block)
+    return groups
+
+# Block buffers are shared by outlets whose lifetimes don't overlap. An
+# outlet's buffer is live from the group that writes it to the last group
+# that reads it; dac~ inlets are read up to the end of dsptick(). Buffers
+# aren't shared within a group, as an object may write its output before
+# reading all of its input.
+
+outlet_buffers = {}
+
+def allocate_buffers(groups, reuse=True):
+    """Assigns a block buffer to each outlet of the groups from fuse()
+    that isn't kept in a register."""
+    outlet_buffers.clear()
+    _allocate_buffers(groups, reuse)
+
+def allocate_partition_buffers(partitions, reuse=True):
+    """As allocate_buffers(), for a list of partitions, each a list of
+    groups run by its own tick function. The partitions may run at the same
+    time, so each one's buffers are declared in its own function, and the
+    names are counted from 0 again."""
+    outlet_buffers.clear()
+    for groups in partitions:
+        _allocate_buffers(groups, reuse)
+
+def _allocate_buffers(groups, reuse):
+    group_index = {}
+    for index, group in enumerate(groups):
+        for o in group:
+            group_index[o] = index
+    readers = optimize.consumers(group_index)
+    end = len(groups)
+    busy_until = []
+    for index, group in enumerate(groups):
+        for o in group:
+            for outlet in o.outlet:
+                if outlet in register_outlets or outlet in block_outlets:
+                    continue
+                last = index
+                for inlet in readers.get(outlet, ()):
+                    reader = inlet.parent
+                    last = max(last, end if isinstance(reader, AudioDAC) else group_index[reader])
+                # Groups are visited in order, so the first free buffer will do.
+                free = [k for k, until in enumerate(busy_until) if until < index] if reuse else []
+                if free:
+                    k = free[0]
+                    busy_until[k] = last
+                else:
+                    k = len(busy_until)
+                    busy_until.append(last)
+                outlet_buffers[outlet] = 'buffer_%d' % k
+
+def buffer_names(groups=None):
+    """The names of the buffers of the groups' outlets, or of all outlets."""
+    if groups is None:
+        names = set(outlet_buffers.values())
+    else:
+        names = set((outlet_buffers[outlet] for group in groups for o in group for outlet in o.outlet
+                     if outlet in outlet_buffers))
+    return sorted(names, key=lambda name: int(name.split('_')[1]))
+
+def buffer_bytes(count, block_size):
+    return count * c_type_sizes[numeric_format().sample_type] * block_size
+
+def sample_loop(body):
+    if not body:
+        return []
+    return (['for(i=0; i<n; i++) {'] +
+            ['\t%s' % s for s in body] +
+            ['}'])
+
+def group_dsptick(group):
+    """The loops that run a group from fuse() over the block."""
+    if group[0].outlet and group[0].outlet[0] in block_outlets:
+        # Once per block, outside any loop.
+        lines = ['%s %s;' % (numeric_format().sample_type, outlet_buffer_str(outlet))
+                 for o in group for outlet in o.outlet]
+        for o in group:
+            lines.extend(dsptick(o))
+        return lines
+    scalar_body = []
+    for o in group:
+        scalar_body.extend(('%s %s;' % (numeric_format().sample_type, outlet_buffer_str(outlet))
+                            for outlet in o.outlet if outlet in register_outlets))
+        scalar_body.extend(dsptick(o))
+    if not vector_dsptick(group[0]) or options.simd == 'none':
+        return sample_loop(scalar_body)
+    if options.simd == 'cmsis':
+        if len(group) == 1 and cmsis_dsptick(group[0]):
+            return list(cmsis_dsptick(group[0]))
+        return sample_loop(scalar_body)
+    vector_body = []
+    for o in group:
+        vector_body.extend(('pd_v4sf %s;' % vector_outlet_str(outlet)
+                            for outlet in o.outlet if outlet in register_outlets))
+        vector_body.extend(vector_dsptick(o))
+    # The scalar loop finishes the samples after the last whole vector.
+    return (['for(i=0; i + PD_VECTOR_SIZE <= n; i += PD_VECTOR_SIZE) {'] +
+            ['\t%s' % s for s in vector_body] +
+            ['}',
+             'for(; i<n; i++) {'] +
+            ['\t%s' % s for s in scalar_body] +
+            ['}'])
+
+def _vector_declare():
+    return ['#define PD_VECTOR_SIZE 4',
+            'typedef float pd_v4sf __attribute__((vector_size(16)));',
+            'typedef int pd_v4si __attribute__((vector_size(16)));',
+            '',
+            '/* mask lanes are all ones where a is chosen, all zeros where b is */',
+            'static inline pd_v4sf pd_v4_select(pd_v4si mask, pd_v4sf a, pd_v4sf b) {',
+            '\treturn (pd_v4sf)((mask & (pd_v4si)a) | (~mask & (pd_v4si)b));',
+            '}',
+            '',
+            'static inline pd_v4sf pd_v4_abs(pd_v4sf x) {',
+            '\treturn (pd_v4sf)((pd_v4si)x & 0x7fffffff);',
+            '}',
+            '',
+            'static inline pd_v4sf pd_v4_max(pd_v4sf a, pd_v4sf b) {',
+            '\treturn pd_v4_select(a > b, a, b);',
+            '}',
+            '',
+            'static inline pd_v4sf pd_v4_min(pd_v4sf a, pd_v4sf b) {',
+            '\treturn pd_v4_select(a < b, a, b);',
+            '}',
+            '',
+            'static inline pd_v4sf pd_v4_clip(pd_v4sf x, pd_v4sf lo, pd_v4sf hi) {',
+            '\treturn pd_v4_select(x < lo, lo, pd_v4_select(x > hi, hi, x));',
+            '}',
+            ]
+
+#######################################
+# The control domain. Each inlet that messages reach gets a function,
+# object_N_inlet_K(), and each outlet that sends them a function,
+# object_N_send_K(), that calls those of the connected inlets in turn. A
+# message is a pd_message_t on the stack; nothing is allocated.
+#
+# metro and vline~ act at later times through events, kept in a binary
+# heap of options.event_queue_size entries in pd_scheduler_t. Times are in
+# samples since init(), and may fall between samples. dsptick() fires the
+# events that are due, then runs the objects up to the next event or the
+# end of the block, so the sample loops never look at the queue.
+
+control_inlets = []
+control_objects = []
+event_objects = []
+
+def prepare_control(parse_context, chain):
+    """Pick the inlets that messages from loadbang reach, and the control
+    objects that handle them, leaving out objects that aren't in the chain.
+    Without a message that reaches the chain, there's no control code.
+    Must be called before emitting code for the chain."""
+    del control_inlets[:]
+    del control_objects[:]
+    del event_objects[:]
+    in_chain = set(chain)
+    inlets = [inlet for inlet in parse_context.message_inlets
+              if not isinstance(inlet.parent, DSPOperator) or inlet.parent in in_chain]
+    if not any((isinstance(inlet.parent, DSPOperator) for inlet in inlets)):
+        return
+    control_inlets.extend(sorted(inlets, key=lambda inlet: (inlet.parent.id, inlet.id)))
+    objects = set((o for o in parse_context.objects if isinstance(o, LoadBang)))
+    objects.update((inlet.parent for inlet in inlets if isinstance(inlet.parent, ControlObject)))
+    control_objects.extend(sorted(objects, key=lambda o: o.id))
+    # Only messages to the left inlet start events.
+    event_objects.extend((inlet.parent for inlet in control_inlets
+                          if isinstance(inlet.parent, (Metro, AudioVLine)) and inlet.id == 0))
+
+def scheduler_str():
+    if options.state == 'struct':
+        return 'state->pd_scheduler'
+    return 'pd_scheduler'
+
+def event_queue_types():
+    """The types of the event queue, which patch_state_t holds."""
+    return ('#define PD_EVENT_QUEUE_SIZE %d' % options.event_queue_size,
+            '',
+            '/* An event for object target, due at time. a and b are its arguments. */',
+            'typedef struct {',
+            '\tdouble time;',
+            '\tunsigned int order;',
+            '\tint target;',
+            '\tfloat a;',
+            '\tfloat b;',
+            '} pd_event_t;',
+            '',
+            '/* elapsed is the time of the sample that dsptick() runs next, time that',
+            ' * of the message being handled. order counts the events pushed, so that',
+            ' * events due at the same time fire in the order they were pushed. */',
+            'typedef struct {',
+            '\tdouble elapsed;',
+            '\tdouble time;',
+            '\tint count;',
+            '\tunsigned int order;',
+            '\tunsigned int overflows;',
+            '\tpd_event_t events[PD_EVENT_QUEUE_SIZE];',
+            '} pd_scheduler_t;',
+            '',
+            )
+
+def _event_queue_define():
+    return ['static inline int pd_event_before(const pd_event_t *a, const pd_event_t *b) {',
+            '\tif(a->time != b->time) {',
+            '\t\treturn a->time < b->time;',
+            '\t}',
+            '\treturn (int)(a->order - b->order) < 0;',
+            '}',
+            '',
+            'static void pd_event_sift_down(pd_scheduler_t *s, int k) {',
+            '\tfor(;;) {',
+            '\t\tint child = 2 * k + 1;',
+            '\t\tpd_event_t swap;',
+            '\t\tif(child >= s->count) {',
+            '\t\t\treturn;',
+            '\t\t}',
+            '\t\tif(child + 1 < s->count && pd_event_before(&s->events[child + 1], &s->events[child])) {',
+            '\t\t\tchild++;',
+            '\t\t}',
+            '\t\tif(!pd_event_before(&s->events[child], &s->events[k])) {',
+            '\t\t\treturn;',
+            '\t\t}',
+            '\t\tswap = s->events[k];',
+            '\t\ts->events[k] = s->events[child];',
+            '\t\ts->events[child] = swap;',
+            '\t\tk = child;',
+            '\t}',
+            '}',
+            '',
+            '/* Queues an event, or drops it and counts an overflow if the queue is full. */',
+            'static void pd_event_push(pd_scheduler_t *s, double time, int target, float a, float b) {',
+            '\tint k = s->count;',
+            '\tif(k == PD_EVENT_QUEUE_SIZE) {',
+            '\t\ts->overflows++;',
+            '\t\treturn;',
+            '\t}',
+            '\ts->events[k].time = time;',
+            '\ts->events[k].order = s->order++;',
+            '\ts->events[k].target = target;',
+            '\ts->events[k].a = a;',
+            '\ts->events[k].b = b;',
+            '\ts->count++;',
+            '\twhile(k > 0) {',
+            '\t\tconst int parent = (k - 1) / 2;',
+            '\t\tpd_event_t swap;',
+            '\t\tif(!pd_event_before(&s->events[k], &s->events[parent])) {',
+            '\t\t\tbreak;',
+            '\t\t}',
+            '\t\tswap = s->events[k];',
+            '\t\ts->events[k] = s->events[parent];',
+            '\t\ts->events[parent] = swap;',
+            '\t\tk = parent;',
+            '\t}',
+            '}',
+            '',
+            'static void pd_event_pop(pd_scheduler_t *s, pd_event_t *e) {',
+            '\t*e = s->events[0];',
+            '\ts->events[0] = s->events[--s->count];',
+            '\tpd_event_sift_down(s, 0);',
+            '}',
+            '',
+            '/* Removes the events of target due at or after from. */',
+            'static void pd_event_cancel(pd_scheduler_t *s, int target, double from) {',
+            '\tint k = 0;',
+            '\tint count = 0;',
+            '\tfor(k=0; k<s->count; k++) {',
+            '\t\tif(s->events[k].target != target || s->events[k].time < from) {',
+            '\t\t\ts->events[count++] = s->events[k];',
+            '\t\t}',
+            '\t}',
+            '\tif(count == s->count) {',
+            '\t\treturn;',
+            '\t}',
+            '\ts->count = count;',
+            '\tfor(k=count / 2 - 1; k>=0; k--) {',
+            '\t\tpd_event_sift_down(s, k);',
+            '\t}',
+            '}',
+            '',
+            ]
+
+def message_size():
+    """The most floats in a message: those of the longest message a message
+    box sends, or the highest $N it reads."""
+    size = 1
+    for o in control_objects:
+        if isinstance(o, Message):
+            for selector, atoms in o.messages():
+                size = max([size, len(atoms)] + [atom.n for atom in atoms if isinstance(atom, DollarArgument)])
+    return size
+
+def _inlet_function(inlet):
+    return obj_prop(inlet.parent, 'inlet_%d' % inlet.id)
+
+def _send_function(o, outlet_id):
+    return obj_prop(o, 'send_%d' % outlet_id)
+
+def _bang_lines(send):
+    return ('{',
+            '\tconst pd_message_t bang = {PD_LIST, 0, {0.0f}};',
+            '\t%s(%s&bang);' % (send, state_call()),
+            '}',
+            )
+
+def control_define():
+    """The C code of the control domain, for the objects picked by
+    prepare_control(): message types, the event queue, and the functions of
+    the inlets and outlets."""
+    if not control_inlets:
+        return []
+    lines = ['#define PD_MESSAGE_SIZE %d' % message_size(),
+             '',
+             'enum { PD_LIST, PD_STOP };',
+             '',
+             '/* argc floats, or none for a bang, or stop. */',
+             'typedef struct {',
+             '\tint selector;',
+             '\tint argc;',
+             '\tfloat argv[PD_MESSAGE_SIZE];',
+             '} pd_message_t;',
+             '',
+             ]
+    if event_objects:
+        if options.state == 'static':
+            lines.extend(event_queue_types())
+            lines.extend(('static pd_scheduler_t pd_scheduler;',
+                          ''))
+        lines.extend(_event_queue_define())
+    if any((isinstance(o, Metro) for o in control_objects)):
+        lines.extend(('/* metro intervals in samples, at least one */',
+                      'static inline float pd_metro_interval(float ms) {',
+                      '\tconst float samples = ms * (SAMPLING_RATE / 1000.0f);',
+                      '\treturn (samples > 1.0f) ? samples : 1.0f;',
+                      '}',
+                      ''))
+
+    message_param = '%sconst pd_message_t *m' % state_arg()
+    for inlet in control_inlets:
+        lines.append('static void %s(%s);' % (_inlet_function(inlet), message_param))
+    lines.append('')
+
+    live = set(control_inlets)
+    senders = [o for o in control_objects if isinstance(o, LoadBang) or o.inlet[0] in live]
+    for o in senders:
+        for outlet in o.outlet:
+            lines.append('static void %s(%s) {' % (_send_function(o, outlet.id), message_param))
+            lines.extend(('\t%s(%sm);' % (_inlet_function(inlet), state_call())
+                          for inlet in outlet.targets if inlet in live))
+            lines.append('}')
+            lines.append('')
+
+    # Helpers serve the left inlet.
+    for inlet in control_inlets:
+        if inlet.id == 0:
+            declared = control_declare(inlet.parent)
+            if declared:
+                lines.extend(declared)
+                lines.append('')
+
+    for inlet in control_inlets:
+        lines.append('static void %s(%s) {' % (_inlet_function(inlet), message_param))
+        lines.extend(('\t%s' % s for s in receive(inlet.parent, inlet.id)))
+        lines.append('}')
+        lines.append('')
+
+    if event_objects:
+        lines.append('static void pd_fire(%sconst pd_event_t *e) {' % state_arg())
+        lines.append('\tswitch(e->target) {')
+        for o in event_objects:
+            lines.append('\tcase %d:' % o.id)
+            lines.extend(('\t\t%s' % s for s in fire(o)))
+            lines.append('\t\tbreak;')
+        lines.append('\t}')
+        lines.append('}')
+        lines.append('')
+        lines.extend(('/* Events dropped because the queue was full, since init(). */',
+                      'unsigned int dsp_event_overflows(%s) {' % state_param(),
+                      '\treturn %s.overflows;' % scheduler_str(),
+                      '}',
+                      ''))
+    return lines
+
+def control_init():
+    """The end of init(): an empty event queue, and the bang of each
+    loadbang."""
+    lines = []
+    if event_objects:
+        scheduler = scheduler_str()
+        lines.extend(('%s.elapsed = 0.0;' % scheduler,
+                      '%s.time = 0.0;' % scheduler,
+                      '%s.count = 0;' % scheduler,
+                      '%s.order = 0;' % scheduler,
+                      '%s.overflows = 0;' % scheduler,
+                      ))
+    for o in control_objects:
+        if isinstance(o, LoadBang):
+            lines.extend(_bang_lines(_send_function(o, 0)))
+    return lines
+
+def event_dsptick(channels, planar):
+    """The body of dsptick() with events: dsptick_segment() runs the
+    objects for each part of the block between events."""
+    if planar:
+        segment = 'dsptick_segment(%sout + start, end - start, n);' % state_call()
+    elif channels:
+        segment = 'dsptick_segment(%sout + start * %d, end - start);' % (state_call(), channels)
     else:
-        return ('const float %s = logf(%s);' % (outlet, in1),
+        segment = 'dsptick_segment(%sout, end - start);' % state_call()
+    return ['pd_scheduler_t *s = &%s;' % scheduler_str(),
+            'int start = 0;',
+            'while(start < n) {',
+            '\tint end = n;',
+            '\twhile(s->count > 0 && s->events[0].time <= s->elapsed) {',
+            '\t\tpd_event_t e;',
+            '\t\tpd_event_pop(s, &e);',
+            '\t\ts->time = e.time;',
+            '\t\tpd_fire(%s&e);' % state_call(),
+            '\t}',
+            '\ts->time = s->elapsed;',
+            '\t/* An event in this block ends the part at the first sample after it. */',
+            '\tif(s->count > 0 && s->events[0].time < s->elapsed + (n - start)) {',
+            '\t\tend = start + (int)ceil(s->events[0].time - s->elapsed);',
+            '\t}',
+            '\t' + segment,
+            '\ts->elapsed += end - start;',
+            '\tstart = end;',
+            '}',
+            ]
+
+@when(state, Metro)
+def metro_state(o):
+    return (('int', 'running', '0'),
+            ('int', 'hit', '0'),
+            ('float', 'interval', '0.0f'),
+            )
+
+@when(init, Metro)
+def metro_init(o):
+    return ('%s = 0;' % state_prop(o, 'running'),
+            '%s = 0;' % state_prop(o, 'hit'),
+            '%s = pd_metro_interval(%s);' % (state_prop(o, 'interval'), float_str(o.interval)),
+            )
+
+# hit tells object_N_tick() that the bang it sent turned the metro off, or
+# on again, which already took care of the next tick.
+
+@when(control_declare, Metro)
+def metro_control_declare(o):
+    hit = state_prop(o, 'hit')
+    return ('static void %s(%sdouble time) {' % (obj_prop(o, 'tick'), state_arg()),
+            '\tconst pd_message_t bang = {PD_LIST, 0, {0.0f}};',
+            '\t%s = 0;' % hit,
+            '\t%s(%s&bang);' % (_send_function(o, 0), state_call()),
+            '\tif(!%s && %s) {' % (hit, state_prop(o, 'running')),
+            '\t\tpd_event_push(&%s, time + %s, %d, 0.0f, 0.0f);' % (scheduler_str(), state_prop(o, 'interval'), o.id),
+            '\t}',
+            '}',
+            )
+
+@when(receive, Metro)
+def metro_receive(o, inlet):
+    if inlet == 1:
+        return ('if(m->argc > 0) {',
+                '\t%s = pd_metro_interval(m->argv[0]);' % state_prop(o, 'interval'),
+                '}',
                 )
+    running = state_prop(o, 'running')
+    return ('pd_event_cancel(&%s, %d, 0.0);' % (scheduler_str(), o.id),
+            '%s = 1;' % state_prop(o, 'hit'),
+            'if(m->selector == PD_STOP || (m->argc > 0 && m->argv[0] == 0.0f)) {',
+            '\t%s = 0;' % running,
+            '} else {',
+            '\t%s = 1;' % running,
+            '\t%s(%s%s.time);' % (obj_prop(o, 'tick'), state_call(), scheduler_str()),
+            '}',
+            )
+
+@when(fire, Metro)
+def metro_fire(o):
+    return ('%s(%se->time);' % (obj_prop(o, 'tick'), state_call()),
+            )
+
+def _atom_str(atom):
+    if isinstance(atom, DollarArgument):
+        return '((m->argc >= %d) ? m->argv[%d] : 0.0f)' % (atom.n, atom.n - 1)
+    return float_str(atom)
+
+@when(receive, Message)
+def message_receive(o, inlet):
+    lines = []
+    for selector, atoms in o.messages():
+        if not atoms:
+            values = '0.0f'
+        else:
+            values = ', '.join((_atom_str(atom) for atom in atoms))
+        lines.extend(('{',
+                      '\tconst pd_message_t out = {%s, %d, {%s}};' % ('PD_STOP' if selector == 'stop' else 'PD_LIST',
+                                                                     len(atoms), values),
+                      '\t%s(%s&out);' % (_send_function(o, 0), state_call()),
+                      '}',
+                      ))
+    return tuple(lines)
+
+#######################################
+# Size in bytes of the C types used for state, on a 32-bit target.
+c_type_sizes = {
+    'float': 4,
+    'int': 4,
+    'int16_t': 2,
+    'int32_t': 4,
+    'uint32_t': 4,
+    'FILE*': 4,
+}
+
+def c_type_layout(c_type):
+    """(size, alignment) of a state type."""
+    if c_type == 'pd_scheduler_t':
+        # Two doubles and three ints, padded to a double, then the events:
+        # a double, two ints and two floats each.
+        return 32 + 24 * options.event_queue_size, 8
+    return c_type_sizes[c_type], c_type_sizes[c_type]
+
+def state_members(objects):
+    """The members of patch_state_t for the objects, and the event queue
+    if there are events (see prepare_control())."""
+    members = [(c_type, obj_prop(o, name)) for o in objects for c_type, name, initial in state(o)]
+    if event_objects:
+        members.append(('pd_scheduler_t', 'pd_scheduler'))
+    return members
+
+def state_struct_size(objects):
+    size = 0
+    alignments = [1]
+    for c_type, name in state_members(objects):
+        member_size, alignment = c_type_layout(c_type)
+        size = (size + alignment - 1) // alignment * alignment + member_size
+        alignments.append(alignment)
+    # The struct is padded to its largest alignment.
+    alignment = max(alignments)
+    return (size + alignment - 1) // alignment * alignment
+
+def state_struct_declare(chain):
+    members = state_members(chain)
+    if not members:
+        # C doesn't allow an empty struct.
+        members = [('int', 'unused')]
+    return (['typedef struct patch_state {'] +
+            ['\t%s %s;' % member for member in members] +
+            ['} patch_state_t;'])
+
+def state_param():
+    if options.state == 'struct':
+        return 'patch_state_t *state'
+    return ''
+
+def state_arg():
+    """state_param() as the first of several parameters."""
+    param = state_param()
+    return param + ', ' if param else ''
+
+def state_call():
+    """The argument for state_arg()."""
+    return 'state, ' if state_param() else ''
+
+#######################################
+# Profiling. Each slot of the table is a group of objects that dsptick()
+# runs together, usually one object. The counter is read once between
+# slots, and the difference added to the slot that just ran. On Cortex-M
+# the counter is the DWT cycle counter, on x86 the time stamp counter, and
+# elsewhere clock_gettime() in nanoseconds.
+
+def profile_declare(slot_count):
+    return ['#if defined(__ARM_ARCH_7M__) || defined(__ARM_ARCH_7EM__) || defined(__ARM_ARCH_8M_MAIN__)',
+            '#define PD_DEMCR (*(volatile uint32_t *)0xE000EDFCu)',
+            '#define PD_DWT_CTRL (*(volatile uint32_t *)0xE0001000u)',
+            '#define PD_DWT_CYCCNT (*(volatile uint32_t *)0xE0001004u)',
+            '#define PD_PROFILE_UNIT "cycles"',
+            'typedef uint32_t pd_counter_t;',
+            'static inline pd_counter_t pd_counter(void) { return PD_DWT_CYCCNT; }',
+            'static void pd_counter_enable(void) { PD_DEMCR |= 0x01000000u; PD_DWT_CTRL |= 1u; }',
+            '#elif defined(__x86_64__) || defined(__i386__)',
+            '#include <x86intrin.h>',
+            '#define PD_PROFILE_UNIT "tsc"',
+            'typedef uint64_t pd_counter_t;',
+            'static inline pd_counter_t pd_counter(void) { return __rdtsc(); }',
+            'static void pd_counter_enable(void) { }',
+            '#else',
+            '#include <time.h>',
+            '#define PD_PROFILE_UNIT "ns"',
+            'typedef uint64_t pd_counter_t;',
+            'static inline pd_counter_t pd_counter(void) {',
+            '\tstruct timespec t;',
+            '\tclock_gettime(CLOCK_MONOTONIC, &t);',
+            '\treturn (pd_counter_t)t.tv_sec * 1000000000u + (pd_counter_t)t.tv_nsec;',
+            '}',
+            'static void pd_counter_enable(void) { }',
+            '#endif',
+            '',
+            'static uint64_t pd_profile_counts[%d];' % max(slot_count, 1),
+            'static uint64_t pd_profile_samples = 0;',
+            '',
+            '/* Adds the time since then to a slot, and returns the time now. */',
+            'static inline pd_counter_t pd_profile_add(int slot, pd_counter_t then) {',
+            '\tconst pd_counter_t now = pd_counter();',
+            '\tpd_profile_counts[slot] += (pd_counter_t)(now - then);',
+            '\treturn now;',
+            '}',
+            '',
+            ]
+
+def profile_dump_define(slot_count):
+    return ['/* Prints the profile, for profile_report.py. */',
+            'void profile_dump(FILE *f) {',
+            '\tint slot;',
+            '\tfprintf(f, "pd_profile unit %s\\n", PD_PROFILE_UNIT);',
+            '\tfprintf(f, "pd_profile samples %llu\\n", (unsigned long long)pd_profile_samples);',
+            '\tfor(slot=0; slot<%d; slot++) {' % slot_count,
+            '\t\tfprintf(f, "pd_profile slot %d %llu\\n", slot, (unsigned long long)pd_profile_counts[slot]);',
+            '\t}',
+            '}',
+            ]
+
+def profile_slot_map(slots):
+    """Describes the objects in each slot, for profile_report.py. A slot
+    is a list of objects, or a name for code that isn't an object's."""
+    result = []
+    for slot in slots:
+        if isinstance(slot, str):
+            result.append({'name': slot, 'objects': []})
+            continue
+        result.append({'name': ' '.join((object_name(o) for o in slot)),
+                       'objects': [{'id': o.id,
+                                    'name': object_name(o),
+                                    'file': getattr(o, 'file_name', None),
+                                    'line': getattr(o, 'line', None)} for o in slot]})
+    return result
+
+#######################################
+# Shared helper code.
+
+# Minimax odd polynomials for sin(2 * pi * t) over -0.25 <= t <= 0.25, with
+# their maximum error in exact arithmetic.
+cos_poly_coefficients = {
+    5: ((6.281280077e+00, -4.109524269e+01, 7.358551475e+01), 6.78e-05),
+    7: ((6.283164044e+00, -4.133714237e+01, 8.134076889e+01, -7.099343328e+01), 5.90e-07),
+    9: ((6.283185160e+00, -4.134165503e+01, 8.160100407e+01, -7.654978230e+01, 3.953670608e+01), 3.34e-09),
+}
+
+# Allowance for single-precision rounding in the table lookup or polynomial.
+float_rounding_error = 4.0 / (1 << 24)
+
+def cos_error_bound():
+    """Maximum absolute error of pd_cos() with the current options, or None
+    for libm."""
+    if options.trig == 'table':
+        # Linear interpolation error of cos(2 * pi * x) with a step of 1/N.
+        return math.pi ** 2 / (2.0 * options.cos_table_size ** 2) + float_rounding_error
+    elif options.trig == 'poly':
+        return cos_poly_coefficients[options.poly_degree][1] + float_rounding_error
+    else:
+        return None
+
+def _cos_table_declare():
+    size = options.cos_table_size
+    values = [float_str(math.cos(2.0 * math.pi * k / size)) for k in range(size + 1)]
+    lines = ['#define COS_TABLE_SIZE %d' % size,
+             'static const float pd_cos_table[COS_TABLE_SIZE + 1] = {',
+             ]
+    for k in range(0, len(values), 8):
+        lines.append('\t%s,' % ', '.join(values[k:k + 8]))
+    lines.extend(('};',
+                  '',
+                  '/* phase in cycles, 0 <= phase <= 1 */',
+                  'static inline float pd_cos(float phase) {',
+                  '\tconst float index = phase * COS_TABLE_SIZE;',
+                  '\tconst int i = (int)index;',
+                  '\tconst float fraction = index - i;',
+                  '\tconst float *p = &pd_cos_table[i & (COS_TABLE_SIZE - 1)];',
+                  '\treturn p[0] + fraction * (p[1] - p[0]);',
+                  '}',
+                  ))
+    return lines
+
+def _cos_poly_declare():
+    coefficients = cos_poly_coefficients[options.poly_degree][0]
+    horner = float_str(coefficients[-1])
+    for c in reversed(coefficients[:-1]):
+        horner = '%s + t2 * (%s)' % (float_str(c), horner)
+    return ['/* phase in cycles, 0 <= phase <= 1 */',
+            'static inline float pd_cos(float phase) {',
+            '\t/* cos(2 pi phase) == sin(2 pi t) */',
+            '\tconst float t = fabsf(phase - 0.5f) - 0.25f;',
+            '\tconst float t2 = t * t;',
+            '\treturn t * (%s);' % horner,
+            '}',
+            ]
+
+def _fixed_declare():
+    lines = []
+    for fmt in (numeric_formats['q15'], numeric_formats['q31']):
+        if fmt is not numeric_format():
+            continue
+        largest = (1 << (fmt.bits - 1)) - 1
+        lines.extend(('static inline %s %s(%s x) {' % (fmt.sample_type, fmt.saturate, fmt.wide_type),
+                      '\treturn (%s)((x < -%d%s - 1) ? -%d%s - 1 : (x > %d%s) ? %d%s : x);' % (
+                          fmt.sample_type, largest, fmt.literal_suffix, largest, fmt.literal_suffix,
+                          largest, fmt.literal_suffix, largest, fmt.literal_suffix),
+                      '}',
+                      '',
+                      'static inline %s %s(float x) {' % (fmt.sample_type, fmt.from_float),
+                      '\tif (!(x > %s)) return (%s)(-%d%s - 1);' % (float_str(-2.0 ** (fmt.bits - 1)),
+                          fmt.sample_type, largest, fmt.literal_suffix),
+                      '\tif (x >= %s) return %d%s;' % (float_str(2.0 ** (fmt.bits - 1)), largest, fmt.literal_suffix),
+                      '\treturn (%s)x;' % fmt.sample_type,
+                      '}',
+                      '',
+                      ))
+    return lines
+
+def _cos_fixed_declare():
+    fmt = numeric_format()
+    size = options.cos_table_size
+    table_bits = int(math.log(size, 2))
+    largest = (1 << (fmt.bits - 1)) - 1
+    values = ['%d' % int(round(math.cos(2.0 * math.pi * k / size) * largest)) for k in range(size + 1)]
+    lines = ['#define COS_TABLE_BITS %d' % table_bits,
+             'static const %s pd_cos_table_q%d[(1 << COS_TABLE_BITS) + 1] = {' % (fmt.sample_type, fmt.bits - 1),
+             ]
+    for k in range(0, len(values), 8):
+        lines.append('\t%s,' % ', '.join(values[k:k + 8]))
+    lines.extend(('};',
+                  '',
+                  '/* phase in 1/2**32 cycles, interpolated with 16 fraction bits */',
+                  'static inline %s %s(uint32_t phase) {' % (fmt.sample_type, fmt.cos),
+                  '\tconst %s *p = &pd_cos_table_q%d[phase >> (32 - COS_TABLE_BITS)];' % (fmt.sample_type, fmt.bits - 1),
+                  '\tconst %s fraction = (phase >> (16 - COS_TABLE_BITS)) & 0xffff;' % fmt.wide_type,
+                  '\treturn (%s)(p[0] + ((((%s)p[1] - p[0]) * fraction) >> 16));' % (fmt.sample_type, fmt.wide_type),
+                  '}',
+                  ))
+    return lines
+
+def _tabosc4_declare():
+    return ['/* 4-point interpolation at a position in points, in a table of mask + 1 points',
+            ' * plus three guard points, as in Pd\'s tabosc4~ */',
+            'static inline float pd_tabosc4(const float *table, int mask, float position) {',
+            '\tconst int i = (int)position;',
+            '\tconst float fraction = position - i;',
+            '\tconst float *p = &table[i & mask];',
+            '\tconst float a = p[0];',
+            '\tconst float b = p[1];',
+            '\tconst float c = p[2];',
+            '\tconst float d = p[3];',
+            '\tconst float cminusb = c - b;',
+            '\treturn b + fraction * (cminusb - 0.1666667f * (1.0f - fraction) *',
+            '\t\t((d - a - 3.0f * cminusb) + fraction * (d + 2.0f * a - 3.0f * b)));',
+            '}',
+            ]
+
+def support_declare(names):
+    lines = []
+    lines.extend(_table_declare())
+    if options.simd == 'gcc':
+        lines.extend(_vector_declare())
+        lines.append('')
+    if numeric_format().fixed:
+        lines.extend(_fixed_declare())
+    if 'cos_fixed' in names:
+        lines.extend(_cos_fixed_declare())
+        lines.append('')
+    if 'wrap_phase' in names:
+        lines.extend(('/* wraps a phase in cycles to 0 <= phase <= 1 */',
+                      'static inline float pd_wrap_phase(float phase) {',
+                      '\tphase -= (float)(int)phase;',
+                      '\treturn (phase < 0.0f) ? phase + 1.0f : phase;',
+                      '}',
+                      '',
+                      ))
+    if 'tabosc4' in names:
+        lines.extend(_tabosc4_declare())
+        lines.append('')
+    if 'cos' in names:
+        if options.trig == 'table':
+            lines.extend(_cos_table_declare())
+        else:
+            lines.extend(_cos_poly_declare())
+        lines.append('')
+    return tuple(lines)
@@ -0,0 +1,579 @@
+#!/usr/bin/env python
+
+# Runs a Pure Data (pd) object graph with NumPy, without generating C.
+#
+# Copyright (C) 2013 Jared Boone, ShareBrained Technology, Inc.
+#
+# This file is part of PD compiler.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# Each object processes a whole block with NumPy array operations, in the
+# order of the DSP chain. Signals are float32, as in the generated C code,
+# and follow its arithmetic, except that oscillator phases are kept in
+# float64 cycles and cosine is exact. That makes the output a reference
+# for the approximations the compiler can make (--trig, --numeric). Given
+# the --trig of float code, phases instead add up in float32 as that code
+# does, so the output follows it to within rounding.
+#
+# Messages and events follow the generated C code: the block is split at
+# events, and line~ and vline~ ramps add their increment in float32.
+
+import heapq
+import math
+import wave
+
+import numpy
+
+from pdom import *
+from dispatch import generic, when
+from emit_c import SAMPLING_RATE
+
+# start() returns the state an object starts out with, as a dict, or None
+# for objects without state. process() takes the object's state and a
+# float32 array of the block for each inlet (zeros for an unconnected
+# inlet), and returns an array for each outlet.
+
+@generic
+def start(o):
+    return None
+
+@generic
+def process(o, state, args):
+    raise Exception('%s is not supported by the interpreter' % object_name(o))
+
+# receive() handles a message to one of the object's inlets, and fire() one
+# of its events. A message is (selector, floats), with selector 'list' or
+# 'stop'; an event is (time, a, b).
+
+@generic
+def receive(o, interpreter, state, inlet, message):
+    pass
+
+@generic
+def fire(o, interpreter, state, event):
+    pass
+
+BANG = ('list', [])
+
+#######################################
+# Phases are in cycles. The phase for each sample of the block is the
+# phase at the start of the block plus the increments before it.
+#
+# With state['trig'] set, the phase is float32 and wraps each sample as in
+# float code compiled with that --trig: osc~ with libm keeps radians, and
+# wraps with fmodf() like phasor~ does; otherwise pd_wrap_phase() wraps
+# cycles.
+
+def _phase_start(o):
+    return {'phase': 0.0, 'trig': None}
+
+def _phases(state, frequency):
+    increments = frequency.astype(numpy.float64) / SAMPLING_RATE
+    offsets = numpy.cumsum(increments) - increments
+    phases = state['phase'] + offsets
+    end = phases[-1] + increments[-1] if len(phases) else state['phase']
+    state['phase'] = end - numpy.floor(end)
+    return phases - numpy.floor(phases)
+
+def _fmod_wrap(modulus):
+    return lambda phases: numpy.fmod(phases, modulus)
+
+def _cycles_wrap(phases):
+    phases = phases - numpy.trunc(phases)
+    return numpy.where(phases < 0.0, phases + numpy.float32(1.0), phases)
+
+def _float32_phases(state, frequency, wrap, scale=1.0):
+    """The float32 phase for each sample of the block. Between wraps the
+    phases are a running float32 sum, which add.accumulate() rounds one
+    sample at a time like the C code."""
+    increments = (frequency.astype(numpy.float64) * scale / SAMPLING_RATE).astype(numpy.float32)
+    n = len(increments)
+    phases = numpy.empty(n + 1, dtype=numpy.float32)
+    phases[0] = state['phase']
+    k = 0
+    while k < n:
+        run = numpy.add.accumulate(numpy.concatenate((phases[k:k + 1], increments[k:])))[1:]
+        wrapped = wrap(run)
+        changed = numpy.nonzero((wrapped != run) & ~numpy.isnan(run))[0]
+        end = n if not len(changed) else k + changed[0] + 1
+        phases[k + 1:end + 1] = run[:end - k]
+        phases[end] = wrapped[end - k - 1]
+        k = end
+    state['phase'] = phases[n]
+    return phases[:n]
+
+@when(start, AudioPhasor)
+def phasor_start(o):
+    return _phase_start(o)
+
+@when(process, AudioPhasor)
+def phasor_process(o, state, args):
+    if state['trig'] == 'libm':
+        return (_float32_phases(state, args[0], _fmod_wrap(numpy.float32(1.0))),
+                )
+    elif state['trig'] is not None:
+        return (_float32_phases(state, args[0], _cycles_wrap),
+                )
+    phases = _phases(state, args[0]).astype(numpy.float32)
+    # A phase just below 1 can round up to it in float32.
+    phases[phases >= 1.0] = 0.0
+    return (phases,
+            )
+
+@when(start, AudioOscillator)
+def osc_start(o):
+    return _phase_start(o)
+
+@when(process, AudioOscillator)
+def osc_process(o, state, args):
+    if state['trig'] == 'libm':
+        phases = _float32_phases(state, args[0], _fmod_wrap(numpy.float32(2.0 * math.pi)), 2.0 * math.pi)
+        return (numpy.cos(phases.astype(numpy.float64)).astype(numpy.float32),
+                )
+    elif state['trig'] is not None:
+        phases = _float32_phases(state, args[0], _cycles_wrap).astype(numpy.float64)
+    else:
+        phases = _phases(state, args[0])
+    return (numpy.cos(phases * 2.0 * numpy.pi).astype(numpy.float32),
+            )
+
+@when(start, AudioTableOscillator)
+def tabosc4_start(o):
+    return _phase_start(o)
+
+@when(process, AudioTableOscillator)
+def tabosc4_process(o, state, args):
+    values = numpy.asarray(o.array.values, dtype=numpy.float32)
+    points = len(values) - 3
+    if points < 1 or points & (points - 1):
+        raise Exception('object %d (%s): array %s has %d points, needs a power of two plus three' % (
+                        o.id, object_name(o), o.array.name, len(values)))
+    if state['trig'] is not None:
+        phases = _float32_phases(state, args[0], _cycles_wrap)
+    else:
+        phases = _phases(state, args[0])
+    position = (phases * points).astype(numpy.float32)
+    i = position.astype(numpy.int64)
+    fraction = position - i
+    i &= points - 1
+    a, b, c, d = values[i], values[i + 1], values[i + 2], values[i + 3]
+    cminusb = c - b
+    return (b + fraction * (cminusb - numpy.float32(0.1666667) * (1.0 - fraction) *
+                            ((d - a - 3.0 * cminusb) + fraction * (d + 2.0 * a - 3.0 * b))),
+            )
+
+# A float to the right inlet sets the phase, in cycles, or radians for the
+# float32 phase of osc~ with libm.
+
+def _phase_receive(state, message, radians=False):
+    if message[1]:
+        value = numpy.float32(message[1][0])
+        cycles = value - numpy.floor(value)
+        if state['trig'] is None:
+            state['phase'] = float(cycles)
+        elif radians and state['trig'] == 'libm':
+            state['phase'] = numpy.float32(float(cycles * numpy.float32(2.0)) * math.pi)
+        else:
+            state['phase'] = cycles
+
+@when(receive, AudioPhasor)
+def phasor_receive(o, interpreter, state, inlet, message):
+    _phase_receive(state, message)
+
+@when(receive, AudioOscillator)
+def osc_receive(o, interpreter, state, inlet, message):
+    _phase_receive(state, message, True)
+
+@when(receive, AudioTableOscillator)
+def tabosc4_receive(o, interpreter, state, inlet, message):
+    _phase_receive(state, message)
+
+#######################################
+# Ramps, as in emit_c: a whole number of samples, each adding the
+# increment to the last, ending exactly on the target.
+
+def _samples_per_ms():
+    return numpy.float32(SAMPLING_RATE) / numpy.float32(1000.0)
+
+def _ramp_start(o):
+    return {'value': numpy.float32(0.0), 'increment': numpy.float32(0.0), 'target': numpy.float32(0.0),
+            'remaining': 0, 'time': numpy.float32(0.0), 'delay': numpy.float32(0.0)}
+
+def _ramp(state, target, ms):
+    target = numpy.float32(target)
+    samples = numpy.float32(ms) * _samples_per_ms()
+    if not samples >= 0.5:
+        state['value'] = target
+        state['remaining'] = 0
+        return
+    count = int(samples + numpy.float32(0.5)) if samples < 1.0e9 else 1000000000
+    state['target'] = target
+    state['increment'] = (target - state['value']) / numpy.float32(count)
+    state['remaining'] = count
+
+def _ramp_process(o, state, args):
+    n = len(args[0])
+    steps = min(state['remaining'], n)
+    out = numpy.empty(n, dtype=numpy.float32)
+    increments = numpy.full(steps + 1, state['increment'], dtype=numpy.float32)
+    increments[0] = state['value']
+    values = numpy.add.accumulate(increments)
+    out[:steps] = values[:steps]
+    state['remaining'] -= steps
+    if steps and not state['remaining']:
+        state['value'] = state['target']
+    else:
+        state['value'] = values[steps]
+    out[steps:] = state['value']
+    return (out,
+            )
+
+def _ramp_receive(o, interpreter, state, inlet, message):
+    """line~'s messages, and the time and delay inlets of vline~."""
+    selector, floats = message
+    if inlet > 0:
+        if floats:
+            state['delay' if inlet == 2 else 'time'] = numpy.float32(floats[0])
+    elif selector == 'stop':
+        state['remaining'] = 0
+    elif floats:
+        ms = floats[1] if len(floats) > 1 else state['time']
+        state['time'] = numpy.float32(0.0)
+        _ramp(state, floats[0], ms)
+
+@when(start, AudioLine)
+def line_start(o):
+    return _ramp_start(o)
+
+@when(process, AudioLine)
+def line_process(o, state, args):
+    return _ramp_process(o, state, args)
+
+@when(receive, AudioLine)
+def line_receive(o, interpreter, state, inlet, message):
+    _ramp_receive(o, interpreter, state, inlet, message)
+
+@when(start, AudioVLine)
+def vline_start(o):
+    return _ramp_start(o)
+
+@when(process, AudioVLine)
+def vline_process(o, state, args):
+    return _ramp_process(o, state, args)
+
+@when(receive, AudioVLine)
+def vline_receive(o, interpreter, state, inlet, message):
+    selector, floats = message
+    if inlet > 0:
+        _ramp_receive(o, interpreter, state, inlet, message)
+    elif selector == 'stop':
+        interpreter.cancel(o, 0.0)
+        state['remaining'] = 0
+    elif floats:
+        ms = numpy.float32(floats[1] if len(floats) > 1 else state['time'])
+        delay = numpy.float32(floats[2] if len(floats) > 2 else state['delay'])
+        due = interpreter.time + float(delay * _samples_per_ms())
+        state['time'] = numpy.float32(0.0)
+        state['delay'] = numpy.float32(0.0)
+        # A new ramp cancels those due at or after its start.
+        interpreter.cancel(o, due)
+        if not due > interpreter.elapsed:
+            _ramp(state, floats[0], ms)
+        else:
+            interpreter.push(due, o, floats[0], ms)
+
+@when(fire, AudioVLine)
+def vline_fire(o, interpreter, state, event):
+    _ramp(state, event[1], event[2])
+
+@when(start, FloatInlet)
+def float_inlet_start(o):
+    return {'value': numpy.float32(o.value)}
+
+@when(process, FloatInlet)
+def float_inlet_process(o, state, args):
+    return (numpy.full(len(args[0]), state['value'], dtype=numpy.float32),
+            )
+
+@when(receive, FloatInlet)
+def float_inlet_receive(o, interpreter, state, inlet, message):
+    if message[1]:
+        state['value'] = numpy.float32(message[1][0])
+
+#######################################
+# Control objects.
+
+def _metro_interval(ms):
+    samples = numpy.float32(ms) * _samples_per_ms()
+    return samples if samples > 1.0 else numpy.float32(1.0)
+
+def _metro_tick(o, interpreter, state, time):
+    state['hit'] = False
+    interpreter.send(o, 0, BANG)
+    # Unless the bang turned the metro off, or on again.
+    if not state['hit'] and state['running']:
+        interpreter.push(time + float(state['interval']), o)
+
+@when(start, Metro)
+def metro_start(o):
+    return {'running': False, 'hit': False, 'interval': _metro_interval(o.interval)}
+
+@when(receive, Metro)
+def metro_receive(o, interpreter, state, inlet, message):
+    selector, floats = message
+    if inlet == 1:
+        if floats:
+            state['interval'] = _metro_interval(floats[0])
+        return
+    interpreter.cancel(o, 0.0)
+    state['hit'] = True
+    if selector == 'stop' or (floats and floats[0] == 0.0):
+        state['running'] = False
+    else:
+        state['running'] = True
+        _metro_tick(o, interpreter, state, interpreter.time)
+
+@when(fire, Metro)
+def metro_fire(o, interpreter, state, event):
+    _metro_tick(o, interpreter, state, event[0])
+
+@when(receive, Message)
+def message_receive(o, interpreter, state, inlet, message):
+    floats = message[1]
+    for selector, atoms in o.messages():
+        values = []
+        for atom in atoms:
+            if isinstance(atom, DollarArgument):
+                atom = floats[atom.n - 1] if len(floats) >= atom.n else 0.0
+            values.append(numpy.float32(atom))
+        interpreter.send(o, 0, (selector, values))
+
+#######################################
+@when(process, AudioAdd)
+def add_process(o, state, args):
+    return (args[0] + args[1],
+            )
+
+@when(process, AudioSubtract)
+def subtract_process(o, state, args):
+    return (args[0] - args[1],
+            )
+
+@when(process, AudioMultiply)
+def multiply_process(o, state, args):
+    return (args[0] * args[1],
+            )
+
+@when(process, AudioDivide)
+def divide_process(o, state, args):
+    return (args[0] / args[1],
+            )
+
+@when(process, AudioMaximum)
+def max_process(o, state, args):
+    return (numpy.fmax(args[0], args[1]),
+            )
+
+@when(process, AudioMinimum)
+def min_process(o, state, args):
+    return (numpy.fmin(args[0], args[1]),
+            )
+
+@when(process, AudioPower)
+def pow_process(o, state, args):
+    return (numpy.power(args[0], args[1]),
+            )
+
+@when(process, AudioLogarithm)
+def log_process(o, state, args):
+    if o._in2.source:
+        return (numpy.log(args[0]) / numpy.log(args[1]),
+                )
+    return (numpy.log(args[0]),
+            )
+
+#######################################
+@when(process, AudioCosine)
+def cos_process(o, state, args):
+    return (numpy.cos(args[0].astype(numpy.float64) * 2.0 * numpy.pi).astype(numpy.float32),
+            )
+
+@when(process, AudioAbsolute)
+def abs_process(o, state, args):
+    return (numpy.abs(args[0]),
+            )
+
+@when(process, AudioExponent)
+def exp_process(o, state, args):
+    return (numpy.exp(args[0]),
+            )
+
+@when(process, AudioSignal)
+def sig_process(o, state, args):
+    return (args[0],
+            )
+
+@when(process, AudioWrap)
+def wrap_process(o, state, args):
+    # Same arithmetic as the generated C code.
+    x = args[0]
+    k = numpy.trunc(x)
+    return (numpy.where(x > 0.0, x - k, x - (k - 1.0)),
+            )
+
+@when(process, AudioClip)
+def clip_process(o, state, args):
+    x, lo, hi = args
+    return (numpy.where(x < lo, lo, numpy.where(x > hi, hi, x)),
+            )
+
+@when(process, AudioTableRead)
+def tabread_process(o, state, args):
+    values = numpy.asarray(o.array.values, dtype=numpy.float32)
+    if not len(values):
+        return (numpy.zeros_like(args[0]),
+                )
+    # Clip before truncating, so that huge or NaN indexes don't overflow.
+    index = numpy.nan_to_num(numpy.clip(args[0], 0.0, len(values) - 1))
+    return (values[index.astype(numpy.int64)],
+            )
+
+#######################################
+
+class Interpreter(object):
+    """Runs a DSP chain, as returned by dsp_chain(), a block at a time.
+    dac~ objects add into the output channels they name, as with the
+    interleaved and planar dac~ backends of the compiler. objects are the
+    patch's objects, for its control objects; without them, no messages
+    are sent. Times are in samples, and at most event_queue_size events are
+    pending, as in the generated C code. With trig, one of the compiler's
+    --trig choices, oscillator phases add up in float32 as in float code
+    compiled with it; without, they are exact."""
+    def __init__(self, chain, objects=(), event_queue_size=64, trig=None):
+        self.chain = [o for o in chain if not isinstance(o, AudioDAC)]
+        self.dacs = [o for o in chain if isinstance(o, AudioDAC)]
+        self.channels = max([max(o.channels) for o in self.dacs] or [2])
+        self.control_objects = [o for o in objects if isinstance(o, ControlObject)]
+        self.event_queue_size = event_queue_size
+        self.trig = trig
+        self.reset()
+
+    def reset(self):
+        """Returns every object to its starting state, and sends the bang
+        of each loadbang."""
+        self.states = dict(((o, start(o)) for o in self.chain + self.control_objects))
+        for state in self.states.values():
+            if state is not None and 'trig' in state:
+                state['trig'] = self.trig
+                if self.trig is not None:
+                    state['phase'] = numpy.float32(state['phase'])
+        self.elapsed = 0.0
+        self.time = 0.0
+        self.events = []
+        self.order = 0
+        self.overflows = 0
+        for o in self.control_objects:
+            if isinstance(o, LoadBang):
+                self.send(o, 0, BANG)
+
+    def send(self, o, outlet_id, message):
+        """Sends a message from an outlet to each connected inlet in turn.
+        Objects that aren't in the chain don't get it."""
+        for inlet in o.outlet[outlet_id].targets:
+            target = inlet.parent
+            if target in self.states:
+                receive(target, self, self.states[target], inlet.id, message)
+
+    def push(self, time, o, a=0.0, b=0.0):
+        if len(self.events) == self.event_queue_size:
+            self.overflows += 1
+            return
+        heapq.heappush(self.events, (time, self.order, o, numpy.float32(a), numpy.float32(b)))
+        self.order += 1
+
+    def cancel(self, o, after):
+        """Removes the events of o due at or after a time."""
+        events = [e for e in self.events if e[2] is not o or e[0] < after]
+        if len(events) != len(self.events):
+            heapq.heapify(events)
+            self.events = events
+
+    def _inlet_block(self, inlet, outputs, n):
+        source = inlet.source
+        if isinstance(source, ConstantOutlet):
+            return numpy.full(n, source.value, dtype=numpy.float32)
+        elif source is None or source not in outputs:
+            return numpy.zeros(n, dtype=numpy.float32)
+        return outputs[source]
+
+    def tick(self, n):
+        """Processes n samples, and returns them as an array of n frames of
+        self.channels channels. Events that are due fire before the samples
+        after them."""
+        parts = []
+        start = 0
+        while start < n:
+            end = n
+            while self.events and self.events[0][0] <= self.elapsed:
+                time, order, o, a, b = heapq.heappop(self.events)
+                self.time = time
+                fire(o, self, self.states[o], (time, a, b))
+            self.time = self.elapsed
+            if self.events and self.events[0][0] < self.elapsed + (n - start):
+                end = start + int(math.ceil(self.events[0][0] - self.elapsed))
+            parts.append(self._tick(end - start))
+            self.elapsed += end - start
+            start = end
+        if not parts:
+            return self._tick(0)
+        return numpy.concatenate(parts)
+
+    def _tick(self, n):
+        outputs = {}
+        with numpy.errstate(all='ignore'):
+            for o in self.chain:
+                args = [self._inlet_block(inlet, outputs, n) for inlet in o.inlet]
+                for outlet, block in zip(o.outlet, process(o, self.states[o], args)):
+                    outputs[outlet] = numpy.asarray(block, dtype=numpy.float32)
+        frames = numpy.zeros((n, self.channels), dtype=numpy.float32)
+        for o in self.dacs:
+            for channel, inlet in zip(o.channels, o.inlet):
+                if inlet.source:
+                    frames[:, channel - 1] += self._inlet_block(inlet, outputs, n)
+        return frames
+
+    def render(self, samples, block_size=1024):
+        """Processes samples samples, block_size at a time, and returns them
+        as an array of frames."""
+        blocks = [self.tick(min(block_size, samples - k)) for k in range(0, samples, block_size)]
+        if not blocks:
+            return numpy.zeros((0, self.channels), dtype=numpy.float32)
+        return numpy.concatenate(blocks)
+
+def write_wav(path, frames):
+    """Writes frames as 16-bit PCM, with full scale at 1.0."""
+    pcm = numpy.clip(numpy.round(frames * 32767.0), -32768, 32767).astype('<i2')
+    output_file = wave.open(path, 'wb')
+    output_file.setnchannels(frames.shape[1])
+    output_file.setsampwidth(2)
+    output_file.setframerate(int(SAMPLING_RATE))
+    output_file.writeframes(pcm.tobytes())
+    output_file.close()
+
+def write_f32(path, frames):
+    """Writes frames as interleaved 32-bit floats, like main.c's out.f32."""
+    frames.astype('<f4').tofile(path)
@@ -22,18 +22,157 @@
  */
 
 #include <stdio.h>
+#include <stdlib.h>
+#include <stdint.h>
 
+/* Output is collected into chunks of this many frames before writing. */
+#define CHUNK_FRAMES 4096
+
+extern const int dsp_block_size;
+extern const int dsp_output_channels;
+extern const int dsp_output_planar;
+
+/* Define PATCH_Q15 or PATCH_Q31 for code generated with --numeric=q15 or
+ * --numeric=q31. Output is converted to float for out.f32. */
+#if defined(PATCH_Q15)
+typedef int16_t sample_t;
+#define SAMPLE_TO_FLOAT(x) ((float)(x) * (1.0f / 32768.0f))
+#elif defined(PATCH_Q31)
+typedef int32_t sample_t;
+#define SAMPLE_TO_FLOAT(x) ((float)(x) * (1.0f / 2147483648.0f))
+#else
+typedef float sample_t;
+#define SAMPLE_TO_FLOAT(x) (x)
+#define SAMPLE_IS_FLOAT
+#endif
+
+/* Define PATCH_STATE_STRUCT for code generated with --state=struct. */
+#ifdef PATCH_STATE_STRUCT
+typedef struct patch_state patch_state_t;
+extern const size_t patch_state_size;
+
+extern void init(patch_state_t *state);
+extern void dsptick(patch_state_t *state, sample_t *out, int n);
+extern void deinit(patch_state_t *state);
+
+static patch_state_t *state = NULL;
+#define PATCH_INIT() init(state)
+#define PATCH_DSPTICK(out, n) dsptick(state, out, n)
+#define PATCH_DEINIT() deinit(state)
+#else
 extern void init();
-extern void dsptick();
+extern void dsptick(sample_t *out, int n);
 extern void deinit();
 
+#define PATCH_INIT() init()
+#define PATCH_DSPTICK(out, n) dsptick(out, n)
+#define PATCH_DEINIT() deinit()
+#endif
+
+/* Define PATCH_THREADS for code generated with --partitions, and build
+ * with dsp_threads.c and -pthread, to run the partitions on threads. */
+#ifdef PATCH_THREADS
+extern int dsp_threads_start(void);
+extern void dsp_threads_stop(void);
+#undef PATCH_DSPTICK
+#ifdef PATCH_STATE_STRUCT
+extern void dsp_threads_dsptick(patch_state_t *state, sample_t *out, int n);
+#define PATCH_DSPTICK(out, n) dsp_threads_dsptick(state, out, n)
+#else
+extern void dsp_threads_dsptick(sample_t *out, int n);
+#define PATCH_DSPTICK(out, n) dsp_threads_dsptick(out, n)
+#endif
+#endif
+
+/* Define PATCH_PROFILE for code generated with --profile. The profile is
+ * printed to stdout, for profile_report.py. */
+#ifdef PATCH_PROFILE
+extern void profile_dump(FILE *f);
+#endif
+
 int main(int argc, char* argv[]) {
     int i=0;
+    int n=0;
+    int c=0;
+    int j=0;
+    const int total = 44100 * 3;
+    const int channels = dsp_output_channels;
+    const int chunk_frames = (dsp_block_size > CHUNK_FRAMES) ? dsp_block_size : CHUNK_FRAMES;
+    float *chunk = NULL;
+    sample_t *block = NULL;
+    FILE *out_file = NULL;
+    int frames = 0;
+
+    /* With the file backend (no output channels), each dac~ writes its
+     * own dac_<id>.f32 file. Otherwise the output buffer is written to
+     * out.f32, interleaved. */
+    if(channels > 0) {
+        chunk = malloc(sizeof(float) * chunk_frames * channels);
+        block = malloc(sizeof(sample_t) * dsp_block_size * channels);
+        out_file = fopen("out.f32", "wb");
+        if(chunk == NULL || block == NULL || out_file == NULL) {
+            fprintf(stderr, "unable to set up output\n");
+            return 1;
+        }
+    }
+
+#ifdef PATCH_STATE_STRUCT
+    state = malloc(patch_state_size);
+    if(state == NULL) {
+        fprintf(stderr, "unable to allocate patch state\n");
+        return 1;
+    }
+#endif
+
+    PATCH_INIT();
+#ifdef PATCH_THREADS
+    if(dsp_threads_start() != 0) {
+        fprintf(stderr, "unable to start threads\n");
+        return 1;
+    }
+#endif
+    for(i=0; i<total; i+=n) {
+        n = (total - i < dsp_block_size) ? (total - i) : dsp_block_size;
+        if(channels == 0) {
+            PATCH_DSPTICK(NULL, n);
+            continue;
+        }
+        if(frames + n > chunk_frames) {
+            fwrite(chunk, sizeof(float) * channels, frames, out_file);
+            frames = 0;
+        }
+#ifdef SAMPLE_IS_FLOAT
+        if(!dsp_output_planar) {
+            PATCH_DSPTICK(&chunk[frames * channels], n);
+            frames += n;
+            continue;
+        }
+#endif
+        PATCH_DSPTICK(block, n);
+        for(c=0; c<channels; c++) {
+            for(j=0; j<n; j++) {
+                const sample_t x = dsp_output_planar ? block[c * n + j] : block[j * channels + c];
+                chunk[(frames + j) * channels + c] = SAMPLE_TO_FLOAT(x);
+            }
+        }
+        frames += n;
+    }
+#ifdef PATCH_THREADS
+    dsp_threads_stop();
+#endif
+    PATCH_DEINIT();
+#ifdef PATCH_PROFILE
+    profile_dump(stdout);
+#endif
 
-    init();
-    for(i=0; i<44100 * 3; i++) {
-        dsptick();
+#ifdef PATCH_STATE_STRUCT
+    free(state);
+#endif
+    if(channels > 0) {
+        fwrite(chunk, sizeof(float) * channels, frames, out_file);
+        fclose(out_file);
+        free(block);
+        free(chunk);
     }
-    deinit();
     return 0;
 }
@@ -0,0 +1,605 @@
+#!/usr/bin/env python
+
+# Optimization passes over the Pure Data (pd) object graph.
+# 
+# Copyright (C) 2013 Jared Boone, ShareBrained Technology, Inc.
+# 
+# This file is part of PD compiler.
+# 
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import math
+import struct
+
+from pdom import *
+from dispatch import generic, when
+
+def float32(value):
+    return struct.unpack('f', struct.pack('f', value))[0]
+
+#######################################
+# evaluate() computes an object's output at compile time from the values
+# of its inlets (None for an unconnected inlet). Objects with state, or
+# that can't be evaluated, return None.
+
+@generic
+def evaluate(o, args):
+    return None
+
+#######################################
+@when(evaluate, AudioAdd)
+def add_evaluate(o, args):
+    return args[0] + args[1]
+
+@when(evaluate, AudioSubtract)
+def subtract_evaluate(o, args):
+    return args[0] - args[1]
+
+@when(evaluate, AudioMultiply)
+def multiply_evaluate(o, args):
+    return args[0] * args[1]
+
+@when(evaluate, AudioDivide)
+def divide_evaluate(o, args):
+    return args[0] / args[1]
+
+#######################################
+@when(evaluate, AudioCosine)
+def cos_evaluate(o, args):
+    return math.cos(args[0] * 2.0 * math.pi)
+
+@when(evaluate, AudioAbsolute)
+def abs_evaluate(o, args):
+    return abs(args[0])
+
+@when(evaluate, AudioExponent)
+def exp_evaluate(o, args):
+    return math.exp(args[0])
+
+@when(evaluate, AudioSignal)
+def sig_evaluate(o, args):
+    return args[0]
+
+@when(evaluate, AudioWrap)
+def wrap_evaluate(o, args):
+    # Same arithmetic as the generated C code.
+    x = args[0]
+    if x > 0.0:
+        return x - int(x)
+    else:
+        return x - (int(x) - 1.0)
+
+#######################################
+@when(evaluate, AudioMaximum)
+def max_evaluate(o, args):
+    return max(args[0], args[1])
+
+@when(evaluate, AudioMinimum)
+def min_evaluate(o, args):
+    return min(args[0], args[1])
+
+@when(evaluate, AudioPower)
+def pow_evaluate(o, args):
+    return math.pow(args[0], args[1])
+
+#######################################
+@when(evaluate, AudioClip)
+def clip_evaluate(o, args):
+    i, lo, hi = args
+    if i < lo:
+        return lo
+    elif i > hi:
+        return hi
+    else:
+        return i
+
+@when(evaluate, AudioLogarithm)
+def log_evaluate(o, args):
+    if args[1] is None:
+        return math.log(args[0])
+    else:
+        return math.log(args[0]) / math.log(args[1])
+
+@when(evaluate, AudioTableRead)
+def tabread_evaluate(o, args):
+    values = o.array.values
+    if not values:
+        return 0.0
+    index = int(args[0] or 0.0)
+    return values[min(max(index, 0), len(values) - 1)]
+
+# Objects that take messages only have a value of their own if no message
+# ever reaches them.
+
+@when(evaluate, FloatInlet)
+def float_inlet_evaluate(o, args):
+    return None if o.receives_messages else o.value
+
+@when(evaluate, AudioLine)
+def line_evaluate(o, args):
+    return None if o.receives_messages else 0.0
+
+@when(evaluate, AudioVLine)
+def vline_evaluate(o, args):
+    return None if o.receives_messages else 0.0
+
+#######################################
+# simplify() recognizes algebraic identities. It returns the source that
+# can replace the object's output and a description of the identity, or
+# None if the object does useful work.
+
+@generic
+def simplify(o):
+    return None
+
+def is_constant(inlet, value):
+    source = inlet.source
+    return isinstance(source, ConstantOutlet) and float32(source.value) == value
+
+def _commutative_identity(o, identity, identity_name):
+    for x, y in ((o._in1, o._in2), (o._in2, o._in1)):
+        if is_constant(y, identity) and x.source:
+            return x.source, identity_name
+    return None
+
+def _right_identity(o, identity, identity_name):
+    if is_constant(o._in2, identity) and o._in1.source:
+        return o._in1.source, identity_name
+    return None
+
+@when(simplify, AudioAdd)
+def add_simplify(o):
+    return _commutative_identity(o, 0.0, 'add zero')
+
+@when(simplify, AudioSubtract)
+def subtract_simplify(o):
+    return _right_identity(o, 0.0, 'subtract zero')
+
+@when(simplify, AudioMultiply)
+def multiply_simplify(o):
+    if is_constant(o._in1, 0.0) or is_constant(o._in2, 0.0):
+        return ConstantOutlet(0.0), 'multiply by zero'
+    return _commutative_identity(o, 1.0, 'multiply by one')
+
+@when(simplify, AudioDivide)
+def divide_simplify(o):
+    return _right_identity(o, 1.0, 'divide by one')
+
+@when(simplify, AudioPower)
+def pow_simplify(o):
+    return _right_identity(o, 1.0, 'power of one')
+
+@when(simplify, AudioSignal)
+def sig_simplify(o):
+    if isinstance(o._in.source, Outlet):
+        return o._in.source, 'signal pass-through'
+    return None
+
+#######################################
+# value_range() gives the interval (lo, hi) that an object's output stays
+# within, from the intervals of its inlets. Unconnected inlets are (0, 0)
+# and unbounded ones are (-inf, inf). It returns None if the output is
+# unbounded. These ranges choose the scaling of fixed-point signals; a clip~
+# bounds a signal whose range can't be worked out.
+
+@generic
+def value_range(o, args):
+    return None
+
+def _hull(values):
+    return (min(values), max(values))
+
+@when(value_range, AudioAdd)
+def add_range(o, args):
+    a, b = args
+    return (a[0] + b[0], a[1] + b[1])
+
+@when(value_range, AudioSubtract)
+def subtract_range(o, args):
+    a, b = args
+    return (a[0] - b[1], a[1] - b[0])
+
+@when(value_range, AudioMultiply)
+def multiply_range(o, args):
+    a, b = args
+    return _hull([x * y for x in a for y in b])
+
+@when(value_range, AudioDivide)
+def divide_range(o, args):
+    a, b = args
+    if b[0] <= 0.0 <= b[1]:
+        return None
+    return _hull([x / y for x in a for y in b])
+
+@when(value_range, AudioOscillator)
+def osc_range(o, args):
+    return (-1.0, 1.0)
+
+@when(value_range, AudioPhasor)
+def phasor_range(o, args):
+    return (0.0, 1.0)
+
+@when(value_range, AudioCosine)
+def cos_range(o, args):
+    return (-1.0, 1.0)
+
+@when(value_range, AudioAbsolute)
+def abs_range(o, args):
+    lo, hi = args[0]
+    if lo >= 0.0:
+        return (lo, hi)
+    elif hi <= 0.0:
+        return (-hi, -lo)
+    else:
+        return (0.0, max(-lo, hi))
+
+@when(value_range, AudioExponent)
+def exp_range(o, args):
+    return (math.exp(args[0][0]), math.exp(args[0][1]))
+
+@when(value_range, AudioSignal)
+def sig_range(o, args):
+    return args[0]
+
+@when(value_range, AudioWrap)
+def wrap_range(o, args):
+    return (0.0, 1.0)
+
+@when(value_range, AudioMaximum)
+def max_range(o, args):
+    a, b = args
+    return (max(a[0], b[0]), max(a[1], b[1]))
+
+@when(value_range, AudioMinimum)
+def min_range(o, args):
+    a, b = args
+    return (min(a[0], b[0]), min(a[1], b[1]))
+
+@when(value_range, AudioPower)
+def pow_range(o, args):
+    a, b = args
+    if a[0] < 0.0:
+        return None
+    # x ** y is monotonic in each argument, so the corners are the extremes.
+    return _hull([x ** y for x in a for y in b])
+
+@when(value_range, AudioClip)
+def clip_range(o, args):
+    i, lo, hi = args
+    if lo[0] == lo[1] and hi[0] == hi[1] and lo[0] <= hi[0]:
+        return (min(max(i[0], lo[0]), hi[0]), min(max(i[1], lo[0]), hi[0]))
+    return _hull(i + lo + hi)
+
+def _table_range(values):
+    if not values:
+        return (0.0, 0.0)
+    return (min(values), max(values))
+
+@when(value_range, AudioTableRead)
+def tabread_range(o, args):
+    return _table_range(o.array.values)
+
+@when(value_range, AudioTableOscillator)
+def tabosc4_range(o, args):
+    # 4-point interpolation can overshoot the points by up to a quarter.
+    lo, hi = _table_range(o.array.values)
+    bound = 1.25 * max(-lo, hi)
+    return (-bound, bound)
+
+# A float inlet or ramp stays between its starting value and the floats
+# that messages can send it, unless those are only known at run time.
+
+def _received_range(o, value):
+    if o.received_floats is None:
+        return None
+    values = [value] + list(o.received_floats)
+    return (min(values), max(values))
+
+@when(value_range, FloatInlet)
+def float_inlet_range(o, args):
+    return _received_range(o, o.value)
+
+@when(value_range, AudioLine)
+def line_range(o, args):
+    return _received_range(o, 0.0)
+
+@when(value_range, AudioVLine)
+def vline_range(o, args):
+    return _received_range(o, 0.0)
+
+@when(value_range, AudioLogarithm)
+def log_range(o, args):
+    a, b = args
+    if a[0] <= 0.0:
+        return None
+    if o._in2.source is None:
+        return (math.log(a[0]), math.log(a[1]))
+    if b[0] <= 0.0 or b[0] <= 1.0 <= b[1]:
+        return None
+    return _hull([math.log(x) / math.log(y) for x in a for y in b])
+
+#######################################
+# rate() gives how often an object's output can change, from the rates of
+# its inlets: 'constant' never, 'block' only between blocks, and 'sample'
+# from one sample to the next. Unconnected inlets are constant. An object
+# without state changes only when its inputs do; oscillators and ramps
+# change every sample whatever their inputs. A float inlet changes when a
+# message arrives, and dsptick() handles messages between blocks (or the
+# parts of a block between events).
+
+rates = ('constant', 'block', 'sample')
+
+@generic
+def rate(o, args):
+    return max(args or ['constant'], key=rates.index)
+
+@when(rate, AudioPhasor)
+def phasor_rate(o, args):
+    return 'sample'
+
+@when(rate, AudioOscillator)
+def osc_rate(o, args):
+    return 'sample'
+
+@when(rate, AudioTableOscillator)
+def tabosc4_rate(o, args):
+    return 'sample'
+
+@when(rate, AudioLine)
+def line_rate(o, args):
+    return 'sample'
+
+@when(rate, AudioVLine)
+def vline_rate(o, args):
+    return 'sample'
+
+@when(rate, FloatInlet)
+def float_inlet_rate(o, args):
+    return 'block'
+
+#######################################
+# Rough per-sample cost of each object on a Cortex-M4F, in cycles. Used to
+# estimate the savings of optimization passes.
+
+estimated_cycles = {
+    AudioDAC: 4,
+    AudioPhasor: 30,
+    AudioOscillator: 80,
+    AudioAdd: 3,
+    AudioSubtract: 3,
+    AudioMultiply: 3,
+    AudioDivide: 16,
+    AudioMaximum: 4,
+    AudioMinimum: 4,
+    AudioAbsolute: 3,
+    AudioExponent: 50,
+    AudioWrap: 8,
+    AudioPower: 100,
+    AudioLogarithm: 50,
+    AudioCosine: 50,
+    AudioSignal: 2,
+    AudioClip: 6,
+    AudioTableRead: 6,
+    AudioTableOscillator: 40,
+    AudioLine: 6,
+    AudioVLine: 6,
+    FloatInlet: 1,
+}
+
+def cycles(o):
+    return estimated_cycles.get(o.__class__, 0)
+
+#######################################
+def constant_value(o):
+    args = []
+    for inlet in o.inlet:
+        source = inlet.source
+        if isinstance(source, ConstantOutlet):
+            args.append(float32(source.value))
+        elif source is None:
+            args.append(None)
+        else:
+            return None
+    try:
+        value = evaluate(o, args)
+    except (TypeError, ValueError, ArithmeticError):
+        # Unconnected inlets (None) and results with no float value.
+        return None
+    if value is None or math.isinf(value) or math.isnan(value):
+        return None
+    return float32(value)
+
+# Objects whose first two inlets can be swapped without changing the output.
+commutative = (AudioAdd, AudioMultiply, AudioMaximum, AudioMinimum)
+
+def source_key(source):
+    if isinstance(source, ConstantOutlet):
+        return ('constant', float32(source.value))
+    elif isinstance(source, Outlet):
+        return ('outlet', id(source.parent), source.id)
+    else:
+        return None
+
+def structure_key(o):
+    """Two objects with the same key compute the same output, including
+    objects with state, which start out the same and see the same input.
+    Objects that receive messages have a key of their own."""
+    inlets = [source_key(inlet.source) for inlet in o.inlet]
+    if isinstance(o, commutative):
+        # Unconnected inlets (None) sort last.
+        inlets[:2] = sorted(inlets[:2], key=lambda key: (key is None, key))
+    # Table objects must also read the same array.
+    return (o.__class__, tuple(inlets), id(getattr(o, 'array', None)),
+            id(o) if o.receives_messages else None)
+
+def consumers(chain):
+    result = {}
+    for o in chain:
+        for inlet in o.inlet:
+            if isinstance(inlet.source, Outlet):
+                result.setdefault(inlet.source, []).append(inlet)
+    return result
+
+def optimize_chain(chain):
+    """Fold objects whose output only depends on constants, bypass
+    objects that compute an algebraic identity and merge objects that
+    duplicate an earlier one. The chain must be in dependency order. The
+    consumers of each removed object are fed a ConstantOutlet, the
+    object's own input or the earlier object's outlet instead, so removed
+    objects (and anything feeding only them) drop out when the chain is
+    rebuilt. Returns a list of (object, reason) for the removed objects."""
+    outlet_consumers = consumers(chain)
+    canonical = {}
+    removed = []
+    for o in chain:
+        if not o.outlet:
+            continue
+        value = constant_value(o)
+        identity = simplify(o) if value is None else None
+        if value is not None:
+            replacements, reason = (ConstantOutlet(value),), 'constant %g' % value
+        elif identity is not None:
+            replacements, reason = (identity[0],), identity[1]
+        else:
+            key = structure_key(o)
+            original = canonical.setdefault(key, o)
+            if original is o:
+                continue
+            replacements, reason = original.outlet, 'duplicate of object %d' % original.id
+        for outlet, replacement in zip(o.outlet, replacements):
+            for inlet in outlet_consumers.get(outlet, ()):
+                inlet.source = replacement
+        removed.append((o, reason))
+    return removed
+
+def signal_ranges(chain):
+    """Range of values of each outlet in the chain, as (lo, hi), or None
+    where the range is unbounded. The chain must be in dependency order."""
+    unbounded = (float('-inf'), float('inf'))
+    ranges = {}
+    for o in chain:
+        if not o.outlet:
+            continue
+        args = []
+        for inlet in o.inlet:
+            source = inlet.source
+            if isinstance(source, ConstantOutlet):
+                args.append((source.value, source.value))
+            elif isinstance(source, Outlet):
+                args.append(ranges.get(source) or unbounded)
+            else:
+                args.append((0.0, 0.0))
+        try:
+            result = value_range(o, args)
+        except (ValueError, ArithmeticError):
+            result = None
+        if result is not None and not all((abs(x) < float('inf') for x in result)):
+            # Also catches NaN.
+            result = None
+        ranges[o.outlet[0]] = result
+    return ranges
+
+def components(chain):
+    """Splits the chain into the groups of objects that are connected to
+    each other, directly or through other objects, each in chain order.
+    Objects in different components can run at the same time."""
+    # Union-find over the objects, joining each object with its sources.
+    leader = dict(((o, o) for o in chain))
+    def find(o):
+        root = o
+        while leader[root] is not root:
+            root = leader[root]
+        while leader[o] is not root:
+            leader[o], o = root, leader[o]
+        return root
+    for o in chain:
+        for inlet in o.inlet:
+            if isinstance(inlet.source, Outlet) and inlet.source.parent in leader:
+                leader[find(inlet.source.parent)] = find(o)
+    result = []
+    members = {}
+    for o in chain:
+        root = find(o)
+        if root not in members:
+            members[root] = []
+            result.append(members[root])
+        members[root].append(o)
+    return result
+
+def partition(chain, count):
+    """Shares the components of the chain among at most count partitions,
+    balancing their estimated cycles per sample. Each component goes,
+    largest first, to the partition with the fewest cycles so far. Returns
+    the partitions, each a list of objects in chain order, largest first."""
+    order = dict(((o, k) for k, o in enumerate(chain)))
+    partitions = [[] for k in range(min(count, len(chain)))]
+    loads = [0] * len(partitions)
+    for component in sorted(components(chain), key=lambda c: -sum((cycles(o) for o in c))):
+        k = loads.index(min(loads))
+        partitions[k].extend(component)
+        loads[k] += sum((cycles(o) for o in component))
+    partitions = [sorted(p, key=order.get) for p in partitions if p]
+    partitions.sort(key=lambda p: -sum((cycles(o) for o in p)))
+    return partitions
+
+def signal_rates(chain):
+    """Rate of each outlet in the chain, one of rates. The chain must be in
+    dependency order."""
+    result = {}
+    for o in chain:
+        if not o.outlet:
+            continue
+        args = []
+        for inlet in o.inlet:
+            source = inlet.source
+            if isinstance(source, Outlet):
+                args.append(result.get(source, 'sample'))
+            else:
+                args.append('constant')
+        for outlet in o.outlet:
+            result[outlet] = rate(o, args)
+    return result
+
+def overwritten_connects(parse_context):
+    """Signal connections that were replaced by a later connection to the
+    same inlet. Only the last connection to an inlet is compiled; messages
+    go to every connection."""
+    connects = [c for c in parse_context.connects if not isinstance(c.outlet, ControlOutlet)]
+    latest = {}
+    for c in connects:
+        latest[c.inlet] = c
+    return [c for c in connects if latest[c.inlet] is not c]
+
+def report(parse_context, overwritten, unoptimized_chain, chain, removed, sampling_rate):
+    """Describe what the optimization passes removed from the DSP chain,
+    and the estimated cycles saved per sample."""
+    reasons = dict(((o, reason) for o, reason in removed))
+    kept = set(chain)
+    lines = []
+    saved = 0
+    for o in unoptimized_chain:
+        if o in kept:
+            continue
+        lines.append('removed object %d (%s): %s' % (o.id, object_name(o), reasons.get(o, 'output unused')))
+        saved += cycles(o)
+    reachable = set(unoptimized_chain)
+    for o in parse_context.objects:
+        if isinstance(o, DSPOperator) and o not in reachable:
+            lines.append('skipped object %d (%s): not connected to a dac~' % (o.id, object_name(o)))
+    for c in overwritten:
+        lines.append('ignored %r: inlet has a later connection' % (c,))
+    lines.append('estimated cycles saved: %d per sample (%.2f Mcycles/s at %g Hz)' % (saved, saved * sampling_rate / 1e6, sampling_rate))
+    return lines
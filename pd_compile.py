@@ -21,69 +21,531 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
 # 02110-1301, USA.
 
-import sys
+import argparse
+import json
+import multiprocessing
 import os.path
+import sys
 
 import pdom
+import optimize
+import compile_cache
+
+arg_parser = argparse.ArgumentParser(description='Compile Pure Data patches into C code.')
+arg_parser.add_argument('patches', nargs='+', metavar='patch',
+                        help='Pure Data patch file (.pd), or a directory of them')
+arg_parser.add_argument('--jobs', type=int, default=1,
+                        help='number of patches to compile in parallel (default: 1)')
+arg_parser.add_argument('--path', action='append', default=[], metavar='DIR',
+                        help='directory to search for abstractions, after the directory of the '
+                             'patch using them; may be given more than once')
+arg_parser.add_argument('--block-size', type=int, default=64,
+                        help='number of samples processed per dsptick() call (default: 64)')
+arg_parser.add_argument('--no-optimize', action='store_true',
+                        help='emit the object graph as parsed, without optimization passes')
+arg_parser.add_argument('--trig', choices=('libm', 'table', 'poly'), default='libm',
+                        help='cosine implementation for osc~ and cos~ (default: libm)')
+arg_parser.add_argument('--cos-table-size', type=int, default=2048,
+                        help='number of points in the cosine table for --trig=table (default: 2048)')
+arg_parser.add_argument('--poly-degree', type=int, choices=(5, 7, 9), default=7,
+                        help='degree of the cosine polynomial for --trig=poly (default: 7)')
+arg_parser.add_argument('--dac', choices=('file', 'interleaved', 'planar'), default='file',
+                        help='where dac~ output goes: a dac_<id>.f32 file per dac~, or the caller\'s '
+                             'interleaved or planar output buffer (default: file)')
+arg_parser.add_argument('--state', choices=('static', 'struct'), default='static',
+                        help='keep object state in file-level statics, or in a patch_state_t '
+                             'passed to init(), dsptick() and deinit() (default: static)')
+arg_parser.add_argument('--numeric', choices=('float', 'q15', 'q31'), default='float',
+                        help='sample format: float, or saturating 16- or 32-bit fixed point for '
+                             'targets without an FPU (default: float)')
+arg_parser.add_argument('--simd', choices=('none', 'gcc', 'cmsis'), default='none',
+                        help='emit runs of elementwise objects as one loop over GCC vector types, '
+                             'or as CMSIS-DSP calls (default: none)')
+arg_parser.add_argument('--dedup-tables', action='store_true',
+                        help='emit arrays with the same contents as one table')
+arg_parser.add_argument('--profile', action='store_true',
+                        help='count the cycles taken by each object in dsptick(); profile_dump() prints the '
+                             'counts, and profile_report.py maps them back to the objects')
+arg_parser.add_argument('--partitions', type=int, default=1, metavar='N',
+                        help='split the objects feeding independent dac~ objects into up to N tick '
+                             'functions that can run on different cores (default: 1)')
+arg_parser.add_argument('--event-queue-size', type=int, default=64, metavar='N',
+                        help='number of pending metro and vline~ events the event queue holds; '
+                             'more are dropped, and counted by dsp_event_overflows() (default: 64)')
+arg_parser.add_argument('--report', action='store_true',
+                        help='list the objects removed from the DSP chain and the estimated cycles saved')
+arg_parser.add_argument('--no-cache', action='store_true',
+                        help='always compile, without reading or writing the compile cache')
+arg_parser.add_argument('--cache-dir', default=compile_cache.default_directory(),
+                        help='directory of the compile cache (default: %(default)s)')
+arg_parser.add_argument('--cache-size', type=int, default=64,
+                        help='size limit of the compile cache in megabytes (default: 64)')
+
+# Exit status when a patch can't be compiled with the options given (see
+# emit_c.Unsupported), as opposed to an error. argparse exits with 2 for
+# options it refuses.
+UNSUPPORTED_STATUS = 3
+
+# Options that don't change the generated code.
+uncached_options = ('patches', 'jobs', 'no_cache', 'cache_dir', 'cache_size')
+
+def dsp_chain(objects):
+    """The objects that the dac~ objects depend on, each after the objects
+    feeding its inlets. The order is a depth-first post-order from each
+    dac~ in turn, so an object usually follows the last of its inputs.
+    The walk keeps its own stack, and visits each object once."""
+    chain = []
+    # Objects are absent until first reached, then False while on the
+    # stack, and True once in the chain.
+    done = {}
+    for dac in (o for o in objects if isinstance(o, pdom.AudioDAC)):
+        if dac in done:
+            continue
+        done[dac] = False
+        stack = [(dac, iter(dac.inlet))]
+        while stack:
+            o, inlets = stack[-1]
+            for inlet in inlets:
+                source = inlet.source and inlet.source.parent
+                if source is None:
+                    continue
+                mark = done.get(source)
+                if mark is None:
+                    done[source] = False
+                    stack.append((source, iter(source.inlet)))
+                    break
+                if mark is False:
+                    raise Exception('DSP loop: %s' % dsp_loop_path(stack, source))
+            else:
+                stack.pop()
+                done[o] = True
+                chain.append(o)
+    return chain
+
+def dsp_loop_path(stack, o):
+    """Describes the loop through o and the objects above it on the stack,
+    in the direction the signal flows."""
+    loop = [entry[0] for entry in stack]
+    loop = loop[loop.index(o):] + [o]
+    loop.reverse()
+    def describe(o):
+        if getattr(o, 'file_name', None) is not None:
+            return '%s (%s:%d)' % (pdom.object_name(o), o.file_name, o.line)
+        return '%s (object %d)' % (pdom.object_name(o), o.id)
+    return ' -> '.join((describe(o) for o in loop))
+
+import emit_c
+from emit_c import state, declare, init, buffer_declare, dsptick_start, dsptick_end, deinit
+from emit_c import support, support_declare
+from emit_c import SAMPLING_RATE, float_str
+
+def compile_patch(input_file_path, args):
+    """Compiles one patch to C next to it, and returns the messages for the
+    user."""
+    messages = []
+    input_file_base, input_file_extension = os.path.splitext(input_file_path)
+    header_file_path = input_file_base + '.h'
+
+    cache = None
+    if not args.no_cache:
+        cache = compile_cache.CompileCache(args.cache_dir, args.cache_size * 1024 * 1024)
+        options = dict(((name, value) for name, value in vars(args).items() if name not in uncached_options))
+        # The output's name is in the header guard, the #include and the
+        # profile, so patches with the same contents don't share an entry.
+        options['output_name'] = os.path.basename(input_file_base)
+        dependencies = [open(path, 'rb').read() for path in pdom.abstraction_paths(input_file_path, args.path)]
+        key = cache.key(open(input_file_path, 'rb').read(), dependencies, options)
+        cached = cache.get(key)
+        if cached:
+            files, messages = cached
+            write_outputs(input_file_base, files)
+            return messages
+
+    parse_context = pdom.parse_patch(open(input_file_path, 'r'), args.path)
+    outputs = {}
+
+    emit_c.options = emit_c.Options(trig=args.trig,
+                                    cos_table_size=args.cos_table_size,
+                                    poly_degree=args.poly_degree,
+                                    dac=args.dac,
+                                    state=args.state,
+                                    numeric=args.numeric,
+                                    simd=args.simd,
+                                    dedup_tables=args.dedup_tables,
+                                    profile=args.profile,
+                                    event_queue_size=args.event_queue_size)
+
+    unoptimized_chain = dsp_chain(parse_context.objects)
+    overwritten = optimize.overwritten_connects(parse_context)
+
+    chain = unoptimized_chain
+    removed = []
+    if not args.no_optimize:
+        removed = optimize.optimize_chain(chain)
+        chain = dsp_chain(chain)
+
+    # Objects that don't share a partition never feed each other, so the
+    # partitions can run at the same time.
+    partitions = [chain]
+    if args.partitions > 1:
+        partitions = optimize.partition(chain, args.partitions) or [chain]
+        chain = [o for partition in partitions for o in partition]
+
+    emit_c.prepare(chain)
+    emit_c.prepare_control(parse_context, chain)
+    if emit_c.control_inlets and args.partitions > 1:
+        # Messages and events can reach any partition, at any time.
+        raise emit_c.Unsupported('messages reach the DSP chain, so it can\'t be partitioned; compile with --partitions=1')
+    # State is kept for the control objects as well as the chain.
+    state_objects = chain + emit_c.control_objects
+    groups = emit_c.fuse(chain, not args.no_optimize)
+    partition_groups = split_groups(groups, partitions)
+    emit_c.allocate_partition_buffers(partition_groups, not args.no_optimize)
+    sample_type = emit_c.numeric_format().sample_type
+
+    if args.report:
+        for line in optimize.report(parse_context, overwritten, unoptimized_chain, chain, removed, SAMPLING_RATE):
+            messages.append(line)
+
+    if emit_c.block_outlets:
+        messages.append('%d objects computed once per block instead of every sample' % len(emit_c.block_outlets))
+
+    # Outlet buffers are the bulk of dsptick()'s stack.
+    outlet_count = sum((len(o.outlet) for o in chain))
+    buffer_count = sum((len(emit_c.buffer_names(tick_groups)) for tick_groups in partition_groups))
+    messages.append('signal buffers: %d bytes (%d bytes with a buffer per outlet)' % (
+          emit_c.buffer_bytes(buffer_count, args.block_size),
+          emit_c.buffer_bytes(outlet_count, args.block_size)))
+
+    if args.partitions > 1:
+        if len(partitions) < args.partitions:
+            messages.append('only %d independent DSP chains, so %d partitions' % (len(partitions), len(partitions)))
+        for k, partition in enumerate(partitions):
+            messages.append('partition %d: %d objects, %d cycles per sample (estimated)' % (
+                            k, len(partition), sum((optimize.cycles(o) for o in partition))))
+
+    if emit_c.control_inlets:
+        messages.append('%d message inlets, %d objects with events' % (
+                        len(emit_c.control_inlets), len(emit_c.event_objects)))
+        if emit_c.event_objects:
+            messages.append('event queue of %d events' % args.event_queue_size)
+
+    if args.trig == 'table':
+        messages.append('cosine table of %d points, max error %.2g' % (args.cos_table_size, emit_c.cos_error_bound()))
+    elif args.trig == 'poly':
+        messages.append('cosine polynomial of degree %d, max error %.2g' % (args.poly_degree, emit_c.cos_error_bound()))
+
+    if args.state == 'struct':
+        messages.append('patch_state_t is %d bytes on a 32-bit target' % emit_c.state_struct_size(state_objects))
+
+    dacs = [o for o in chain if isinstance(o, pdom.AudioDAC)]
+    channels = emit_c.dac_backend().output_channels(dacs)
+
+    state_param = emit_c.state_param()
+    state_arg = state_param + ', ' if state_param else ''
+    state_call = 'state, ' if state_param else ''
+
+    # With the state in a struct, its type and the entry points go in a header
+    # so that callers can allocate instances.
+    if args.state == 'struct':
+        guard = '%s_H' % os.path.basename(input_file_base).upper().replace('-', '_').replace('~', '_').replace('.', '_')
+        header_lines = ['#ifndef %s' % guard,
+                        '#define %s' % guard,
+                        '',
+                        '#include <stddef.h>',
+                        '#include <stdio.h>',
+                        ]
+        if emit_c.numeric_format().fixed:
+            header_lines.append('#include <stdint.h>')
+        header_lines.append('')
+        if emit_c.event_objects:
+            header_lines.extend(emit_c.event_queue_types())
+        header_lines.extend(emit_c.state_struct_declare(state_objects))
+        header_lines.extend(('',
+                             'extern const size_t patch_state_size;',
+                             'extern const int dsp_block_size;',
+                             'extern const int dsp_output_channels;',
+                             'extern const int dsp_output_planar;',
+                             '',
+                             'void init(%s);' % state_param,
+                             'void dsptick(%s%s *out, int n);' % (state_arg, sample_type),
+                             'void deinit(%s);' % state_param,
+                             ''))
+        if emit_c.event_objects:
+            header_lines.extend(('unsigned int dsp_event_overflows(%s);' % state_param,
+                                 ''))
+        if args.partitions > 1:
+            header_lines.extend(('extern const int dsp_partition_count;',
+                                 'void dsptick_partition(%sint k, %s *out, int n);' % (state_arg, sample_type),
+                                 'void dsptick_mix(%s *out, const %s *partial, int n);' % (sample_type, sample_type),
+                                 ''))
+        if args.profile:
+            header_lines.extend(('void profile_dump(FILE *f);',
+                                 ''))
+        header_lines.extend(('#endif',
+                             ''))
+        outputs['.h'] = '\n'.join(header_lines)
+
+    lines = ['#include <stdio.h>',
+             '#include <math.h>',
+             ]
+    if emit_c.numeric_format().fixed or args.profile:
+        lines.append('#include <stdint.h>')
+    if args.simd == 'cmsis':
+        lines.append('#include "arm_math.h"')
+    if args.state == 'struct':
+        lines.append('#include "%s"' % os.path.basename(header_file_path))
+    lines.extend(['',
+             '#define BLOCK_SIZE %d' % args.block_size,
+             '',
+             'static const float SAMPLING_RATE = %s;' % float_str(SAMPLING_RATE),
+             'const int dsp_block_size = BLOCK_SIZE;',
+             'const int dsp_output_channels = %d;' % channels,
+             'const int dsp_output_planar = %d;' % emit_c.dac_backend().planar,
+             ])
+    if args.state == 'struct':
+        lines.append('const size_t patch_state_size = sizeof(patch_state_t);')
+    if args.partitions > 1:
+        lines.append('const int dsp_partition_count = %d;' % len(partitions))
+    lines.append('')
+
+    # Profile slots: each group of objects, then the dac~ output loop, for
+    # each partition.
+    profile_slots = []
+    for k, tick_groups in enumerate(partition_groups):
+        profile_slots.extend(tick_groups)
+        profile_slots.append('dac~ output' if len(partitions) == 1 else 'partition %d dac~ output' % k)
+    if args.profile:
+        lines.extend(emit_c.profile_declare(len(profile_slots)))
+        outputs['.profile.json'] = json.dumps({'patch': os.path.basename(input_file_path),
+                                               'slots': emit_c.profile_slot_map(profile_slots)}, indent=1) + '\n'
+
+    support_names = set()
+    for o in chain:
+        support_names.update(support(o))
+    lines.extend(support_declare(support_names))
+
+    for o in state_objects:
+        if args.state == 'static':
+            lines.extend(('static %s %s = %s;' % (c_type, emit_c.obj_prop(o, name), initial)
+                          for c_type, name, initial in state(o)))
+        lines.extend(declare(o))
+    lines.append('')
+    lines.extend(emit_c.control_define())
+
+    lines.append('void init(%s) {' % state_param)
+    if args.profile:
+        lines.append('\tpd_counter_enable();')
+    for o in state_objects:
+        lines.extend(('\t%s' %s for s in init(o)))
+    lines.extend(('\t%s' % s for s in emit_c.control_init()))
+    lines.append('}')
+    lines.append('')
+
+    # Each object processes the whole block before the next object runs, so
+    # every outlet gets a buffer of BLOCK_SIZE samples. n must not exceed
+    # BLOCK_SIZE. out holds n frames of dsp_output_channels channels.
+    if emit_c.event_objects:
+        # Events split the block into parts, each run like a whole block.
+        planar = emit_c.dac_backend().planar
+        lines.append('static void dsptick_segment(%s%s *out, int n%s) {' % (state_arg, sample_type,
+                                                                           ', int stride' if planar else ''))
+        lines.extend(tick_lines(partition_groups[0], dacs, channels, 0, args, stride='stride' if planar else 'n'))
+        lines.append('}')
+        lines.append('')
+        lines.append('void dsptick(%s%s *out, int n) {' % (state_arg, sample_type))
+        lines.extend(('\t%s' % s for s in emit_c.event_dsptick(channels, planar)))
+        lines.append('}')
+        lines.append('')
+    elif args.partitions == 1:
+        lines.append('void dsptick(%s%s *out, int n) {' % (state_arg, sample_type))
+        lines.extend(tick_lines(partition_groups[0], dacs, channels, 0, args))
+        lines.append('}')
+        lines.append('')
+    else:
+        # Each partition's dac~ objects fill a whole output block of their
+        # own, and dsptick_mix() adds the blocks together.
+        slot = 0
+        for k, tick_groups in enumerate(partition_groups):
+            partition_dacs = [o for o in partitions[k] if isinstance(o, pdom.AudioDAC)]
+            lines.append('static void dsptick_partition_%d(%s%s *out, int n) {' % (k, state_arg, sample_type))
+            lines.extend(tick_lines(tick_groups, partition_dacs, channels, slot, args, count_samples=(k == 0)))
+            lines.append('}')
+            lines.append('')
+            slot += len(tick_groups) + 1
+
+        lines.append('void dsptick_partition(%sint k, %s *out, int n) {' % (state_arg, sample_type))
+        lines.append('\tswitch(k) {')
+        for k in range(len(partitions)):
+            lines.append('\tcase %d: dsptick_partition_%d(%sout, n); break;' % (k, k, state_call))
+        lines.append('\t}')
+        lines.append('}')
+        lines.append('')
+
+        lines.append('void dsptick_mix(%s *out, const %s *partial, int n) {' % (sample_type, sample_type))
+        lines.append('\tint i;')
+        lines.append('\tfor(i=0; i<n * %d; i++) {' % channels)
+        lines.extend(('\t\t%s' % s for s in emit_c.mix_dsptick()))
+        lines.append('\t}')
+        lines.append('}')
+        lines.append('')
+
+        # Runs the partitions one after another, for callers with one core.
+        lines.append('void dsptick(%s%s *out, int n) {' % (state_arg, sample_type))
+        if channels and len(partitions) > 1:
+            lines.append('\t%s partial[BLOCK_SIZE * %d];' % (sample_type, channels))
+        lines.append('\tdsptick_partition_0(%sout, n);' % state_call)
+        for k in range(1, len(partitions)):
+            if channels:
+                lines.append('\tdsptick_partition_%d(%spartial, n);' % (k, state_call))
+                lines.append('\tdsptick_mix(out, partial, n);')
+            else:
+                lines.append('\tdsptick_partition_%d(%sout, n);' % (k, state_call))
+        lines.append('}')
+        lines.append('')
+
+    lines.append('void deinit(%s) {' % state_param)
+    for o in state_objects:
+        lines.extend(('\t%s' % s for s in deinit(o)))
+    lines.append('}')
+    if args.profile:
+        lines.append('')
+        lines.extend(emit_c.profile_dump_define(len(profile_slots)))
+
+    outputs['.c'] = '\n'.join(lines)
+
+    write_outputs(input_file_base, outputs)
+    if cache:
+        cache.put(key, outputs, messages)
+    return messages
+
+def split_groups(groups, partitions):
+    """The groups from fuse() of each partition. The chain lists each
+    partition's objects together, but a group can run across the boundary
+    between two partitions, and is then split there."""
+    partition_index = {}
+    for k, partition in enumerate(partitions):
+        for o in partition:
+            partition_index[o] = k
+    result = [[] for partition in partitions]
+    for group in groups:
+        start = 0
+        for end in range(1, len(group) + 1):
+            if end == len(group) or partition_index[group[end]] != partition_index[group[start]]:
+                result[partition_index[group[start]]].append(group[start:end])
+                start = end
+    return result
+
+def tick_lines(groups, dacs, channels, first_slot, args, count_samples=True, stride='n'):
+    """The body of a tick function that runs the groups, then the dac~
+    output loop of dacs, filling channels output channels, stride samples
+    apart if planar. With --profile, the groups and the output loop are
+    counted in the slots from first_slot on."""
+    lines = ['\tint i;']
+    lines.extend(('\t%s' % s for s in buffer_declare(groups)))
+    if args.profile:
+        lines.append('\tpd_counter_t pd_profile_time = pd_counter();')
+
+    for slot, group in enumerate(groups, first_slot):
+        for o in group:
+            lines.extend(('\t%s' % s for s in dsptick_start(o)))
+        lines.extend(('\t%s' % s for s in emit_c.group_dsptick(group)))
+        for o in group:
+            lines.extend(('\t%s' % s for s in dsptick_end(o)))
+        if args.profile:
+            lines.append('\tpd_profile_time = pd_profile_add(%d, pd_profile_time);' % slot)
+    lines.extend(('\t%s' % s for s in emit_c.sample_loop(emit_c.dac_backend().output_dsptick(dacs, channels, stride))))
+    if args.profile:
+        lines.append('\tpd_profile_add(%d, pd_profile_time);' % (first_slot + len(groups)))
+        if count_samples:
+            lines.append('\tpd_profile_samples += n;')
+    return lines
+
+def write_outputs(input_file_base, files):
+    for suffix, contents in files.items():
+        output_file = open(input_file_base + suffix, 'w')
+        output_file.write(contents)
+        output_file.close()
+
+def patch_paths(paths):
+    """The patches named on the command line, with directories replaced by
+    the .pd files in them."""
+    result = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, subdirectories, file_names in sorted(os.walk(path)):
+                subdirectories.sort()
+                result.extend((os.path.join(directory, name) for name in sorted(file_names)
+                               if name.endswith('.pd')))
+        else:
+            result.append(path)
+    return result
+
+def compile_job(job):
+    """Compiles one patch of a batch. An error only fails its own patch."""
+    input_file_path, args = job
+    try:
+        return input_file_path, compile_patch(input_file_path, args), None
+    except Exception as e:
+        return input_file_path, [], '%s: %s' % (type(e).__name__, e)
+
+def main():
+    args = arg_parser.parse_args()
+
+    if args.block_size < 1:
+        arg_parser.error('block size must be at least 1')
+    if args.cos_table_size < 4 or args.cos_table_size & (args.cos_table_size - 1):
+        arg_parser.error('cosine table size must be a power of two')
+    if args.numeric != 'float' and args.cos_table_size > 65536:
+        arg_parser.error('cosine table size must be at most 65536 for fixed-point code')
+    if args.numeric != 'float' and args.simd != 'none':
+        arg_parser.error('--simd requires --numeric=float')
+    if args.jobs < 1:
+        arg_parser.error('jobs must be at least 1')
+    if args.partitions < 1:
+        arg_parser.error('partitions must be at least 1')
+    if args.event_queue_size < 1:
+        arg_parser.error('event queue size must be at least 1')
+
+    paths = patch_paths(args.patches)
+    if not paths:
+        arg_parser.error('no patches found')
+
+    # A single patch compiles as it always has, errors and all.
+    if len(paths) == 1:
+        try:
+            messages = compile_patch(paths[0], args)
+        except emit_c.Unsupported as e:
+            sys.stderr.write('%s: %s\n' % (paths[0], e))
+            return UNSUPPORTED_STATUS
+        for message in messages:
+            print(message)
+        return 0
+
+    jobs = [(path, args) for path in paths]
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs)
+        results = pool.imap(compile_job, jobs)
+    else:
+        pool = None
+        results = (compile_job(job) for job in jobs)
+
+    failures = []
+    for path, messages, error in results:
+        print('%s:' % path)
+        for message in messages:
+            print('\t%s' % message)
+        if error:
+            print('\tfailed: %s' % error)
+            failures.append((path, error))
+    if pool:
+        pool.close()
+        pool.join()
+
+    print('compiled %d of %d patches' % (len(paths) - len(failures), len(paths)))
+    for path, error in failures:
+        print('failed %s: %s' % (path, error))
+    return 1 if failures else 0
 
-input_file_path = sys.argv[1]
-input_file_base, input_file_extension = os.path.splitext(input_file_path)
-output_file_path = input_file_base + '.c'
-
-parse_context = pdom.parse_patch(open(input_file_path, 'r'))
-
-chain = []
-def walk_object_inlets(o):
-    global chain
-    for inlet in o.inlet:
-        outlet = inlet.source
-        if outlet and outlet.parent:
-            walk_object_inlets(outlet.parent)
-    if o not in chain:
-        chain.append(o)
-
-dacs = tuple((o for o in parse_context.objects if isinstance(o, pdom.AudioDAC)))
-for dac in dacs:
-    walk_object_inlets(dac)
-
-#print(chain)
-#print
-
-from emit_c import declare, init, dsptick_start, dsptick, dsptick_end, deinit
-
-lines = ['#include <stdio.h>',
-         '#include <math.h>',
-         '',
-         'static const float SAMPLING_RATE = 44100.0f;',
-         '',
-         ]
-
-for o in chain:
-    lines.extend(declare(o))
-lines.append('')
-
-lines.append('void init() {')
-for o in chain:
-    lines.extend(('\t%s' %s for s in init(o)))
-lines.append('}')
-lines.append('')
-
-lines.append('void dsptick() {')
-for o in chain:
-    lines.extend(('\t%s' % s for s in dsptick_start(o)))
-for o in chain:
-    lines.extend(('\t%s' % s for s in dsptick(o)))
-for o in chain:
-    lines.extend(('\t%s' % s for s in dsptick_end(o)))
-lines.append('}')
-lines.append('')
-
-lines.append('void deinit() {')
-for o in chain:
-    lines.extend(('\t%s' % s for s in deinit(o)))
-lines.append('}')
-
-c_code = '\n'.join(lines)
-c_file = open(output_file_path, 'w')
-c_file.write(c_code)
-c_file.close()
+if __name__ == '__main__':
+    sys.exit(main())
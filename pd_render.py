@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+# Renders Pure Data patches to audio files with the NumPy interpreter.
+#
+# Copyright (C) 2013 Jared Boone, ShareBrained Technology, Inc.
+#
+# This file is part of PD compiler.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import argparse
+import os.path
+import sys
+import time
+
+import pdom
+import optimize
+import interpret
+from pd_compile import dsp_chain
+
+arg_parser = argparse.ArgumentParser(description='Render Pure Data patches to audio without compiling them.')
+arg_parser.add_argument('patch', help='Pure Data patch file (.pd)')
+arg_parser.add_argument('-o', '--output',
+                        help='output file: .wav for 16-bit PCM, anything else for interleaved 32-bit '
+                             'floats like main.c\'s out.f32 (default: the patch name with .wav)')
+arg_parser.add_argument('--seconds', type=float, default=3.0,
+                        help='length of the rendering (default: 3)')
+arg_parser.add_argument('--block-size', type=int, default=1024,
+                        help='samples processed per step; larger is faster, and the output is the same '
+                             '(default: 1024)')
+arg_parser.add_argument('--optimize', action='store_true',
+                        help='render the DSP chain after the compiler\'s optimization passes, instead of '
+                             'as drawn')
+arg_parser.add_argument('--path', action='append', default=[], metavar='DIR',
+                        help='directory to search for abstractions, after the directory of the patch')
+
+def main():
+    args = arg_parser.parse_args()
+    if args.block_size < 1:
+        arg_parser.error('block size must be at least 1')
+
+    parse_context = pdom.parse_patch(open(args.patch, 'r'), args.path)
+    chain = dsp_chain(parse_context.objects)
+    if args.optimize:
+        optimize.optimize_chain(chain)
+        chain = dsp_chain(chain)
+
+    samples = int(round(args.seconds * interpret.SAMPLING_RATE))
+    start = time.time()
+    frames = interpret.Interpreter(chain, parse_context.objects).render(samples, args.block_size)
+    elapsed = time.time() - start
+
+    output_path = args.output or os.path.splitext(args.patch)[0] + '.wav'
+    if output_path.endswith('.wav'):
+        interpret.write_wav(output_path, frames)
+    else:
+        interpret.write_f32(output_path, frames)
+    print('%s: %d frames of %d channels in %.3fs (%.0fx realtime)' % (output_path, len(frames),
+          frames.shape[1], elapsed, args.seconds / elapsed if elapsed > 0 else float('inf')))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
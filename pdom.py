@@ -21,12 +21,14 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
 # 02110-1301, USA.
 
-class Message(object):
-    def __init__(self, content):
-        self._content = content
+import array
+import os.path
+import re
 
-    def __repr__(self):
-        return '%s(%s)' % (self.__class__.__name__, self._content)
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class Text(object):
     def __init__(self, comment):
@@ -35,12 +37,21 @@ class Text(object):
     def __repr__(self):
         return '%s(%s)' % (self.__class__.__name__, self._comment)
 
+# Connections and ports are the most numerous objects of a large patch, so
+# they have __slots__ instead of a dict per instance.
+
 class Connect(object):
+    __slots__ = ('_source', '_outlet', '_target', '_inlet', 'outlet', 'inlet', 'line', 'file_name')
+
     def __init__(self, source, outlet, target, inlet):
         self._source = int(source)
         self._outlet = int(outlet)
         self._target = int(target)
         self._inlet = int(inlet)
+        self.outlet = None
+        self.inlet = None
+        self.line = None
+        self.file_name = None
 
     @property
     def source_index(self):
@@ -66,41 +77,64 @@ class UnsupportedObject(object):
     def __init__(self, name, parameters):
         self._name = name
         self._parameters = parameters
+        self.inlet = tuple()
+        self.outlet = tuple()
 
     def __repr__(self):
         return '%s(%s,%s)' % (self.__class__.__name__, self._name, self._parameters)
 
+# A port's id is its index in the parent's inlets or outlets. The parent
+# builds its ports before it has the tuple of them, so the index is looked
+# up the first time it is needed and kept.
+
 class Inlet(object):
+    __slots__ = ('_parent', '_value_type', '_id', 'source')
+
     def __init__(self, parent, value_type):
         self._parent = parent
         self._value_type = value_type
-        self._source = None
+        self._id = None
+        self.source = None
 
     @property
     def id(self):
-        return self._parent.inlet.index(self)
+        if self._id is None:
+            self._id = self._parent.inlet.index(self)
+        return self._id
 
     @property
-    def source(self):
-        return self._source
-
-    @source.setter
-    def source(self, value):
-        self._source = value
+    def parent(self):
+        return self._parent
 
 class Outlet(object):
+    __slots__ = ('_parent', '_id')
+
     def __init__(self, parent):
         self._parent = parent
+        self._id = None
 
     @property
     def id(self):
-        return self._parent.outlet.index(self)
+        if self._id is None:
+            self._id = self._parent.outlet.index(self)
+        return self._id
 
     @property
     def parent(self):
         return self._parent
 
+class ControlOutlet(Outlet):
+    """An outlet that sends messages. Unlike a signal, a message goes to
+    every inlet connected to the outlet, in the order of the connections."""
+    __slots__ = ('targets',)
+
+    def __init__(self, parent):
+        super(ControlOutlet, self).__init__(parent)
+        self.targets = []
+
 class ConstantOutlet(object):
+    __slots__ = ('_value',)
+
     def __init__(self, value):
         self._value = value
 
@@ -113,10 +147,23 @@ class ConstantOutlet(object):
         return self._value
 
 class DSPOperator(object):
+    # Indexes of the inlets that take messages themselves. A message sent
+    # to any other inlet sets the value of its signal (see FloatInlet).
+    message_inlets = ()
+
     def __init__(self, **kwargs):
         self._inlets = tuple()
         self._outlets = tuple()
         self.id = None
+        # Set by the parser; assigned here so that every object's attributes
+        # fit the dict layout shared by its class.
+        self.x = 0
+        self.line = None
+        self.file_name = None
+        self.receives_messages = False
+        # The floats that messages can set the object's value to, or None
+        # if they're only known at run time (see received_floats()).
+        self.received_floats = ()
 
     @property
     def inlet(self):
@@ -133,11 +180,14 @@ class AudioDAC(DSPOperator):
     def __init__(self, parameters, **kwargs):
         super(AudioDAC, self).__init__(**kwargs)
 
-        self._left = Inlet(self, float)
-        self._right = Inlet(self, float)
-        self._inlets = (self._left, self._right)
+        # Output channel numbers, counting from 1, one inlet each.
+        self.channels = tuple((int(p) for p in parameters)) or (1, 2)
+        self._inlets = tuple((Inlet(self, float) for channel in self.channels))
 
 class AudioPhasor(DSPOperator):
+    # A float to the right inlet sets the phase, in cycles.
+    message_inlets = (1,)
+
     def __init__(self, parameters, **kwargs):
         super(AudioPhasor, self).__init__(**kwargs)
 
@@ -152,6 +202,9 @@ class AudioPhasor(DSPOperator):
             self._in.source = ConstantOutlet(float(parameters[0]))
 
 class AudioOscillator(DSPOperator):
+    # A float to the right inlet sets the phase, in cycles.
+    message_inlets = (1,)
+
     def __init__(self, parameters, **kwargs):
         super(AudioOscillator, self).__init__(**kwargs)
 
@@ -348,9 +401,331 @@ class AudioClip(DSPOperator):
         if len(parameters) > 1:
             self._hi.source = ConstantOutlet(float(parameters[1]))
 
-class Print(object):
-	def __init__(self, parameters):
-		pass
+class AudioTableRead(DSPOperator):
+    def __init__(self, parameters, **kwargs):
+        super(AudioTableRead, self).__init__(**kwargs)
+
+        self._in = Inlet(self, float)
+        self._inlets = (self._in,)
+
+        self._out = Outlet(self)
+        self._outlets = (self._out,)
+
+        self.array_name = parameters[0] if parameters else None
+        self.array = None
+
+class AudioTableOscillator(DSPOperator):
+    # A float to the right inlet sets the phase, in cycles.
+    message_inlets = (1,)
+
+    def __init__(self, parameters, **kwargs):
+        super(AudioTableOscillator, self).__init__(**kwargs)
+
+        self._in = Inlet(self, float)
+        self._ft1 = Inlet(self, float)
+        self._inlets = (self._in, self._ft1,)
+
+        self._out = Outlet(self)
+        self._outlets = (self._out,)
+
+        self.array_name = parameters[0] if parameters else None
+        self.array = None
+
+        # Unlike osc~, tabosc4~ takes no frequency argument.
+        self._in.source = ConstantOutlet(0.0)
+
+class AudioLine(DSPOperator):
+    """line~: ramps to a target, given by a message "target time", with the
+    time in milliseconds. A float to the right inlet is the time for the
+    next target alone."""
+    message_inlets = (0, 1)
+
+    def __init__(self, parameters, **kwargs):
+        super(AudioLine, self).__init__(**kwargs)
+
+        self._in = Inlet(self, float)
+        self._time = Inlet(self, float)
+        self._inlets = (self._in, self._time,)
+
+        self._out = Outlet(self)
+        self._outlets = (self._out,)
+
+class AudioVLine(DSPOperator):
+    """vline~: as line~, with a delay before the ramp starts, given by a
+    message "target time delay" or the right inlet."""
+    message_inlets = (0, 1, 2)
+
+    def __init__(self, parameters, **kwargs):
+        super(AudioVLine, self).__init__(**kwargs)
+
+        self._in = Inlet(self, float)
+        self._time = Inlet(self, float)
+        self._delay = Inlet(self, float)
+        self._inlets = (self._in, self._time, self._delay,)
+
+        self._out = Outlet(self)
+        self._outlets = (self._out,)
+
+class FloatInlet(DSPOperator):
+    """Floats sent to a signal inlet, as a signal that holds the last one.
+    The parser puts one in front of each signal inlet that messages are
+    connected to. It starts at the value the inlet had, its argument or
+    zero."""
+    message_inlets = (0,)
+
+    def __init__(self, value, **kwargs):
+        super(FloatInlet, self).__init__(**kwargs)
+
+        self._in = Inlet(self, float)
+        self._inlets = (self._in,)
+
+        self._out = Outlet(self)
+        self._outlets = (self._out,)
+
+        self.value = value
+
+class SubpatchInlet(object):
+    """inlet~: a signal entering a subpatch or abstraction. Its inlet is on
+    the outside of the subpatch, its outlet on the inside."""
+    def __init__(self, parameters, **kwargs):
+        self._in = Inlet(self, float)
+        self.inlet = (self._in,)
+        self._out = Outlet(self)
+        self.outlet = (self._out,)
+        self.id = None
+
+    def __repr__(self):
+        return self.__class__.__name__
+
+class SubpatchOutlet(SubpatchInlet):
+    """outlet~: a signal leaving a subpatch or abstraction. Its inlet is on
+    the inside of the subpatch, its outlet on the outside."""
+    pass
+
+class SubpatchMessageInlet(object):
+    """inlet: messages entering a subpatch or abstraction. Its inlet is on
+    the outside of the subpatch, its outlet on the inside."""
+    def __init__(self, parameters, **kwargs):
+        self._in = Inlet(self, float)
+        self.inlet = (self._in,)
+        self._out = ControlOutlet(self)
+        self.outlet = (self._out,)
+        self.id = None
+
+    def __repr__(self):
+        return self.__class__.__name__
+
+class SubpatchMessageOutlet(SubpatchMessageInlet):
+    """outlet: messages leaving a subpatch or abstraction. Its inlet is on
+    the inside of the subpatch, its outlet on the outside."""
+    pass
+
+class Subpatch(object):
+    """A subpatch or an instance of an abstraction, as an object of the
+    canvas that contains it. Its inlets and outlets are those of its inlet,
+    inlet~, outlet and outlet~ objects, ordered from left to right as in
+    Pure Data."""
+    def __init__(self, name, canvas):
+        self.name = name
+        self.canvas = canvas
+        self.id = None
+        def left_to_right(classes):
+            return sorted((o for o in canvas.objects if o.__class__ in classes), key=lambda o: o.x)
+        self.inlet = tuple((o._in for o in left_to_right((SubpatchInlet, SubpatchMessageInlet))))
+        self.outlet = tuple((o._out for o in left_to_right((SubpatchOutlet, SubpatchMessageOutlet))))
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, self.name)
+
+class Canvas(object):
+    """The objects and connections of a patch, subpatch or abstraction.
+    Connections refer to objects by their index in this canvas."""
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.objects = []
+        self.connects = []
+
+    def connect(self):
+        # The FloatInlet in front of each signal inlet that takes messages,
+        # and the inlets in the order they got one.
+        float_inlets = {}
+        messaged = []
+        for c in self.connects:
+            try:
+                source_object = self.objects[c.source_index]
+                c.outlet = source_object.outlet[c.source_outlet_index]
+                target_object = self.objects[c.target_index]
+                c.inlet = target_object.inlet[c.target_inlet_index]
+            except (IndexError, AttributeError):
+                raise Exception('%s:%d: %r refers to an object, outlet or inlet that does not exist' % (
+                                self.file_name, c.line, c))
+            if not isinstance(c.outlet, ControlOutlet):
+                if takes_messages(c.inlet):
+                    raise Exception('%s:%d: %r connects a signal to an inlet that takes messages' % (
+                                    self.file_name, c.line, c))
+                c.inlet.source = c.outlet
+            elif takes_messages(c.inlet):
+                c.outlet.targets.append(c.inlet)
+            else:
+                float_inlet = float_inlets.get(c.inlet)
+                if float_inlet is None:
+                    if isinstance(c.inlet.source, Outlet):
+                        raise Exception('%s:%d: %r connects messages to an inlet that has a signal' % (
+                                        self.file_name, c.line, c))
+                    value = c.inlet.source.value if isinstance(c.inlet.source, ConstantOutlet) else 0.0
+                    float_inlet = FloatInlet(value)
+                    float_inlet.line = c.line
+                    float_inlet.file_name = c.file_name
+                    float_inlets[c.inlet] = float_inlet
+                    messaged.append(c.inlet)
+                    c.inlet.source = float_inlet._out
+                c.outlet.targets.append(float_inlet._in)
+        # Connections refer to objects by number, so the float inlets go
+        # after the patch's own objects.
+        for inlet in messaged:
+            if inlet.source is not float_inlets[inlet]._out:
+                raise Exception('%s: inlet %d of %s has both a signal and messages connected' % (
+                                self.file_name, inlet.id, object_name(inlet.parent)))
+            self.objects.append(float_inlets[inlet])
+
+def takes_messages(inlet):
+    """Whether an inlet takes messages itself, rather than a signal."""
+    o = inlet.parent
+    if isinstance(o, DSPOperator):
+        return inlet.id in o.message_inlets
+    return not isinstance(o, SubpatchInlet)
+
+class Array(object):
+    """An array of floats, declared by "#X array" and filled in by the
+    "#A" records that follow it."""
+    def __init__(self, name, size, save_contents):
+        self.name = name
+        self.values = array.array('f', [0.0]) * size
+        self.save_contents = save_contents
+
+    def load(self, start, text):
+        values = array_values(text)[:max(len(self.values) - start, 0)]
+        self.values[start:start + len(values)] = values
+
+    def __repr__(self):
+        return '%s(%s,%d)' % (self.__class__.__name__, self.name, len(self.values))
+
+def array_values(text):
+    """The numbers in text, as an array('f'). NumPy, if it's there, parses
+    them without making a Python object for each."""
+    if numpy is not None:
+        return array.array('f', numpy.fromstring(text, dtype=numpy.float32, sep=' ').tobytes())
+    return array.array('f', map(float, text.split()))
+
+# Control objects pass messages instead of signals. A message is a list of
+# floats, a bang being the empty list, or "stop". Messages start from
+# loadbang, and go from each outlet to the connected inlets depth first, as
+# in Pure Data.
+
+class ControlObject(object):
+    def __init__(self, **kwargs):
+        self._inlets = tuple()
+        self._outlets = tuple()
+        self.id = None
+        self.x = 0
+        self.line = None
+        self.file_name = None
+
+    @property
+    def inlet(self):
+        return self._inlets
+
+    @property
+    def outlet(self):
+        return self._outlets
+
+    def __repr__(self):
+        return self.__class__.__name__
+
+class DollarArgument(object):
+    """$1, $2, ... in a message box: that float of the message that
+    triggered it."""
+    __slots__ = ('n',)
+
+    def __init__(self, n):
+        self.n = n
+
+    def __repr__(self):
+        return '$%d' % self.n
+
+class Message(ControlObject):
+    """A message box. Its content is one or more messages separated by
+    commas, which it sends in turn whenever a message arrives."""
+    def __init__(self, content, **kwargs):
+        super(Message, self).__init__(**kwargs)
+
+        self._in = Inlet(self, float)
+        self._inlets = (self._in,)
+
+        self._out = ControlOutlet(self)
+        self._outlets = (self._out,)
+
+        self._content = content
+
+    def messages(self):
+        """The messages as (selector, atoms), with selector 'list' or
+        'stop' and each atom a float or a DollarArgument."""
+        result = []
+        for text in _comma_pattern.split(self._content):
+            words = text.split()
+            if not words:
+                continue
+            selector, atoms = 'list', words
+            if words[0] in ('bang', 'stop'):
+                selector, atoms = ('stop' if words[0] == 'stop' else 'list'), []
+            elif words[0] in ('float', 'list'):
+                atoms = words[1:]
+            result.append((selector, [self._atom(word) for word in atoms]))
+        return result
+
+    def _atom(self, word):
+        match = _dollar_pattern.match(word)
+        if match and match.end() == len(word) and int(match.group(1)) > 0:
+            return DollarArgument(int(match.group(1)))
+        try:
+            return float(word)
+        except ValueError:
+            raise Exception('%s:%d: message box "%s": %s is not supported, only floats, $1, $2, ... and '
+                            'bang, stop, float and list' % (self.file_name, self.line, self._content, word))
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, self._content)
+
+class Metro(ControlObject):
+    """metro: while on, sends a bang every interval milliseconds. A bang or
+    a non-zero float turns it on, zero or stop turns it off."""
+    def __init__(self, parameters, **kwargs):
+        super(Metro, self).__init__(**kwargs)
+
+        self._in = Inlet(self, float)
+        self._interval = Inlet(self, float)
+        self._inlets = (self._in, self._interval,)
+
+        self._out = ControlOutlet(self)
+        self._outlets = (self._out,)
+
+        self.interval = float(parameters[0]) if parameters else 0.0
+
+class LoadBang(ControlObject):
+    """loadbang: sends a bang when the patch starts, from init()."""
+    def __init__(self, parameters, **kwargs):
+        super(LoadBang, self).__init__(**kwargs)
+
+        self._out = ControlOutlet(self)
+        self._outlets = (self._out,)
+
+class Print(ControlObject):
+    """print: takes messages, but compiled code has nowhere to print them."""
+    def __init__(self, parameters, **kwargs):
+        super(Print, self).__init__(**kwargs)
+
+        self._in = Inlet(self, float)
+        self._inlets = (self._in,)
 
 object_constructor = {
     'dac~': AudioDAC,
@@ -370,9 +745,25 @@ object_constructor = {
     'cos~': AudioCosine,
     'sig~': AudioSignal,
     'clip~': AudioClip,
-	'print': Print,
+    'tabread~': AudioTableRead,
+    'tabosc4~': AudioTableOscillator,
+    'line~': AudioLine,
+    'vline~': AudioVLine,
+    'inlet~': SubpatchInlet,
+    'outlet~': SubpatchOutlet,
+    'inlet': SubpatchMessageInlet,
+    'outlet': SubpatchMessageOutlet,
+    'metro': Metro,
+    'loadbang': LoadBang,
+    'print': Print,
 }
 
+def object_name(o):
+    for name, constructor in object_constructor.items():
+        if o.__class__ is constructor:
+            return name
+    return o.__class__.__name__
+
 def connect_parser(text):
     args = text.split()
     source, outlet, target, inlet = args
@@ -383,7 +774,9 @@ def msg_parser(text):
     args = text.split(None, 2)
     x_pos = args[0]
     y_pos = args[1]
-    content = args[2]
+    content = args[2] if len(args) > 2 else ''
+    # Pure Data adds ", f <width>" for a box of a set width.
+    content = _width_pattern.sub('', content)
     return Message(content)
 
 def obj_parser(text):
@@ -393,6 +786,7 @@ def obj_parser(text):
     object_name = args[2]   # TODO: optional!
     parameters = args[3:]
     new_object = object_constructor[object_name](parameters)
+    new_object.x = int(float(x_pos))
     return new_object
 
 def text_parser(text):
@@ -402,30 +796,71 @@ def text_parser(text):
     comment = args[2]
     return Text(comment)
 
+def array_parser(text):
+    args = text.split()
+    name = args[0]
+    size = int(args[1])
+    flags = int(args[3]) if len(args) > 3 else 0
+    return Array(name, size, bool(flags & 1))
+
 element_type_parser = {
+    'array': array_parser,
     'connect': connect_parser,
+    'coords': lambda text: None,
     'msg': msg_parser,
     'obj': obj_parser,
     'text': text_parser,
 }
 
 class ParseContext(object):
-    def __init__(self):
+    def __init__(self, search_path=()):
         self.connects = []
         self.objects = []
+        self.arrays = {}
+        # The inlets that messages reach, from messaged_inlets().
+        self.message_inlets = []
+        self.search_path = list(search_path)
+        self.current_array = None
+        # The canvases being parsed, innermost last, and the files being
+        # parsed as (name, arguments, $0), innermost last.
+        self.canvases = []
+        self.files = []
+        self.instance_count = 0
+
+    @property
+    def canvas(self):
+        return self.canvases[-1]
 
     def chunk_parser_regular_element(self, text):
         element_type, text = text.split(None, 1)
-        new_object = element_type_parser[element_type](text)
-        if isinstance(new_object, Connect):
-            self.connects.append(new_object)
+        path = self.abstraction_path(text) if element_type == 'obj' else None
+        if element_type == 'restore':
+            new_object = self.restore(text)
+        elif path is not None:
+            new_object = self.abstraction(path, text)
+        else:
+            new_object = element_type_parser[element_type](text)
+        if isinstance(new_object, Array):
+            self.arrays[new_object.name] = new_object
+            self.current_array = new_object
+        elif new_object is None:
+            pass
+        elif isinstance(new_object, Connect):
+            self.canvas.connects.append(new_object)
         else:
-            self.objects.append(new_object)
+            self.canvas.objects.append(new_object)
+        return new_object
 
     def chunk_parser_array_data(self, text):
+        if self.current_array is None:
+            raise ValueError('array data without an array')
+        start, text = (text.split(None, 1) + [''])[:2]
+        self.current_array.load(int(start), text)
         return None
 
     def chunk_parser_frameset(self, text):
+        if text.startswith('canvas'):
+            self.canvases.append(Canvas(self.files[-1][0]))
         return None
 
     chunk_parser = {
@@ -434,45 +869,304 @@ class ParseContext(object):
         'X': chunk_parser_regular_element,
     }
 
+    def restore(self, text):
+        """Closes a subpatch or graph, which becomes an object of the
+        canvas that contains it."""
+        if len(self.canvases) < 2:
+            raise ValueError('restore without a subpatch')
+        args = text.split()
+        canvas = self.canvases.pop()
+        canvas.connect()
+        return Subpatch(' '.join(args[3:]) or args[2], canvas)
+
+    def abstraction_path(self, text):
+        """The file of the abstraction named by an "#X obj" record, or None
+        if it names a built-in object or no abstraction is found. Like Pure
+        Data, this looks next to the file being parsed first."""
+        args = text.split()
+        if len(args) < 3 or args[2] in object_constructor:
+            return None
+        directories = [os.path.dirname(self.files[-1][0])] + self.search_path
+        return find_abstraction(args[2], directories)
+
+    def abstraction(self, path, text):
+        """Parses an instance of an abstraction, and returns it as a
+        subpatch."""
+        if path in (name for name, arguments, dollar_zero in self.files):
+            raise ValueError('abstraction %s contains itself' % path)
+        args = text.split()
+        self.parse_records(path, abstraction_records(path), args[3:])
+        canvas = self.canvases.pop()
+        canvas.connect()
+        subpatch = Subpatch(args[2], canvas)
+        subpatch.x = int(float(args[0]))
+        return subpatch
+
+    def substitute(self, record):
+        """Replaces $1, $2, ... with the arguments of the abstraction being
+        parsed, and $0 with a number unique to its instance."""
+        name, arguments, dollar_zero = self.files[-1]
+        def argument(match):
+            n = int(match.group(1))
+            if n == 0:
+                return dollar_zero
+            return arguments[n - 1] if n <= len(arguments) else '0'
+        return _dollar_pattern.sub(argument, record)
+
     def parse_record(self, text):
         chunk_type = text[0]
         return self.chunk_parser[chunk_type](self, text[1:].strip())
 
+    def parse_records(self, name, records, arguments):
+        """Parses the records of a patch or abstraction file into a new
+        canvas, which is left on top of self.canvases."""
+        # Pure Data numbers its instances from 1000.
+        self.files.append((name, arguments, '%d' % (1000 + self.instance_count)))
+        self.instance_count += 1
+        depth = len(self.canvases)
+        for line, column, record in records:
+            if len(record) and record[0] == '#':
+                # In a message box, $1, $2, ... are the message's floats.
+                if '$' in record and not record.startswith('#X msg'):
+                    record = self.substitute(record)
+                try:
+                    element = self.parse_record(record[1:])
+                except KeyError as e:
+                    raise Exception('%s:%d:%d: unknown name %s in "%s"' % (name, line, column, e,
+                                    _excerpt(record)))
+                except (ValueError, IndexError) as e:
+                    raise Exception('%s:%d:%d: cannot parse "%s": %s' % (name, line, column,
+                                    _excerpt(record), e))
+                if element is not None:
+                    element.line = line
+                    element.file_name = name
+        if len(self.canvases) != depth + 1:
+            raise Exception('%s: subpatch is not closed' % name)
+        self.files.pop()
+
     def parse_patch(self, patch_file):
-        patch = patch_file.read()
+        name = getattr(patch_file, 'name', '<patch>')
+        self.parse_records(name, patch_records(patch_file), [])
         patch_file.close()
-
-        patch_split = patch.split('\\;')
-        patch_split = map(lambda s: s.split(';'), patch_split)
-        records = []
-        for split_items in patch_split:
-            if records:
-                records[-1] += ';' + split_items[0]
-                records.extend(split_items[1:])
-            else:
-                records = split_items
-        records = map(str.strip, records)
-        #print('\n'.join(records))
-
-        for record in records:
-            if len(record) and record[0] == '#':
-                self.parse_record(record[1:])
+        root = self.canvases.pop()
+        root.connect()
+
+        # The objects of the patch keep their numbers from the file; those of
+        # subpatches and abstractions follow.
+        self.objects = list(root.objects)
+        self.connects = list(root.connects)
+        for o in self.objects:
+            if isinstance(o, Subpatch):
+                self.objects.extend(o.canvas.objects)
+                self.connects.extend(o.canvas.connects)
 
         for i in range(len(self.objects)):
             o = self.objects[i]
             o.id = i
             #print('%d: %s' % (i, o))
 
-        for i in range(len(self.connects)):
-            c = self.connects[i]
-            source_object = self.objects[c.source_index]
-            outlet = source_object.outlet[c.source_outlet_index]
-            target_object = self.objects[c.target_index]
-            inlet = target_object.inlet[c.target_inlet_index]
-            inlet.source = outlet
-            #print('%d: %s' % (i, c))
-
-def parse_patch(f):
-    context = ParseContext()
+        # Flatten the patch: connect the objects inside subpatches straight
+        # to the objects outside. An unconnected inlet~ or outlet~ carries
+        # zero, as in Pure Data.
+        for o in self.objects:
+            if not isinstance(o, DSPOperator):
+                continue
+            for inlet in o.inlet:
+                while inlet.source is not None and isinstance(inlet.source.parent, SubpatchInlet):
+                    inlet.source = inlet.source.parent.inlet[0].source or ConstantOutlet(0.0)
+        # Messages likewise skip the inlet and outlet objects.
+        for o in self.objects:
+            for outlet in getattr(o, 'outlet', ()):
+                if isinstance(outlet, ControlOutlet):
+                    outlet.targets = message_targets(outlet)
+        self.message_inlets = messaged_inlets(self.objects)
+        for inlet in self.message_inlets:
+            if isinstance(inlet.parent, DSPOperator):
+                inlet.parent.receives_messages = True
+        senders = message_senders(self.objects, self.message_inlets)
+        for o in self.objects:
+            if isinstance(o, (FloatInlet, AudioLine, AudioVLine)) and o.receives_messages:
+                o.received_floats = received_floats(senders, o.inlet[0], 0)
+
+        for o in self.objects:
+            if hasattr(o, 'array_name'):
+                o.array = self.arrays.get(o.array_name)
+                if o.array is None:
+                    raise Exception('%s:%d: %s has no array named %r' % (o.file_name, o.line, object_name(o),
+                                    o.array_name))
+
+def message_targets(outlet):
+    """The inlets that an outlet's messages go to, past any inlet and
+    outlet objects."""
+    result = []
+    for inlet in outlet.targets:
+        if isinstance(inlet.parent, SubpatchMessageInlet):
+            result.extend(message_targets(inlet.parent._out))
+        else:
+            result.append(inlet)
+    return result
+
+def messaged_inlets(objects):
+    """The inlets that messages from the loadbang objects can reach, each
+    once. Nothing else starts a message, so other message inlets never get
+    one."""
+    result = []
+    reached = set()
+    senders = [o for o in objects if isinstance(o, LoadBang)]
+    visited = set(senders)
+    while senders:
+        o = senders.pop(0)
+        for outlet in o.outlet:
+            for inlet in outlet.targets:
+                if inlet in reached:
+                    continue
+                reached.add(inlet)
+                result.append(inlet)
+                if isinstance(inlet.parent, ControlObject) and inlet.parent not in visited:
+                    visited.add(inlet.parent)
+                    senders.append(inlet.parent)
+    return result
+
+def message_senders(objects, message_inlets):
+    """The objects that send messages to each inlet that messages reach."""
+    result = {}
+    reached = set(message_inlets)
+    for o in objects:
+        if isinstance(o, LoadBang) or (isinstance(o, ControlObject) and any((inlet in reached for inlet in o.inlet))):
+            for outlet in o.outlet:
+                for inlet in outlet.targets:
+                    result.setdefault(inlet, []).append(o)
+    return result
+
+def received_floats(senders, inlet, index, visiting=frozenset()):
+    """The floats that messages to an inlet can have at index, leaving out
+    messages too short to have one. None if they can't be known before run
+    time, when a $N of a message box depends on itself."""
+    if inlet in visiting:
+        return None
+    result = []
+    for o in senders.get(inlet, ()):
+        # Other control objects only send bangs.
+        if not isinstance(o, Message):
+            continue
+        for selector, atoms in o.messages():
+            if len(atoms) <= index:
+                continue
+            atom = atoms[index]
+            if isinstance(atom, DollarArgument):
+                floats = received_floats(senders, o._in, atom.n - 1, visiting | frozenset((inlet,)))
+                if floats is None:
+                    return None
+                # $N is 0 when the message that triggered the box is too short.
+                result.extend(floats + [0.0])
+            else:
+                result.append(atom)
+    return result
+
+_dollar_pattern = re.compile(r'\\?\$(\d+)')
+_comma_pattern = re.compile(r'\\,')
+_width_pattern = re.compile(r'(?<!\\),\s*f\s+\d+$')
+
+_abstraction_records = {}
+
+def abstraction_records(path):
+    """The records of an abstraction file. The file is read once, and again
+    only if it has been modified since, however many times it is used."""
+    mtime = os.path.getmtime(path)
+    cached = _abstraction_records.get(path)
+    if cached is None or cached[0] != mtime:
+        abstraction_file = open(path, 'r')
+        cached = (mtime, list(patch_records(abstraction_file)))
+        abstraction_file.close()
+        _abstraction_records[path] = cached
+    return cached[1]
+
+def find_abstraction(name, directories):
+    for directory in directories:
+        path = os.path.join(directory, name + '.pd')
+        if os.path.isfile(path):
+            return path
+    return None
+
+def abstraction_paths(patch_path, search_path=()):
+    """The abstraction files that a patch uses, directly or through other
+    abstractions, each once."""
+    result = []
+    def scan(path, records):
+        directories = [os.path.dirname(path)] + list(search_path)
+        for line, column, record in records:
+            args = record.split()
+            if len(args) < 5 or args[:2] != ['#X', 'obj'] or args[4] in object_constructor:
+                continue
+            abstraction = find_abstraction(args[4], directories)
+            if abstraction is not None and abstraction not in result:
+                result.append(abstraction)
+                scan(abstraction, abstraction_records(abstraction))
+    patch_file = open(patch_path, 'r')
+    scan(patch_path, patch_records(patch_file))
+    patch_file.close()
+    return result
+
+def _excerpt(record):
+    if len(record) > 60:
+        return record[:57] + '...'
+    return record
+
+def _advance(line, column, text):
+    """The position (line, column) after reading text from the given one."""
+    newlines = text.count('\n')
+    if newlines:
+        return line + newlines, len(text) - text.rfind('\n')
+    return line, column + len(text)
+
+def patch_records(patch_file, chunk_size=1 << 16):
+    """Yields (line, column, text) for each record of a patch, with
+    surrounding white space removed, in a single pass over the file a chunk
+    at a time. line and column count from 1, and give where the text
+    starts. An escaped semicolon ("\\;") doesn't end a record, and is a
+    plain semicolon in its text."""
+    parts = []
+    line, column = 1, 1
+    record_line, record_column = line, column
+    carry = ''
+    while True:
+        data = patch_file.read(chunk_size)
+        if not data and not carry:
+            break
+        chunk = carry + data
+        carry = ''
+        if data and chunk.endswith('\\'):
+            # It may escape a semicolon at the start of the next chunk.
+            carry = '\\'
+            chunk = chunk[:-1]
+        position = 0
+        while True:
+            end = chunk.find(';', position)
+            if end < 0:
+                parts.append(chunk[position:])
+                line, column = _advance(line, column, chunk[position:])
+                break
+            line, column = _advance(line, column, chunk[position:end + 1])
+            if end > 0 and chunk[end - 1] == '\\':
+                parts.append(chunk[position:end - 1])
+                parts.append(';')
+            else:
+                parts.append(chunk[position:end])
+                text = ''.join(parts)
+                stripped = text.lstrip()
+                start_line, start_column = _advance(record_line, record_column,
+                                                    text[:len(text) - len(stripped)])
+                yield start_line, start_column, stripped.rstrip()
+                parts = []
+                record_line, record_column = line, column
+            position = end + 1
+    text = ''.join(parts)
+    stripped = text.lstrip()
+    if stripped:
+        start_line, start_column = _advance(record_line, record_column, text[:len(text) - len(stripped)])
+        yield start_line, start_column, stripped.rstrip()
+
+def parse_patch(f, search_path=()):
+    context = ParseContext(search_path)
     context.parse_patch(f)
     return context
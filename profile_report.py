@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+# Maps the counts printed by profile_dump() back to the patch's objects.
+#
+# Copyright (C) 2013 Jared Boone, ShareBrained Technology, Inc.
+#
+# This file is part of PD compiler.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+# pd_compile.py --profile writes <patch>.profile.json next to the C file,
+# listing the objects in each slot of the profile table. profile_dump()
+# prints lines of the form "pd_profile unit cycles", "pd_profile samples
+# N" and "pd_profile slot K COUNT"; other lines are ignored, so the dump
+# can be mixed with other output.
+
+import argparse
+import json
+import sys
+
+def parse_dump(lines):
+    """(unit, samples, {slot: count}) from profile_dump() output."""
+    unit = None
+    samples = 0
+    counts = {}
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 3 or fields[0] != 'pd_profile':
+            continue
+        if fields[1] == 'unit':
+            unit = fields[2]
+        elif fields[1] == 'samples':
+            samples = int(fields[2])
+        elif fields[1] == 'slot' and len(fields) == 4:
+            counts[int(fields[2])] = int(fields[3])
+    if unit is None:
+        raise Exception('no profile found in the dump')
+    return unit, samples, counts
+
+def describe(o):
+    location = ''
+    if o['file'] and o['line']:
+        location = ' (%s:%d)' % (o['file'], o['line'])
+    return 'object %d %s%s' % (o['id'], o['name'], location)
+
+arg_parser = argparse.ArgumentParser(description='Map a profile_dump() of generated code to patch objects.')
+arg_parser.add_argument('map', help='the .profile.json file written by pd_compile.py --profile')
+arg_parser.add_argument('dump', nargs='?', help='output of profile_dump() (default: standard input)')
+
+def main():
+    args = arg_parser.parse_args()
+    slots = json.load(open(args.map, 'r'))['slots']
+    dump_file = open(args.dump, 'r') if args.dump else sys.stdin
+    unit, samples, counts = parse_dump(dump_file)
+    if len(counts) != len(slots):
+        raise Exception('the dump has %d slots and the map %d; was the patch recompiled?' % (len(counts), len(slots)))
+
+    total = sum(counts.values())
+    print('%d samples, %s per sample' % (samples, unit))
+    print('%12s %7s  %s' % (unit, 'percent', 'slot'))
+    for slot in sorted(counts.keys(), key=lambda k: -counts[k]):
+        per_sample = float(counts[slot]) / samples if samples else 0.0
+        percent = 100.0 * counts[slot] / total if total else 0.0
+        objects = slots[slot]['objects']
+        print('%12.2f %6.1f%%  %s' % (per_sample, percent, describe(objects[0]) if objects else slots[slot]['name']))
+        for o in objects[1:]:
+            print('%12s %7s    %s' % ('', '', describe(o)))
+    print('%12.2f %6.1f%%  total' % (float(total) / samples if samples else 0.0, 100.0 if total else 0.0))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())